@@ -1,13 +1,26 @@
+import functools
+import os
 import socket
-import struct
 import time
+import zlib
+import compression
+import packetBuilder
 import packetParser
+from segmentBitmap import SegmentBitmap
+from packetTrace import TraceRecorder, trace_path, TRACE_RECEIVE, TRACE_DUPLICATE, TRACE_CORRUPT
+from socketProfiles import connect_tcp, effective_options
+from transferStats import IntervalSampler, distribution
 from Exceptions import *
 from ANSI import ANSI
 from constants import *
 
 BROADCAST_PORT = 13117
-UDP_BUFFER_SIZE = 65535
+UDP_BUFFER_SIZE = 65535  # holds the largest udp datagram, whatever segment size a request asks for
+UDP_RING_SIZE = 64  # preallocated receive buffers used by the fast udp receive path
+UDP_FAST_RCVBUF = 8 * 1024 * 1024  # socket receive buffer requested by the fast udp receive path
+TCP_RECV_SIZE = 65536
+RELIABLE_IDLE_TIMEOUT = 0.25  # reliable udp: silence that ends a pass once the transfer is flowing
+MAX_NACK_ROUNDS = 32  # reliable udp: nack rounds before giving up on the missing segments
 
 def get_user_input():
     """
@@ -15,14 +28,16 @@ def get_user_input():
       - file size (in bytes)
       - number of tcp connections
       - number of udp connections
+      - udp target rate (in bits/sec, empty or 0 = unpaced)
     """
     while True:
         try:
             file_size = int(input(f"{ANSI.BOLD}Enter file size to request (in bytes): {ANSI.ENDC}"))
             num_tcp = int(input(f"{ANSI.BOLD}Enter number of TCP connections: {ANSI.ENDC}"))
             num_udp = int(input(f"{ANSI.BOLD}Enter number of UDP connections: {ANSI.ENDC}"))
-            if file_size > 0 and num_tcp >= 0 and num_udp >= 0:
-                return file_size, num_tcp, num_udp
+            target_rate = int(input(f"{ANSI.BOLD}Enter UDP target rate in bits/sec (0 = unpaced): {ANSI.ENDC}") or 0)
+            if file_size > 0 and num_tcp >= 0 and num_udp >= 0 and target_rate >= 0:
+                return file_size, num_tcp, num_udp, target_rate
             else:
                 print(f"{ANSI.WARNING}All inputs must be positive integers{ANSI.ENDC}")
         except ValueError:
@@ -33,6 +48,7 @@ def listen_for_offer():
     """
     listen for "offer" messages from the server on the broadcast port
     validate the magic cookie and message type, and extract the udp and tcp ports
+    returns (server ip, udp port, tcp port, bitmask of the codecs the server supports)
     """
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -46,9 +62,10 @@ def listen_for_offer():
             result = packetParser.parse_udp_packet(data)
 
             if result['message_type'] == OFFER_TYPE:
-                print(f"{ANSI.OKGREEN}[Client] Received offer from {addr[0]}: UDP port={result['server_udp_port']}, TCP port={result['server_tcp_port']}{ANSI.ENDC}")
+                print(f"{ANSI.OKGREEN}[Client] Received offer from {addr[0]}: UDP port={result['server_udp_port']}, TCP port={result['server_tcp_port']}, "
+                      f"codecs={','.join(compression.codecs_in(result['codecs']))}{ANSI.ENDC}")
                 sock.close()
-                return addr[0], result['server_udp_port'], result['server_tcp_port']
+                return addr[0], result['server_udp_port'], result['server_tcp_port'], result['codecs']
 
         except (PacketParsingError, CookieMismatchError, UnknownMessageTypeError) as e:
             print(f"{ANSI.FAIL}[Client] Error parsing offer message: {e}{ANSI.ENDC}")
@@ -56,112 +73,623 @@ def listen_for_offer():
             print(f"{ANSI.FAIL}[Client] unexpected error: {e}{ANSI.ENDC}")
 
 
-def tcp_speed_test(server_ip, tcp_port, file_size, results, index):
+def _check_trailer(sock, crc):
+    """
+    read the crc32 trailer of a checked tcp response and compare it with the rolling crc of
+    the payload received; returns true if they match
+    """
+    trailer = bytearray(packetParser.CHECKSUM_TRAILER_SIZE)
+    if _recv_exactly(sock, memoryview(trailer)) < len(trailer):
+        raise ConnectionError("Server closed the connection before the checksum trailer")
+    return packetParser.CHECKSUM_TRAILER.unpack(trailer)[0] == crc
+
+
+def _receive_compressed(sock, decompressor, sampler, verify=False):
+    """
+    receive one compressed tcp response body (see packetBuilder.build_compressed_block),
+    decompressing every chunk as it arrives; the sampler and the crc see the decompressed bytes
+    returns (decompressed byte count, their crc32 if verify, server compression cpu seconds)
+    """
+    header = bytearray(packetParser.COMPRESSED_BLOCK_HEADER_SIZE)
+    header_view = memoryview(header)
+    buffer = bytearray(TCP_RECV_SIZE)
+    view = memoryview(buffer)
+    bytes_received = 0
+    crc = 0
+    while True:
+        if _recv_exactly(sock, header_view) < len(header):
+            raise ConnectionError("Server closed the connection in the middle of a compressed response")
+        decompressor.wire_bytes += len(header)
+        remaining = packetParser.COMPRESSED_BLOCK_HEADER.unpack(header)[0]
+        if not remaining:
+            break
+        if remaining == MAGIC_COOKIE and not bytes_received:
+            # a server over capacity answers with an error message instead of a body
+            rest = bytearray(packetParser.ERROR_MSG_SIZE - len(header))
+            received = _recv_exactly(sock, memoryview(rest))
+            raise (packetParser.rejection_error(header + rest[:received])
+                   or ConnectionError("Malformed compressed response"))
+        while remaining:
+            nbytes = sock.recv_into(view, min(remaining, TCP_RECV_SIZE))
+            if not nbytes:
+                raise ConnectionError("Server closed the connection in the middle of a compressed response")
+            remaining -= nbytes
+            data = decompressor.feed(view[:nbytes])
+            if data:
+                if verify:
+                    crc = zlib.crc32(data, crc)
+                bytes_received += len(data)
+                sampler.record(len(data))
+
+    # the end of the body carries the server's compression cpu time in microseconds
+    if _recv_exactly(sock, header_view) < len(header):
+        raise ConnectionError("Server closed the connection in the middle of a compressed response")
+    decompressor.wire_bytes += len(header)
+    return bytes_received, crc, packetParser.COMPRESSED_BLOCK_HEADER.unpack(header)[0] / 1e6
+
+
+def _compression_stats(decompressor, bytes_received, duration, compress_cpu_seconds=None):
+    """
+    result fields of a compressed transfer: the goodput on the wire next to the decompressed
+    "speed", the compression ratio and the cpu time spent on both ends (tcp only for the server)
+    """
+    if decompressor is None:
+        return {}
+    stats = {
+        "codec": CODEC_NAMES[decompressor.codec],
+        "wire_bytes": decompressor.wire_bytes,
+        "wire_speed": (decompressor.wire_bytes * 8) / duration if duration > 0 else 0.0,
+        "compression_ratio": bytes_received / decompressor.wire_bytes if decompressor.wire_bytes else 0.0,
+        "decompress_cpu_seconds": decompressor.cpu_seconds,
+    }
+    if compress_cpu_seconds is not None:
+        stats["compress_cpu_seconds"] = compress_cpu_seconds
+    return stats
+
+
+def _compression_note(stats):
+    if not stats:
+        return ""
+    return (f", {stats['codec']} {stats['wire_bytes']} bytes on the wire ({stats['wire_speed']:.2f} bits/sec, "
+            f"ratio {stats['compression_ratio']:.2f})")
+
+
+def tcp_speed_test(server_ip, tcp_port, file_size, results, index, verify=False, codec=CODEC_NONE, profile=None):
     """
     connect to the server over tcp, request the file size, and measure the transfer time
     store the results in the shared `results` list
+    verify asks for the crc32 trailer and checks it against a crc kept over the received bytes
+    codec asks for a compressed response; speed is then the decompressed goodput and
+    wire_speed the rate of the compressed bytes
+    profile (socketProfiles.SocketProfile) sets the socket options, the result carries the
+    effective values read back after the transfer
     """
+    sock = None
     try:
-        start_time = time.time()
+        sampler = IntervalSampler()
 
         # connect to the server
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect((server_ip, tcp_port))
+        sock = connect_tcp((server_ip, tcp_port), profile)
 
-        # send the requested file size
-        sock.sendall(f"{file_size}\n".encode())
+        # send the binary request header
+        flags = REQUEST_FLAG_CHECKSUM if verify else 0
+        sock.sendall(packetBuilder.build_tcp_request_msg(file_size, flags=flags, codec=codec))
 
-        # receive the file
+        # receive the file, never reading past it into the checksum trailer
         bytes_received = 0
-        while bytes_received < file_size:
-            data = sock.recv(65536)  # receive in 64 kb chunks
-            if not data:
-                break
-            bytes_received += len(data)
+        first_chunk = b''
+        crc = 0
+        decompressor = None
+        compress_cpu_seconds = None
+        if codec != CODEC_NONE:
+            decompressor = compression.Decompressor(codec)
+            bytes_received, crc, compress_cpu_seconds = _receive_compressed(sock, decompressor, sampler, verify)
+        else:
+            while bytes_received < file_size:
+                data = sock.recv(min(TCP_RECV_SIZE, file_size - bytes_received))  # receive in 64 kb chunks
+                if not data:
+                    break
+                if not bytes_received:
+                    first_chunk = data
+                if verify:
+                    crc = zlib.crc32(data, crc)
+                bytes_received += len(data)
+                sampler.record(len(data))
+
+        # a server over capacity answers with an error message and closes the connection
+        if bytes_received < file_size and bytes_received == packetParser.ERROR_MSG_SIZE:
+            rejection = packetParser.rejection_error(first_chunk)
+            if rejection is not None:
+                raise rejection
 
         # measure the transfer time
-        end_time = time.time()
-        duration = end_time - start_time
+        duration = sampler.finish().duration
         speed = (bytes_received * 8) / duration  # speed in bits/sec
 
+        integrity = {}
+        if verify:
+            integrity["checksum_ok"] = bytes_received == file_size and _check_trailer(sock, crc)
+        compressed = _compression_stats(decompressor, bytes_received, duration, compress_cpu_seconds)
+
         results[index] = {
             "type": "TCP",
             "bytes_received": bytes_received,
             "duration": duration,
-            "speed": speed
+            "speed": speed,
+            **integrity,
+            **compressed,
+            **effective_options(sock, profile),
+            **sampler.to_dict()
         }
 
-        print(f"{ANSI.HEADER}[TCP {index + 1}] Transfer completed: {bytes_received} bytes in {duration:.2f} seconds ({speed:.2f} bits/sec){ANSI.ENDC}")
+        print(f"{ANSI.HEADER}[TCP {index + 1}] Transfer completed: {bytes_received} bytes in {duration:.2f} seconds ({speed:.2f} bits/sec)"
+              f"{_compression_note(compressed)}{_integrity_note(integrity)}{ANSI.ENDC}")
 
+    except RequestRejectedError as e:
+        print(f"[TCP {index + 1}] {e}")
+        results[index] = None
     except Exception as e:
         print(f"{ANSI.FAIL}[TCP {index + 1}] ERROR: {e}{ANSI.ENDC}")
         results[index] = None
     finally:
-        sock.close()
+        if sock is not None:
+            sock.close()
+
+
+def _integrity_note(integrity):
+    if "checksum_ok" in integrity:
+        return ", checksum ok" if integrity["checksum_ok"] else f"{ANSI.FAIL}, CHECKSUM MISMATCH"
+    if "corrupt_segments" in integrity:
+        return f", {integrity['corrupt_segments']} corrupt segments"
+    return ""
+
+
+def _recv_exactly(sock, view):
+    """
+    fill view from sock; returns the byte count, short only if the server closed the connection
+    """
+    received = 0
+    while received < len(view):
+        nbytes = sock.recv_into(view[received:])
+        if not nbytes:
+            break
+        received += nbytes
+    return received
+
+
+def tcp_session_test(pool, file_size, requests, results, index, verify=False, codec=CODEC_NONE):
+    """
+    keep-alive variant of tcp_speed_test: pipeline `requests` requests of file_size bytes on a
+    pooled connection and time every framed response on its own
+    the first response of a new connection pays for slow start, the later ones show the
+    steady-state throughput; the connection goes back to the pool for the next round
+    verify checks the crc32 trailer of every response
+    codec asks for compressed responses (see tcp_speed_test)
+    """
+    sock = None
+    try:
+        sampler = IntervalSampler()
+        sock, connect_time = pool.acquire()
+        sock.settimeout(10)
+
+        flags = REQUEST_FLAG_KEEPALIVE | (REQUEST_FLAG_CHECKSUM if verify else 0)
+        request = packetBuilder.build_tcp_request_msg(file_size, flags=flags, codec=codec)
+        sock.sendall(request * requests)
+
+        header = bytearray(packetParser.RESPONSE_HEADER_SIZE)
+        buffer = bytearray(TCP_RECV_SIZE)
+        view = memoryview(buffer)
+        response_durations = []
+        bytes_received = 0
+        checksums_ok = True
+        decompressor = compression.Decompressor(codec) if codec != CODEC_NONE else None
+        compress_cpu_seconds = 0.0
+        for _ in range(requests):
+            started = time.perf_counter()
+            received = _recv_exactly(sock, memoryview(header))
+            if received < len(header):
+                # a rejected request is answered with an error message, shorter than a frame header
+                raise (packetParser.rejection_error(header[:received])
+                       or ConnectionError("Server closed the connection in the middle of a response"))
+            remaining = packetParser.unpack_response_header(header)
+            crc = 0
+            if decompressor is not None:
+                # every response is a compressed body of its own, framed by the uncompressed length
+                decompressor.reset()
+                received, crc, cpu_seconds = _receive_compressed(sock, decompressor, sampler, verify)
+                if received != remaining:
+                    checksums_ok = False
+                bytes_received += received
+                compress_cpu_seconds += cpu_seconds
+                remaining = 0
+            while remaining:
+                nbytes = sock.recv_into(view, min(remaining, TCP_RECV_SIZE))
+                if not nbytes:
+                    raise ConnectionError("Server closed the connection in the middle of a response")
+                if verify:
+                    crc = zlib.crc32(view[:nbytes], crc)
+                remaining -= nbytes
+                bytes_received += nbytes
+                sampler.record(nbytes)
+            if verify and not _check_trailer(sock, crc):
+                checksums_ok = False
+            response_durations.append(time.perf_counter() - started)
+
+        options = effective_options(sock, pool.profile)
+        pool.release(sock)
+        sock = None
+
+        duration = sampler.finish().duration
+        speed = (bytes_received * 8) / duration
+        steady = response_durations[1:] or response_durations
+        steady_speed = (file_size * len(steady) * 8) / sum(steady) if sum(steady) > 0 else 0.0
+        integrity = {"checksum_ok": checksums_ok} if verify else {}
+        compressed = _compression_stats(decompressor, bytes_received, duration, compress_cpu_seconds)
+
+        results[index] = {
+            "type": "TCP",
+            "bytes_received": bytes_received,
+            "duration": duration,
+            "speed": speed,
+            "requests": requests,
+            "reused_connection": connect_time is None,
+            "connect_time": connect_time,
+            "response_durations": response_durations,
+            "steady_state_speed": steady_speed,
+            **integrity,
+            **compressed,
+            **options,
+            **sampler.to_dict()
+        }
+
+        reuse = "reused connection" if connect_time is None else f"new connection ({connect_time * 1000:.2f} ms)"
+        print(f"{ANSI.HEADER}[TCP {index + 1}] Session completed: {requests} x {file_size} bytes in {duration:.2f} seconds "
+              f"({speed:.2f} bits/sec, steady state {steady_speed:.2f} bits/sec), {reuse}{_compression_note(compressed)}"
+              f"{_integrity_note(integrity)}{ANSI.ENDC}")
+
+    except RequestRejectedError as e:
+        print(f"[TCP {index + 1}] {e}")
+        results[index] = None
+    except Exception as e:
+        print(f"{ANSI.FAIL}[TCP {index + 1}] ERROR: {e}{ANSI.ENDC}")
+        results[index] = None
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def tcp_connection_test(server_ip, tcp_port, file_size, connections, results, index, profile=None):
+    """
+    connection churn: open `connections` connections one after another, each requesting
+    file_size (typically tiny) bytes, to measure setup cost instead of bulk throughput
+    stores connections per second and the raw connect / first byte latencies in results,
+    plus the effective socket options of the last connection
+    """
+    request = packetBuilder.build_tcp_request_msg(file_size)
+    connect_times = []
+    first_byte_times = []
+    failed = 0
+    options = {}
+
+    start = time.perf_counter()
+    for _ in range(connections):
+        try:
+            started = time.perf_counter()
+            with connect_tcp((server_ip, tcp_port), profile, timeout=10) as sock:
+                connected = time.perf_counter()
+                sock.sendall(request)
+                bytes_received = 0
+                while bytes_received < file_size:
+                    data = sock.recv(65536)
+                    if not data:
+                        break
+                    if not bytes_received:
+                        first_byte = time.perf_counter()
+                    bytes_received += len(data)
+                options = effective_options(sock, profile)
+        except OSError:
+            failed += 1
+            continue
+        if bytes_received < file_size:
+            failed += 1
+            continue
+        connect_times.append(connected - started)
+        if file_size:
+            first_byte_times.append(first_byte - connected)
+    duration = time.perf_counter() - start
+
+    results[index] = {
+        "type": "CONN",
+        "connections": connections,
+        "completed": len(connect_times),
+        "failed": failed,
+        "duration": duration,
+        "connections_per_second": len(connect_times) / duration if duration > 0 else 0.0,
+        "connect_times": connect_times,
+        "first_byte_times": first_byte_times,
+        **options,
+    }
+    connect = distribution(connect_times) or {}
+    print(f"{ANSI.HEADER}[CONN {index + 1}] {len(connect_times)}/{connections} connections in {duration:.2f} seconds "
+          f"({results[index]['connections_per_second']:.1f}/sec), connect p50 {connect.get('p50', 0) * 1000:.3f} ms{ANSI.ENDC}")
+
+
+def _receive_payload(sock, sampler, segments=None, idle_timeout=None, decompressor=None, trace=None):
+    """
+    receive payload packets until no data arrives for the socket timeout
+    every new segment is recorded in sampler (and in segments, to continue an earlier pass)
+    idle_timeout replaces the socket timeout once the first segment arrived
+    checked payloads are verified against their crc32, failures are counted in segments.corrupt
+    and not marked
+    decompressor decodes compressed segments, the sizes recorded are the decompressed ones; a
+    segment that fails to decode counts as corrupt
+    trace (packetTrace.TraceRecorder) gets a record for every payload datagram, with its payload
+    size as received
+    returns (bytes_received, segments), segments being a SegmentBitmap (None if nothing arrived)
+    """
+    bytes_received = 0
+
+    while True:
+        try:
+            data, addr = sock.recvfrom(UDP_BUFFER_SIZE)
+            packet = packetParser.parse_packet_view(data)
+
+            if packet.message_type == PAYLOAD_TYPE or packet.message_type == CHECKED_PAYLOAD_TYPE:
+                if segments is None:
+                    segments = SegmentBitmap(packet.total_segments)
+                    if idle_timeout is not None:
+                        sock.settimeout(idle_timeout)
+
+                if packet.checksum is not None and zlib.crc32(packet.payload) != packet.checksum:
+                    segments.corrupt += 1
+                    if trace is not None:
+                        trace.record(packet.current_segment, packet.payload_size, TRACE_CORRUPT)
+                    continue
+                size = packet.payload_size
+                if decompressor is not None:
+                    try:
+                        size = len(decompressor.segment(packet.payload))
+                    except compression.DECODE_ERRORS:
+                        segments.corrupt += 1
+                        if trace is not None:
+                            trace.record(packet.current_segment, packet.payload_size, TRACE_CORRUPT)
+                        continue
+                if segments.mark(packet.current_segment):
+                    bytes_received += size
+                    sampler.record(size)
+                    if size > segments.segment_size:
+                        segments.segment_size = size
+                    if trace is not None:
+                        trace.record(packet.current_segment, packet.payload_size)
+                elif trace is not None:
+                    trace.record(packet.current_segment, packet.payload_size, TRACE_DUPLICATE)
+
+            elif packet.message_type == ERROR_TYPE:
+                raise RequestRejectedError(packet.control['error_code'], packet.control['retry_after'])
+
+        except socket.timeout:
+            # stop receiving if no data arrives for 1 second
+            break
+        except PacketParsingError:
+            # a malformed datagram is dropped, like one lost on the way
+            continue
+
+    return bytes_received, segments
+
+
+def _receive_payload_fast(sock, sampler, segments=None, idle_timeout=None, verify=False, decompressor=None,
+                          trace=None):
+    """
+    high-rate variant of _receive_payload
+    datagrams are read with recv_into into a preallocated ring of buffers and only the 21 byte
+    header is decoded in place, so no bytes object, payload copy or dict is created per packet
+    verify expects checked payloads (25 byte header) and hashes each payload in place
+    decompressor decodes compressed segments and trace records every datagram, as in _receive_payload
+    """
+    ring = [bytearray(UDP_BUFFER_SIZE) for _ in range(UDP_RING_SIZE)]
+    views = [memoryview(buffer) for buffer in ring]
+    slot = 0
+    bytes_received = 0
+    recv_into = sock.recv_into
+    if verify:
+        unpack_header = packetParser.unpack_checked_payload_header
+        header_size = packetParser.CHECKED_PAYLOAD_HEADER_SIZE
+    else:
+        unpack_header = packetParser.unpack_payload_header
+        header_size = packetParser.PAYLOAD_HEADER_SIZE
+    record = sampler.record
+
+    while True:
+        buffer = ring[slot]
+        view = views[slot]
+        slot = (slot + 1) % UDP_RING_SIZE
+        try:
+            nbytes = recv_into(buffer)
+        except socket.timeout:
+            # stop receiving if no data arrives for 1 second
+            break
 
+        try:
+            header = unpack_header(buffer, nbytes)
+        except PacketParsingError:
+            # too short for a payload header; an error message is the one short datagram that matters
+            if nbytes == packetParser.ERROR_MSG_SIZE:
+                rejection = packetParser.rejection_error(buffer[:nbytes])
+                if rejection is not None:
+                    raise rejection
+            continue
+        if header is None:
+            continue
+
+        if segments is None:
+            segments = SegmentBitmap(header[0])
+            if idle_timeout is not None:
+                sock.settimeout(idle_timeout)
+        if verify and zlib.crc32(view[header_size:nbytes]) != header[2]:
+            segments.corrupt += 1
+            if trace is not None:
+                trace.record(header[1], nbytes - header_size, TRACE_CORRUPT)
+            continue
+        size = nbytes - header_size
+        if decompressor is not None:
+            try:
+                size = len(decompressor.segment(view[header_size:nbytes]))
+            except compression.DECODE_ERRORS:
+                segments.corrupt += 1
+                if trace is not None:
+                    trace.record(header[1], nbytes - header_size, TRACE_CORRUPT)
+                continue
+        if segments.mark(header[1]):
+            bytes_received += size
+            record(size)
+            if size > segments.segment_size:
+                segments.segment_size = size
+            if trace is not None:
+                trace.record(header[1], nbytes - header_size)
+        elif trace is not None:
+            trace.record(header[1], nbytes - header_size, TRACE_DUPLICATE)
 
-def udp_speed_test(server_ip, udp_port, file_size, results, index):
+    return bytes_received, segments
+
+
+def _receive_reliable(sock, server_addr, sampler, receive):
+    """
+    reliable udp: after the first pass, nack the ranges that are still missing and receive the
+    retransmissions, round after round, then tell the server the transfer is over (empty nack)
+    returns (bytes_received, segments, reliability statistics)
+    """
+    bytes_received, segments = receive(sock, sampler, idle_timeout=RELIABLE_IDLE_TIMEOUT)
+    if segments is None:
+        return bytes_received, segments, {}
+
+    first_pass_success_rate = segments.success_rate
+    rounds = 0
+    requested = 0
+    while not segments.complete and rounds < MAX_NACK_ROUNDS:
+        missing = segments.missing_ranges()
+        for start in range(0, len(missing), NACK_MAX_RANGES):
+            sock.sendto(packetBuilder.build_nack_msg(missing[start:start + NACK_MAX_RANGES]), server_addr)
+        requested += sum(length for _, length in missing)
+        rounds += 1
+        received, segments = receive(sock, sampler, segments)
+        bytes_received += received
+    sock.sendto(packetBuilder.build_nack_msg([]), server_addr)
+
+    return bytes_received, segments, {
+        "first_pass_success_rate": first_pass_success_rate,
+        "nack_rounds": rounds,
+        "retransmit_requests": requested,
+    }
+
+
+def udp_speed_test(server_ip, udp_port, file_size, results, index, target_rate=0, fast_recv=False,
+                   reliable=False, verify=False, codec=CODEC_NONE, profile=None, segment_size=0, fragment=False,
+                   trace_dir=None):
     """
     send a "request" message to the server over udp, then receive payload packets
     measure the transfer time and calculate packet loss
+    a non-zero target_rate (bits/sec) asks the server to pace the segments at that rate
+    fast_recv switches to the allocation-free high-rate receive path
+    reliable makes the client nack missing segments until the transfer is complete
+    verify asks for checked payload segments; a segment failing its crc32 counts as lost
+    codec asks for individually compressed segments (see tcp_speed_test for the result fields)
+    profile (socketProfiles.SocketProfile) sets the socket options; its udp receive buffer
+    replaces the one fast_recv asks for
+    segment_size asks for that many payload bytes per datagram (0 = the server's default); the
+    server clamps it to the path mtu unless fragment allows ip fragmentation. the result's
+    segment_size is the size the server actually used
+    trace_dir records every datagram received in a packet trace there (packetTrace.py), the
+    result's trace field names the file; the request carries a random transfer id, the server
+    names its send trace of the transfer after it too
     """
+    trace = None
     try:
-        start_time = time.time()
+        sampler = IntervalSampler(track_jitter=True)
 
         # create a udp socket
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.settimeout(1.0)
+        if fast_recv:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_FAST_RCVBUF)
+        if profile is not None:
+            profile.apply_udp(sock)
+        transfer_id = 0
+        if trace_dir:
+            transfer_id = int.from_bytes(os.urandom(8), 'big') or 1
+            trace = TraceRecorder(trace_path(trace_dir, TRACE_RECEIVE, transfer_id), TRACE_RECEIVE, transfer_id)
 
         # send a "request" message
-        request_packet = struct.pack('>I B Q', MAGIC_COOKIE, REQUEST_TYPE, file_size)
+        flags = ((REQUEST_FLAG_RELIABLE if reliable else 0) | (REQUEST_FLAG_CHECKSUM if verify else 0)
+                 | (REQUEST_FLAG_FRAGMENT if fragment else 0))
+        request_packet = packetBuilder.build_request_msg(file_size, target_rate, flags, codec,
+                                                         segment_size=segment_size, transfer_id=transfer_id)
         sock.sendto(request_packet, (server_ip, udp_port))
 
         # receive payload packets
-        bytes_received = 0
-        segments_received = set()
-        total_segments = None
-
-        while True:
-            try:
-                data, addr = sock.recvfrom(UDP_BUFFER_SIZE)
-                result = packetParser.parse_udp_packet(data)
-
-                if result['message_type'] == PAYLOAD_TYPE:
-                    if total_segments is None:
-                        total_segments = result['total_segments']
-
-                    current_segment = result['current_segment']
-                    segments_received.add(current_segment)
-                    bytes_received += len(result['payload'])
-
-            except socket.timeout:
-                # stop receiving if no data arrives for 1 second
-                break
+        decompressor = compression.Decompressor(codec) if codec != CODEC_NONE else None
+        if fast_recv:
+            receive = functools.partial(_receive_payload_fast, verify=verify, decompressor=decompressor, trace=trace)
+        else:
+            receive = functools.partial(_receive_payload, decompressor=decompressor, trace=trace)
+        reliability = {}
+        if reliable:
+            bytes_received, segments, reliability = _receive_reliable(sock, (server_ip, udp_port), sampler, receive)
+        else:
+            bytes_received, segments = receive(sock, sampler)
 
-        # measure the transfer time
-        end_time = time.time()
-        duration = end_time - start_time
+        # measure the transfer time up to the last datagram, not the idle timeout that ended it
+        duration = sampler.finish(at_last_byte=True).duration
         speed = (bytes_received * 8) / duration if duration > 0 else 0  # speed in bits/sec
+        if reliability:
+            reliability["time_to_complete"] = duration if segments.complete else None
 
         # calculate packet loss
-        if total_segments:
-            packets_received = len(segments_received)
-            success_rate = (packets_received / total_segments) * 100
+        if segments is not None:
+            success_rate = segments.success_rate
+            loss = segments.loss_summary()
+            duplicates = segments.duplicates
+            corrupt = segments.corrupt
         else:
             success_rate = 0.0
+            loss = SegmentBitmap(0).loss_summary()
+            duplicates = 0
+            corrupt = 0
+        integrity = {"corrupt_segments": corrupt} if verify else {}
+        compressed = _compression_stats(decompressor, bytes_received, duration)
+        if trace is not None and segments is not None:
+            trace.set_transfer(segments.total_segments, segments.segment_size)
 
         results[index] = {
             "type": "UDP",
             "bytes_received": bytes_received,
             "duration": duration,
             "speed": speed,
-            "success_rate": success_rate
+            "success_rate": success_rate,
+            "target_rate": target_rate,
+            "duplicate_segments": duplicates,
+            "segment_size": segments.segment_size if segments is not None else None,
+            **integrity,
+            **compressed,
+            **loss,
+            **reliability,
+            **effective_options(sock, profile),
+            **({"trace": trace.path} if trace is not None else {}),
+            **sampler.to_dict()
         }
 
-        print(f"{ANSI.OKCYAN}[UDP {index + 1}] Transfer completed: {bytes_received} bytes in {duration:.2f} seconds ({speed:.2f} bits/sec), success rate: {success_rate:.2f}%{ANSI.ENDC}")
+        print(f"{ANSI.OKCYAN}[UDP {index + 1}] Transfer completed: {bytes_received} bytes in {duration:.2f} seconds ({speed:.2f} bits/sec), success rate: {success_rate:.2f}%, "
+              f"loss runs: {loss['loss_runs']} (longest {loss['max_loss_run']}){_compression_note(compressed)}{_integrity_note(integrity)}{ANSI.ENDC}")
+        if reliability:
+            print(f"{ANSI.OKCYAN}[UDP {index + 1}] First pass: {reliability['first_pass_success_rate']:.2f}%, "
+                  f"{reliability['retransmit_requests']} segments nacked in {reliability['nack_rounds']} rounds{ANSI.ENDC}")
 
+    except RequestRejectedError as e:
+        print(f"[UDP {index + 1}] {e}")
+        results[index] = None
     except Exception as e:
         print(f"{ANSI.FAIL}[UDP {index + 1}] ERROR: {e}{ANSI.ENDC}")
         results[index] = None
     finally:
+        if trace is not None:
+            trace.close()
         sock.close()
@@ -1,4 +1,5 @@
 from ANSI import ANSI
+from constants import ERROR_REASONS
 
 class PacketParsingError(Exception):
     """
@@ -39,3 +40,15 @@ class UnknownMessageTypeError(PacketParsingError):
     def __init__(self, message_type: int):
         message = f"Unknown message type: 0x{message_type:x}."
         super().__init__(message)
+
+
+class RequestRejectedError(Exception):
+    """
+    Raised when the server answers a request with an error message (admission control).
+    """
+    def __init__(self, error_code, retry_after=0.0):
+        self.error_code = error_code
+        self.retry_after = retry_after
+        reason = ERROR_REASONS.get(error_code, f"error 0x{error_code:x}")
+        retry = f", retry after {retry_after:.1f} seconds" if retry_after else ""
+        super().__init__(f"{ANSI.WARNING}Request rejected: {reason}{retry}{ANSI.ENDC}")
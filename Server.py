@@ -1,50 +1,163 @@
+import queue
 import socket
-import struct
 import threading
 import time
+import compression
+import metrics
 import packetBuilder
 import packetParser
+import serverLog
 from Exceptions import *
-from ANSI import ANSI
 from constants import *
+from payloadSource import TcpPayload
+from socketProfiles import DEFAULT_PROFILE, effective_options, describe
+from udpSender import UdpBatchSender, max_segment_size, allow_fragments, MAX_DATAGRAM_SIZE
+from packetTrace import TraceRecorder, trace_path, TRACE_SEND
 BROADCAST_PORT = 13117
 OFFER_INTERVAL = 1.0
-UDP_CHUNK_SIZE = 1400
+UDP_CHUNK_SIZE = 1400  # default udp segment size, for requests that do not ask for one
+UDP_MIN_SEGMENT_SIZE = 64
 TCP_CHUNK_SIZE = 65536
+NACK_IDLE_TIMEOUT = 5.0  # seconds a reliable udp transfer waits for the next nack before giving up
+TRACE_CLOSE_GRACE = 1.0  # seconds a stopping udp server gives its transfers to close their packet traces
+TCP_KEEPALIVE_TIMEOUT = 300  # seconds an idle keep-alive tcp session waits for its next request
+TCP_LISTEN_BACKLOG = 5  # listen backlog of socket profiles that leave it to the engine
+
+udp_log = serverLog.get_logger("UDP")
+tcp_log = serverLog.get_logger("TCP")
 
 # -----------------------------------------------------------------------------
 # 1) Thread: Broadcast "offer" messages every second
 # -----------------------------------------------------------------------------
-def broadcast_offers(stop_event, udp_port, tcp_port):
+def broadcast_offers(stop_event, udp_port, tcp_port, admission=None):
     """
     broadcasts an "offer" message via udp every offer_interval seconds
     includes the dynamic tcp and udp ports in the message
+    offers are paused while the admission controller reports the server saturated
     """
     broadcaster = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
     broadcaster.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
 
     # build the offer packet dynamically
-    offer_message = packetBuilder.build_offer_msg(udp_port, tcp_port)
-    print(f"{ANSI.OKCYAN}[UDP] Broadcasting offers on port {BROADCAST_PORT}{ANSI.ENDC}")
+    offer_message = packetBuilder.build_offer_msg(udp_port, tcp_port, compression.SUPPORTED_CODECS)
+    udp_log.info("Broadcasting offers on port %d", BROADCAST_PORT)
 
+    paused = False
     while not stop_event.is_set():
+        saturated = admission is not None and admission.saturated
+        if saturated != paused:
+            paused = saturated
+            if paused:
+                udp_log.warning("Server saturated, pausing offers")
+            else:
+                udp_log.warning("Capacity available, resuming offers")
+
         try:
-            broadcaster.sendto(offer_message, ('<broadcast>', BROADCAST_PORT))
+            if not paused:
+                broadcaster.sendto(offer_message, ('<broadcast>', BROADCAST_PORT))
         except Exception as e:
-            print(f"{ANSI.FAIL}[broadcast thread] Error sending offer: {e}{ANSI.ENDC}")
+            udp_log.error("Error sending offer: %s", e)
 
         time.sleep(OFFER_INTERVAL)
 
     broadcaster.close()
-    print(f"{ANSI.OKCYAN}[UDP] Broadcast thread stopped{ANSI.ENDC}")
+    udp_log.info("Broadcast thread stopped")
 
 # -----------------------------------------------------------------------------
 # 2) UDP Server
 # -----------------------------------------------------------------------------
-def handle_udp_request(data, addr, udp_socket):
+def serve_nacks(sender, nacks):
+    """
+    second phase of a reliable udp transfer: retransmit the ranges of every nack the client sends
+    until it reports the transfer complete (an empty nack) or goes quiet for NACK_IDLE_TIMEOUT
+    a None in nacks means the server is stopping
+    returns true if the client confirmed completion
+    """
+    while True:
+        try:
+            ranges = nacks.get(timeout=NACK_IDLE_TIMEOUT)
+        except queue.Empty:
+            return False
+        if ranges is None:
+            return False
+        if not ranges:
+            return True
+        sender.retransmit(ranges)
+        # a round with many missing ranges is nacked in several datagrams, take them all before sending
+        while True:
+            try:
+                ranges = nacks.get_nowait()
+            except queue.Empty:
+                break
+            if ranges is None:
+                return False
+            if not ranges:
+                return True
+            sender.retransmit(ranges)
+        sender.send_all()
+
+
+def udp_segment_size(request, addr):
+    """
+    segment size of an admitted udp request: the one it asks for (UDP_CHUNK_SIZE if none), at
+    least UDP_MIN_SEGMENT_SIZE and clamped to the largest payload that reaches addr in one
+    unfragmented datagram, unless the request allows fragments (REQUEST_FLAG_FRAGMENT), which
+    only the 64 KiB datagram limit applies to
+    returns (segment size, whether its datagrams exceed the path mtu)
+    """
+    if request['flags'] & REQUEST_FLAG_CHECKSUM:
+        header_size = packetParser.CHECKED_PAYLOAD_HEADER_SIZE
+    else:
+        header_size = packetParser.PAYLOAD_HEADER_SIZE
+    unfragmented = max_segment_size(addr, header_size)
+    limit = MAX_DATAGRAM_SIZE - header_size if request['flags'] & REQUEST_FLAG_FRAGMENT else unfragmented
+    segment_size = max(UDP_MIN_SEGMENT_SIZE, min(request['segment_size'] or UDP_CHUNK_SIZE, limit))
+    return segment_size, segment_size > unfragmented
+
+
+def serve_udp_transfer(request, addr, udp_socket, sessions=None, budget=None, payload=None, trace=None):
+    """
+    send the payload segments of one admitted udp request, then serve its nacks if it is reliable
+    budget is the server-wide byte budget (a shared TokenBucket) or None
+    payload is the server's TcpPayload the segments are cut from (None = constant fill)
+    trace is the packetTrace.TraceRecorder of the segments sent, or None
+    """
+    segment_size, fragmented = udp_segment_size(request, addr)
+    sender = UdpBatchSender(udp_socket, addr, request['file_size'], segment_size,
+                            use_gso=False if fragmented else None,
+                            target_rate=request['target_rate'], budget=budget, payload=payload,
+                            checksum=bool(request['flags'] & REQUEST_FLAG_CHECKSUM), codec=request['codec'],
+                            offset=request['offset'], trace=trace)
+    reliable = sessions is not None and request['flags'] & REQUEST_FLAG_RELIABLE
+    if not reliable:
+        bytes_sent = sender.send_all()
+        udp_log.info("Finished sending %d bytes to %s in %d segments of %d bytes", bytes_sent, addr,
+                     sender.next_segment, segment_size)
+        return
+
+    nacks = queue.Queue()
+    sessions[addr] = nacks
+    try:
+        sender.send_all()
+        confirmed = serve_nacks(sender, nacks)
+    finally:
+        sessions.pop(addr, None)
+    udp_log.info("Reliable transfer to %s %s: %d bytes in %d segments, %d retransmitted", addr,
+                 "confirmed" if confirmed else "timed out waiting for nacks", sender.bytes_sent,
+                 sender.total_segments, sender.retransmitted)
+
+
+def handle_udp_request(data, addr, udp_socket, sessions=None, admission=None, payload=None, trace_dir=None,
+                       traces=None):
     """
     handle a single udp datagram in a separate thread
     parses the datagram to determine its type and sends payloads if it is a request
+    sessions maps the address of every reliable transfer in progress to the queue its nacks are
+    routed to (the nack datagrams arrive here too, each in its own thread)
+    requests over the limits of the admission controller, or for a codec this server lacks, are
+    answered with an error message
+    with a trace_dir every transfer writes a send trace there (packetTrace.trace_path), kept in the
+    traces set while it is open
     """
     try:
         # parse the udp packet
@@ -53,125 +166,262 @@ def handle_udp_request(data, addr, udp_socket):
         msg_type = result['message_type']
         if msg_type == REQUEST_TYPE:
             file_size = result['file_size']
-            print(f"{ANSI.OKCYAN}[UDP] {addr} Requested {file_size} bytes{ANSI.ENDC}")
-
-            total_segments = (file_size + UDP_CHUNK_SIZE - 1) // UDP_CHUNK_SIZE
-            bytes_sent = 0
-            segment_index = 0
-            dummy_data = b'X' * UDP_CHUNK_SIZE
-
-            while bytes_sent < file_size:
-                remaining = file_size - bytes_sent
-                chunk = dummy_data[:min(UDP_CHUNK_SIZE, remaining)]
-
-                payload_header = struct.pack(
-                    '>I B Q Q',
-                    MAGIC_COOKIE,
-                    PAYLOAD_TYPE,
-                    total_segments,
-                    segment_index
-                )
-                packet = payload_header + chunk
-                udp_socket.sendto(packet, addr)
-                bytes_sent += len(chunk)
-                segment_index += 1
-
-            print(f"{ANSI.OKCYAN}[UDP] Finished sending {bytes_sent} bytes to {addr} in {segment_index} segments{ANSI.ENDC}")
+            if result['target_rate']:
+                udp_log.info("%s Requested %d bytes at %d bits/sec", addr, file_size, result['target_rate'])
+            else:
+                udp_log.info("%s Requested %d bytes", addr, file_size)
+            metrics.UDP_REQUESTS.inc()
+
+            budget = None
+            try:
+                compression.check_codec(result['codec'])
+                if admission is not None:
+                    admission.admit(addr[0], file_size)
+                    budget = admission.budget
+            except RequestRejectedError as e:
+                udp_socket.sendto(packetBuilder.build_error_msg(e.error_code, e.retry_after), addr)
+                metrics.UDP_REJECTED.inc()
+                udp_log.warning("%s %s", addr, e)
+                return
+            metrics.UDP_ACTIVE.inc()
+            trace = None
+            try:
+                # inside the try, a trace that cannot be created must not keep the admission slot
+                if trace_dir:
+                    trace = TraceRecorder(trace_path(trace_dir, TRACE_SEND, result['transfer_id'], addr),
+                                          TRACE_SEND, result['transfer_id'])
+                    if traces is not None:
+                        traces.add(trace)
+                serve_udp_transfer(result, addr, udp_socket, sessions, budget, payload, trace)
+            finally:
+                if trace is not None:
+                    trace.close()
+                    if traces is not None:
+                        traces.discard(trace)
+                metrics.UDP_ACTIVE.dec()
+                if admission is not None:
+                    admission.release(addr[0])
+        elif msg_type == NACK_TYPE and sessions is not None and addr in sessions:
+            sessions[addr].put(result['ranges'])
         else:
-            print(f"{ANSI.OKCYAN}[UDP] Received unexpected message type {msg_type} from {addr}, ignoring{ANSI.ENDC}")
+            udp_log.debug("Received unexpected message type %d from %s, ignoring", msg_type, addr)
 
     except (PacketTooShortError, CookieMismatchError, UnknownMessageTypeError) as e:
-        print(f"{ANSI.FAIL}[UDP] Parsing error from {addr}: {e}{ANSI.ENDC}")
+        udp_log.error("Parsing error from %s: %s", addr, e)
     except Exception as e:
-        print(f"{ANSI.FAIL}[UDP] Unexpected error handling packet from {addr}: {e}{ANSI.ENDC}")
+        udp_log.error("Unexpected error handling packet from %s: %s", addr, e)
 
 
-def udp_server_loop(stop_event, udp_port):
+def udp_server_loop(stop_event, udp_port, reuse_port=False, admission=None, payload=None, profile=None,
+                    trace_dir=None, ready=None):
     """
     listens for udp datagrams on the provided udp_port and handles each in a thread
+    reuse_port lets several worker processes bind the same port (SO_REUSEPORT)
+    admission is an optional AdmissionController shared with the tcp server
+    payload is the TcpPayload shared with the tcp server, udp segments carry its bytes
+    profile is the socketProfiles.SocketProfile of the socket (kernel defaults if None)
+    trace_dir makes every transfer record a packet trace of what it sends in that directory; when
+    the server stops, reliable transfers waiting for nacks are ended and traces still open after
+    TRACE_CLOSE_GRACE are closed, so none is left without its header
+    ready is an optional semaphore, released once the socket is bound
     """
+    profile = profile if profile is not None else DEFAULT_PROFILE
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    profile.apply_udp(sock)
+    allow_fragments(sock)
     sock.bind(('', udp_port))
     sock.settimeout(1.0)
+    if ready is not None:
+        ready.release()
 
-    print(f"{ANSI.OKCYAN}[UDP] Server listening on port {udp_port}{ANSI.ENDC}")
+    udp_log.info("Server listening on port %d (socket profile %s)", udp_port,
+                 describe(effective_options(sock, profile)))
 
+    sessions = {}  # addr -> nack queue of the reliable transfers in progress
+    traces = set()  # packet traces of the transfers in progress
     while not stop_event.is_set():
         try:
             data, addr = sock.recvfrom(65535)
         except socket.timeout:
             continue
         except Exception as e:
-            print(f"{ANSI.FAIL}[UDP] recvfrom error: {e}{ANSI.ENDC}")
+            udp_log.error("recvfrom error: %s", e)
             continue
 
         t = threading.Thread(
             target=handle_udp_request,
-            args=(data, addr, sock),
+            args=(data, addr, sock, sessions, admission, payload, trace_dir, traces),
             daemon=True
         )
         t.start()
 
+    # the handler threads are daemons and die with the process, let them close their traces first
+    for nacks in list(sessions.values()):
+        nacks.put(None)
+    deadline = time.monotonic() + TRACE_CLOSE_GRACE
+    while traces and time.monotonic() < deadline:
+        time.sleep(0.01)
+    for trace in list(traces):
+        try:
+            trace.close()
+        except BufferError:
+            # the transfer was writing a record at this very moment
+            udp_log.warning("Could not close packet trace %s", trace.path)
     sock.close()
-    print(f"{ANSI.OKCYAN}[UDP] UDP Server loop stopped{ANSI.ENDC}")
+    udp_log.info("UDP Server loop stopped")
 
 # -----------------------------------------------------------------------------
 # 3) TCP Server
 # -----------------------------------------------------------------------------
-def handle_tcp_connection(client_sock, addr):
+def read_tcp_request(sock):
+    """
+    read one request header from a blocking tcp socket with recv_into a fixed-size buffer
+    a binary header normally arrives in two calls (up to its length byte, then the rest); never
+    reads past the end of the header, so the next pipelined request stays in the socket
+    returns None if the client closed the connection before sending anything
+    """
+    header = bytearray(packetParser.TCP_REQUEST_MAX_SIZE)
+    view = memoryview(header)
+    received = 0
+    while True:
+        nbytes = sock.recv_into(view[received:received + packetParser.tcp_request_remaining(header[:received])])
+        if not nbytes:
+            if not received:
+                return None
+            raise ConnectionError("Client closed in the middle of a request header")
+        received += nbytes
+        request = packetParser.parse_tcp_request(header[:received])
+        if request is not None:
+            return request
+
+
+def reject_malformed_request(sock):
+    """
+    answer a request header that did not parse with an error message; the rest of the header
+    still unread is drained first, closing over unread bytes would reset the connection and
+    could take the error message with it
+    """
+    sock.setblocking(False)
+    try:
+        while sock.recv(packetParser.TCP_REQUEST_MAX_SIZE):
+            pass
+    except OSError:
+        pass
+    try:
+        sock.send(packetBuilder.build_error_msg(ERROR_BAD_REQUEST))
+    except OSError:
+        pass
+
+
+def handle_tcp_connection(client_sock, addr, payload, admission=None, profile=None):
     """
     handle a single tcp client
-    reads file size as ascii + newline, sends that many bytes back
+    reads the request header (binary, or legacy ascii file size + newline) and sends that many
+    bytes of payload back, starting at the requested offset of the payload stream (byte range
+    requests), followed by their crc32 if the request has REQUEST_FLAG_CHECKSUM
+    a request with a codec gets the payload as a compressed body (compression.CompressedStream),
+    compressed in the compression pool while the previous block is being sent
+    a request with REQUEST_FLAG_KEEPALIVE starts a session: every response is preceded by a
+    response frame header and the connection stays open for further (possibly pipelined) requests
+    until a request without the flag, the client closing, or TCP_KEEPALIVE_TIMEOUT of silence
+    a request the admission controller rejects is answered with an error message and ends the connection
+    the per-connection options of profile are applied first, the buffers come from the listening socket
     """
-    print(f"{ANSI.HEADER}[TCP] New connection from {addr}{ANSI.ENDC}")
+    tcp_log.info("New connection from %s", addr)
+    metrics.TCP_ACTIVE.inc()
+    budget = admission.budget if admission is not None else None
     try:
+        if profile is not None:
+            profile.apply_tcp(client_sock, buffers=False)
         client_sock.settimeout(10)
-        file_size_bytes = b''
-        while b'\n' not in file_size_bytes:
-            chunk = client_sock.recv(1)
-            if not chunk:
-                raise ConnectionError("Client closed before sending file size")
-            file_size_bytes += chunk
-
-        file_size_str = file_size_bytes.strip().decode()
-        try:
-            file_size = int(file_size_str)
-        except ValueError:
-            raise PacketParsingError(f"{ANSI.FAIL}Invalid file size '{file_size_str}' from Client{addr}{ANSI.ENDC}")
+        request = read_tcp_request(client_sock)
+        if request is None:
+            raise ConnectionError("Client closed before sending its request")
+        framed = request['flags'] & REQUEST_FLAG_KEEPALIVE
+        if framed:
+            # small frame headers must not wait behind nagle while requests are pipelined
+            client_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client_sock.settimeout(TCP_KEEPALIVE_TIMEOUT)
 
-        print(f"{ANSI.HEADER}[TCP] {addr} requested {file_size} bytes{ANSI.ENDC}")
+        while request is not None:
+            file_size = request['file_size']
+            offset = request['offset']
+            if offset:
+                tcp_log.info("%s requested %d bytes at offset %d", addr, file_size, offset)
+            else:
+                tcp_log.info("%s requested %d bytes", addr, file_size)
+            metrics.TCP_REQUESTS.inc()
 
-        bytes_sent = 0
-        dummy_data = b'Z' * TCP_CHUNK_SIZE
-        while bytes_sent < file_size:
-            remaining = file_size - bytes_sent
-            to_send = dummy_data[:min(TCP_CHUNK_SIZE, remaining)]
-            client_sock.sendall(to_send)
-            bytes_sent += len(to_send)
+            try:
+                compression.check_codec(request['codec'])
+                if admission is not None:
+                    admission.admit(addr[0], file_size)
+            except RequestRejectedError as e:
+                client_sock.sendall(packetBuilder.build_error_msg(e.error_code, e.retry_after))
+                metrics.TCP_REJECTED.inc()
+                tcp_log.warning("%s %s", addr, e)
+                break
+            try:
+                if framed:
+                    client_sock.sendall(packetBuilder.build_response_header(file_size))
+                if request['codec'] != CODEC_NONE:
+                    stream = compression.CompressedStream(payload, request['codec'], file_size, offset)
+                    try:
+                        bytes_sent = stream.send(client_sock, budget=budget)
+                    finally:
+                        stream.close()
+                else:
+                    bytes_sent = payload.send(client_sock, file_size, offset, budget=budget)
+                if request['flags'] & REQUEST_FLAG_CHECKSUM:
+                    client_sock.sendall(packetBuilder.build_checksum_trailer(payload.checksum(offset, file_size)))
+            finally:
+                if admission is not None:
+                    admission.release(addr[0])
 
-        print(f"{ANSI.HEADER}[TCP] Finished sending {bytes_sent} bytes to {addr}{ANSI.ENDC}")
+            tcp_log.info("Finished sending %d bytes to %s", bytes_sent, addr)
+            request = read_tcp_request(client_sock) if request['flags'] & REQUEST_FLAG_KEEPALIVE else None
 
     except PacketParsingError as e:
-        print(f"{ANSI.FAIL}[TCP] Parsing error from {addr}: {e}{ANSI.ENDC}")
+        tcp_log.error("Parsing error from %s: %s", addr, e)
+        reject_malformed_request(client_sock)
     except Exception as e:
-        print(f"{ANSI.FAIL}[TCP] Error handling {addr}: {e}{ANSI.ENDC}")
+        tcp_log.error("Error handling %s: %s", addr, e)
     finally:
         client_sock.close()
-        print(f"{ANSI.FAIL}[TCP] Connection with {addr} closed{ANSI.ENDC}")
+        metrics.TCP_ACTIVE.dec()
+        tcp_log.info("Connection with %s closed", addr)
 
 
-def tcp_server_loop(stop_event, tcp_port):
+def tcp_server_loop(stop_event, tcp_port, payload=None, reuse_port=False, admission=None, profile=None, ready=None):
     """
     accepts tcp connections on the provided tcp_port and spawns a handler thread for each client
+    every client is served from the same pre-built payload (zero-copy by default)
+    reuse_port lets several worker processes bind the same port (SO_REUSEPORT)
+    admission is an optional AdmissionController shared with the udp server
+    profile is the socketProfiles.SocketProfile of the listening socket and every connection
+    (buffers are set before listen, so accepted connections inherit them)
+    ready is an optional semaphore, released once the socket is listening
     """
+    if payload is None:
+        payload = TcpPayload(TCP_CHUNK_SIZE)
+    profile = profile if profile is not None else DEFAULT_PROFILE
+
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    profile.apply_tcp(s)
     s.bind(('', tcp_port))
-    s.listen(5)
+    s.listen(profile.listen_backlog(TCP_LISTEN_BACKLOG))
     s.settimeout(1.0)
+    if ready is not None:
+        ready.release()
 
-    print(f"{ANSI.HEADER}[TCP] Server listening on port {tcp_port}{ANSI.ENDC}")
+    tcp_log.info("Server listening on port %d (%s, %d byte chunks, %s payload, socket profile %s)", tcp_port,
+                 payload.mode, payload.chunk_size, payload.source, describe(effective_options(s, profile)))
 
     while not stop_event.is_set():
         try:
@@ -179,15 +429,15 @@ def tcp_server_loop(stop_event, tcp_port):
         except socket.timeout:
             continue
         except Exception as e:
-            print(f"{ANSI.FAIL}[TCP] Accept error: {e}{ANSI.ENDC}")
+            tcp_log.error("Accept error: %s", e)
             continue
 
         t = threading.Thread(
             target=handle_tcp_connection,
-            args=(client_sock, addr),
+            args=(client_sock, addr, payload, admission, profile),
             daemon=True
         )
         t.start()
 
     s.close()
-    print(f"{ANSI.HEADER}[TCP] TCP Server loop stopped{ANSI.ENDC}")
+    tcp_log.info("TCP Server loop stopped")
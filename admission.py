@@ -0,0 +1,109 @@
+import collections
+import multiprocessing
+import threading
+from Exceptions import RequestRejectedError
+from constants import *
+from tokenBucket import TokenBucket
+
+BUSY_RETRY_AFTER = 1.0  # seconds a client turned away for lack of capacity is asked to wait
+BUDGET_BURST = 0.1  # seconds worth of the byte budget that may pile up while the server is idle
+SATURATION_DELAY = 0.5  # a byte budget this many seconds in debt counts as saturated
+DEFAULT_MAX_TRANSFERS = 1024
+DEFAULT_MAX_FILE_SIZE = 64 * 2 ** 30
+
+
+class AdmissionController:
+    """
+    admission control shared by the tcp and udp paths of a server
+
+      - max_transfers: transfers in flight at once; in_flight is a shared multiprocessing array
+        with one counter per process (slot), so pre-fork workers sharing it enforce one global
+        limit and the counts of a worker that died can be dropped by zeroing its slot
+      - max_file_size: largest file size a single request may ask for
+      - per_ip_transfers: transfers in flight per client ip
+      - byte_rate: bytes/sec budget, a token bucket every sender of the server draws from
+
+    0 disables a limit. admit() raises RequestRejectedError with the error code and retry hint
+    to send back, every admitted transfer must be paired with a release()
+    """
+
+    def __init__(self, max_transfers=0, max_file_size=0, per_ip_transfers=0, byte_rate=0, in_flight=None, slot=0):
+        self.max_transfers = max_transfers
+        self.max_file_size = max_file_size
+        self.per_ip_transfers = per_ip_transfers
+        self.byte_rate = byte_rate
+        self.in_flight = in_flight if in_flight is not None else multiprocessing.Array('i', 1)
+        self.slot = slot
+        self.per_ip = collections.Counter()
+        self.rejected = 0
+        self.lock = threading.Lock()
+        self.budget = TokenBucket(byte_rate, byte_rate * BUDGET_BURST) if byte_rate else None
+
+    def limits(self):
+        """
+        the configured limits as keyword arguments, to build the same controller elsewhere
+        """
+        return {
+            "max_transfers": self.max_transfers,
+            "max_file_size": self.max_file_size,
+            "per_ip_transfers": self.per_ip_transfers,
+            "byte_rate": self.byte_rate,
+        }
+
+    def admit(self, ip, file_size):
+        with self.lock:
+            if self.max_file_size and file_size > self.max_file_size:
+                self._reject(ERROR_REQUEST_TOO_LARGE)
+            if self.per_ip_transfers and self.per_ip[ip] >= self.per_ip_transfers:
+                self._reject(ERROR_CLIENT_QUOTA, BUSY_RETRY_AFTER)
+            with self.in_flight.get_lock():
+                if self.max_transfers and sum(self.in_flight) >= self.max_transfers:
+                    self._reject(ERROR_SERVER_BUSY, BUSY_RETRY_AFTER)
+                self.in_flight[self.slot] += 1
+            self.per_ip[ip] += 1
+
+    def release(self, ip):
+        with self.lock:
+            with self.in_flight.get_lock():
+                self.in_flight[self.slot] -= 1
+            self.per_ip[ip] -= 1
+            if self.per_ip[ip] <= 0:
+                del self.per_ip[ip]
+
+    def _reject(self, error_code, retry_after=0.0):
+        self.rejected += 1
+        raise RequestRejectedError(error_code, retry_after)
+
+    @property
+    def saturated(self):
+        """
+        true while new requests would be turned away or only served far behind the byte budget
+        """
+        if self.max_transfers and sum(self.in_flight) >= self.max_transfers:
+            return True
+        return self.budget is not None and self.budget.delay() > SATURATION_DELAY
+
+    def register_metrics(self, registry):
+        """
+        expose the current load as callback gauges of a metrics.MetricsRegistry
+        """
+        registry.gauge_function("speedtest_transfers_in_flight", "Admitted transfers in flight, all workers",
+                                lambda: sum(self.in_flight))
+        registry.gauge_function("speedtest_admission_saturated", "1 while offers are paused",
+                                lambda: int(self.saturated))
+        registry.gauge_function("speedtest_budget_delay_seconds", "Seconds the byte budget is in debt",
+                                lambda: self.budget.delay() if self.budget is not None else 0.0)
+
+    def load(self):
+        """
+        snapshot of the current load
+        """
+        in_flight = sum(self.in_flight)
+        return {
+            "in_flight": in_flight,
+            "max_transfers": self.max_transfers,
+            "utilization": in_flight / self.max_transfers if self.max_transfers else None,
+            "clients": len(self.per_ip),
+            "rejected": self.rejected,
+            "budget_delay": self.budget.delay() if self.budget is not None else 0.0,
+        }
@@ -0,0 +1,542 @@
+import argparse
+import contextlib
+import csv
+import functools
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+from Client import tcp_connection_test
+from discovery import discover, OfferCache, SELECTION_POLICIES
+from main import run_threaded_test, start_server, SERVER_ENGINES
+from Server import TCP_CHUNK_SIZE
+from compression import CODEC_IDS
+from constants import CODEC_NONE
+from payloadSource import make_payload
+from connectionPool import TcpConnectionPool
+from loadGenerator import run_sharded_test
+from socketProfiles import PROFILES, DEFAULT_PROFILE, AUTOTUNE_BUFFER_SIZES, autotune
+from impairmentProxy import add_impairment_arguments, impairment_from_args, start_proxy, PROXY_PORT_OFFSET
+import serverLog
+from transferStats import summarize, distribution, stream_span
+from ANSI import ANSI
+
+SIZE_UNITS = {
+    '': 1, 'B': 1,
+    'KB': 10 ** 3, 'MB': 10 ** 6, 'GB': 10 ** 9, 'TB': 10 ** 12,
+    'KIB': 2 ** 10, 'MIB': 2 ** 20, 'GIB': 2 ** 30, 'TIB': 2 ** 40,
+}
+RATE_UNITS = {'': 1, 'K': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9}
+COUNT_UNITS = {'': 1}
+SERVER_START_TIMEOUT = 30  # seconds the --local server gets to listen on every worker's ports
+CSV_FIELDS = [
+    "file_size", "num_tcp", "num_udp", "target_rate", "requested_segment_size", "repeat", "stream", "type",
+    "bytes_received", "duration", "speed", "success_rate", "segment_size",
+    "first_pass_success_rate", "retransmit_requests", "time_to_complete",
+    "requests", "reused_connection", "connect_time", "steady_state_speed",
+    "checksum_ok", "corrupt_segments",
+    "codec", "wire_bytes", "wire_speed", "compression_ratio", "decompress_cpu_seconds", "compress_cpu_seconds",
+    "stripe", "pieces", "steals", "object_size", "time_to_last_byte", "object_speed", "object_complete",
+    "socket_profile", "sndbuf", "rcvbuf", "congestion", "nodelay", "busy_poll", "autotune_best",
+]
+CONNECTION_CSV_FIELDS = [
+    "file_size", "concurrency", "connections", "repeat", "stream",
+    "completed", "failed", "duration", "connections_per_second",
+    "connect_p50", "connect_p99", "first_byte_p50", "first_byte_p99",
+    "socket_profile", "sndbuf", "rcvbuf", "congestion", "nodelay", "busy_poll",
+]
+
+
+def parse_quantity(text, units):
+    """
+    parse '10', '1.5MB', '64KiB', '100M' style values with the given unit table
+    """
+    match = re.fullmatch(r'\s*([0-9]*\.?[0-9]+)\s*([A-Za-z]*)\s*', text)
+    if not match or match.group(2).upper() not in units:
+        raise argparse.ArgumentTypeError(f"invalid value '{text}'")
+    return int(float(match.group(1)) * units[match.group(2).upper()])
+
+
+def parse_sweep(text, units, default_factor):
+    """
+    parse a sweep specification into a sorted list of values
+      - comma separated values: '1MB,10MB,1GB'
+      - geometric ranges 'start..end[:factor]': '1MB..10GB' (x10 by default for sizes), '1..64:2'
+        a range starting at 0 yields 0 followed by 1, factor, factor^2, ...
+    """
+    values = set()
+    for part in text.split(','):
+        if '..' not in part:
+            values.add(parse_quantity(part, units))
+            continue
+
+        bounds, _, factor_text = part.partition(':')
+        start_text, _, end_text = bounds.partition('..')
+        start, end = parse_quantity(start_text, units), parse_quantity(end_text, units)
+        factor = float(factor_text) if factor_text else default_factor
+        if factor <= 1 or end < start:
+            raise argparse.ArgumentTypeError(f"invalid range '{part}'")
+
+        if start == 0:
+            values.add(0)
+            start = 1
+        value = start
+        while value <= end:
+            values.add(int(value))
+            value *= factor
+    return sorted(values)
+
+
+def aggregate(results, driver_duration):
+    """
+    aggregate the per-stream results of one run
+    throughput is measured from the first stream start to the last stream end (streams run
+    concurrently), so the idle timeout that ends a udp receiver is not counted; driver_duration,
+    the time run_cell took, is kept for reference and stands in when no stream is timed
+    """
+    completed = [r for r in results if r]
+    udp = [r for r in completed if r["type"] == "UDP"]
+    total_bytes = sum(r["bytes_received"] for r in completed)
+    wall_duration = stream_span(completed) or driver_duration
+    return {
+        "streams": len(results),
+        "failed_streams": len(results) - len(completed),
+        "bytes_received": total_bytes,
+        "wall_duration": wall_duration,
+        "driver_duration": driver_duration,
+        "throughput": (total_bytes * 8) / wall_duration if wall_duration > 0 else 0.0,
+        "mean_success_rate": (sum(r["success_rate"] for r in udp) / len(udp)) if udp else None,
+    }
+
+
+def run_cell(server, file_size, num_tcp, num_udp, target_rate, processes, fast_recv, reliable=False,
+             tcp_pool=None, tcp_requests=0, verify=False, codec=CODEC_NONE, stripe=False, profile=None,
+             segment_size=0, fragment=False, trace_dir=None):
+    """
+    run one sweep cell once: all streams concurrently, through the same code path as main.run_client
+    """
+    server_ip, udp_port, tcp_port = server
+    start = time.perf_counter()
+    if processes == 1:
+        results = run_threaded_test(
+            server_ip, udp_port, tcp_port, file_size, num_tcp, num_udp, target_rate, fast_recv, reliable,
+            tcp_pool, tcp_requests, verify, codec, stripe, profile, segment_size, fragment, trace_dir
+        )
+    else:
+        results = run_sharded_test(
+            server_ip, udp_port, tcp_port, file_size, num_tcp, num_udp, processes, target_rate, fast_recv, reliable,
+            tcp_requests, verify, codec, profile, segment_size, fragment, trace_dir, progress_to_stderr=True
+        )
+    return results, time.perf_counter() - start
+
+
+def run_sweep(server, sizes, tcp_counts, udp_counts, rates, repeat, processes=1, fast_recv=False, reliable=False,
+              tcp_requests=0, verify=False, codec=CODEC_NONE, stripe=False, profile=None, segment_sizes=(0,),
+              fragment=False, trace_dir=None):
+    """
+    run every (file size x tcp streams x udp streams x udp rate x udp segment size) cell `repeat` times
+    with tcp_requests the tcp streams are keep-alive sessions on connections pooled across cells
+    with stripe the tcp streams of a cell fetch one striped object of the cell's file size
+    profile (socketProfiles.SocketProfile) sets the options of the client sockets
+    segment_sizes are the udp segment sizes asked for (0 = the server's default), fragment lets
+    the server exceed the path mtu with them
+    trace_dir makes the udp streams write packet traces there
+    returns a list of run records with the per-stream results, their aggregate and the
+    interval / percentile statistics of transferStats.summarize
+    """
+    records = []
+    profile = profile if profile is not None else DEFAULT_PROFILE
+    tcp_pool = None
+    if (tcp_requests or stripe) and processes == 1:
+        tcp_pool = TcpConnectionPool((server[0], server[2]), profile=profile)
+    # the udp rate and segment size only matter for cells that have udp streams
+    cells = [
+        (file_size, num_tcp, num_udp, target_rate, segment_size)
+        for file_size, num_tcp, num_udp, target_rate, segment_size
+        in itertools.product(sizes, tcp_counts, udp_counts, rates, segment_sizes)
+        if num_tcp + num_udp > 0 and (num_udp > 0 or (target_rate == rates[0] and segment_size == segment_sizes[0]))
+    ]
+    for number, (file_size, num_tcp, num_udp, target_rate, segment_size) in enumerate(cells, 1):
+        for iteration in range(repeat):
+            print(f"{ANSI.BOLD}[Benchmark] cell {number}/{len(cells)} run {iteration + 1}/{repeat}: "
+                  f"{file_size} bytes, {num_tcp} TCP, {num_udp} UDP, rate {target_rate or 'unpaced'}, "
+                  f"segments {segment_size or 'default'}{ANSI.ENDC}")
+            results, wall_duration = run_cell(
+                server, file_size, num_tcp, num_udp, target_rate, processes, fast_recv, reliable,
+                tcp_pool, tcp_requests, verify, codec, stripe, profile, segment_size, fragment, trace_dir
+            )
+            records.append({
+                "file_size": file_size,
+                "num_tcp": num_tcp,
+                "num_udp": num_udp,
+                "target_rate": target_rate,
+                "requested_segment_size": segment_size,
+                "repeat": iteration,
+                "socket_profile": profile.name,
+                "results": results,
+                "aggregate": aggregate(results, wall_duration),
+                "statistics": summarize(results),
+            })
+    if tcp_pool is not None:
+        tcp_pool.close()
+    return records
+
+
+def run_autotune(serve, sizes, tcp_counts, udp_counts, rates, repeat, buffer_sizes=AUTOTUNE_BUFFER_SIZES,
+                 base=DEFAULT_PROFILE, **options):
+    """
+    socketProfiles.autotune for every sweep cell: run the cell once per buffer size (the
+    buffers of base replaced, see SocketProfile.with_buffers) and rank the candidates by their
+    mean aggregate throughput
+    serve(profile) is a context manager yielding the server to test; for a --local server it
+    restarts the server with the candidate profile, so both sides use it
+    options are passed on to run_sweep
+    returns the records of every candidate, the runs of each cell's best one marked autotune_best
+    """
+    records = []
+    cells = [cell for cell in itertools.product(sizes, tcp_counts, udp_counts, rates)
+             if cell[1] + cell[2] > 0 and (cell[2] > 0 or cell[3] == rates[0])]
+    for file_size, num_tcp, num_udp, target_rate in cells:
+        candidates = {}
+
+        def measure(profile):
+            with serve(profile) as server:
+                runs = run_sweep(server, [file_size], [num_tcp], [num_udp], [target_rate], repeat, profile=profile,
+                                 **options)
+            candidates[profile.name] = runs
+            records.extend(runs)
+            return sum(run["aggregate"]["throughput"] for run in runs) / len(runs) if runs else None
+
+        ranking = autotune(measure, base, buffer_sizes)
+        best, throughput = ranking[0]
+        for run in candidates[best.name]:
+            run["autotune_best"] = True
+        print(f"{ANSI.OKGREEN}[Autotune] {file_size} bytes, {num_tcp} TCP, {num_udp} UDP: "
+              + ", ".join(f"{profile.name} {speed or 0:.0f}" for profile, speed in ranking)
+              + f" bits/sec; best {best!r}{ANSI.ENDC}")
+    return records
+
+
+def report_segment_sweep(records):
+    """
+    print the udp throughput and loss of every requested segment size of a sweep, with the
+    segment sizes the server actually used (it clamps them to the path mtu)
+    """
+    streams = {}
+    for record in records:
+        udp = [result for result in record["results"] if result and result["type"] == "UDP"]
+        streams.setdefault(record["requested_segment_size"], []).extend(udp)
+    for requested, results in sorted(streams.items()):
+        if not results:
+            continue
+        used = sorted({result["segment_size"] for result in results if result["segment_size"]})
+        speed = sum(result["speed"] for result in results) / len(results)
+        loss = 100 - sum(result["success_rate"] for result in results) / len(results)
+        print(f"{ANSI.OKGREEN}[Segments] {requested or 'default'}: {', '.join(map(str, used)) or 'no'} byte segments, "
+              f"{speed:.0f} bits/sec per stream, {loss:.2f}% lost{ANSI.ENDC}")
+
+
+def run_connection_cell(server, file_size, concurrency, connections, profile=None):
+    """
+    run one connection-churn cell: `concurrency` client threads each open `connections`
+    connections back to back
+    """
+    server_ip, _, tcp_port = server
+    results = [None] * concurrency
+    threads = [
+        threading.Thread(
+            target=tcp_connection_test, args=(server_ip, tcp_port, file_size, connections, results, i, profile),
+            daemon=True
+        )
+        for i in range(concurrency)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def connection_aggregate(results, wall_duration):
+    """
+    connections per second over the wall clock of the cell plus the latency distributions of
+    every connection of every client thread
+    """
+    completed = [r for r in results if r]
+    total = sum(r["completed"] for r in completed)
+    return {
+        "streams": len(results),
+        "completed": total,
+        "failed": sum(r["failed"] for r in completed),
+        "wall_duration": wall_duration,
+        "connections_per_second": total / wall_duration if wall_duration > 0 else 0.0,
+        "connect_time": distribution([t for r in completed for t in r["connect_times"]]),
+        "first_byte_time": distribution([t for r in completed for t in r["first_byte_times"]]),
+    }
+
+
+def run_connection_sweep(server, sizes, concurrency_counts, connections, repeat, profile=None):
+    """
+    measure connection setup cost: every (file size x concurrent clients) cell `repeat` times
+    """
+    records = []
+    cells = [(file_size, concurrency) for file_size, concurrency in itertools.product(sizes, concurrency_counts)
+             if concurrency > 0]
+    for number, (file_size, concurrency) in enumerate(cells, 1):
+        for iteration in range(repeat):
+            print(f"{ANSI.BOLD}[Benchmark] cell {number}/{len(cells)} run {iteration + 1}/{repeat}: "
+                  f"{concurrency} x {connections} connections of {file_size} bytes{ANSI.ENDC}")
+            results, wall_duration = run_connection_cell(server, file_size, concurrency, connections, profile)
+            records.append({
+                "file_size": file_size,
+                "concurrency": concurrency,
+                "connections": connections,
+                "repeat": iteration,
+                "results": results,
+                "aggregate": connection_aggregate(results, wall_duration),
+            })
+    return records
+
+
+def write_json(records, out):
+    json.dump(records, out, indent=2)
+    out.write('\n')
+
+
+def write_csv(records, out):
+    """
+    one row per stream plus one 'aggregate' row per run
+    """
+    writer = csv.DictWriter(out, fieldnames=CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for record in records:
+        cell = {key: record[key] for key in ("file_size", "num_tcp", "num_udp", "target_rate",
+                                             "requested_segment_size", "repeat", "socket_profile")}
+        for stream, result in enumerate(record["results"]):
+            writer.writerow({**cell, "stream": stream, **(result or {"type": "FAILED"})})
+        summary = record["aggregate"]
+        writer.writerow({
+            **cell, "stream": "aggregate", "type": "ALL",
+            "bytes_received": summary["bytes_received"],
+            "duration": summary["wall_duration"],
+            "speed": summary["throughput"],
+            "success_rate": summary["mean_success_rate"],
+            "autotune_best": record.get("autotune_best"),
+        })
+
+
+def _latency_columns(connect, first_byte):
+    connect = connect or {}
+    first_byte = first_byte or {}
+    return {
+        "connect_p50": connect.get("p50"), "connect_p99": connect.get("p99"),
+        "first_byte_p50": first_byte.get("p50"), "first_byte_p99": first_byte.get("p99"),
+    }
+
+
+def write_connection_csv(records, out):
+    """
+    connections mode: one row per client thread plus one 'aggregate' row per run
+    """
+    writer = csv.DictWriter(out, fieldnames=CONNECTION_CSV_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for record in records:
+        cell = {key: record[key] for key in ("file_size", "concurrency", "repeat")}
+        for stream, result in enumerate(record["results"]):
+            if result is None:
+                writer.writerow({**cell, "stream": stream})
+                continue
+            writer.writerow({
+                **cell, "stream": stream, **result,
+                **_latency_columns(distribution(result["connect_times"]), distribution(result["first_byte_times"])),
+            })
+        summary = record["aggregate"]
+        writer.writerow({
+            **cell, "stream": "aggregate", "connections": record["connections"] * record["concurrency"],
+            "completed": summary["completed"], "failed": summary["failed"],
+            "duration": summary["wall_duration"],
+            "connections_per_second": summary["connections_per_second"],
+            **_latency_columns(summary["connect_time"], summary["first_byte_time"]),
+        })
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Non-interactive speed test benchmark: sweeps file sizes and stream counts"
+    )
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--server", metavar="IP:UDP_PORT:TCP_PORT",
+                        help="server to test (default: wait for a broadcast offer)")
+    target.add_argument("--local", action="store_true",
+                        help="start an in-process server on --udp-port/--tcp-port and test it over loopback")
+    parser.add_argument("--mode", choices=("throughput", "connections"), default="throughput",
+                        help="bulk transfer sweep, or connection setup cost (connections per second)")
+    parser.add_argument("--udp-port", type=int, default=50001)
+    parser.add_argument("--tcp-port", type=int, default=50002)
+    parser.add_argument("--engine", choices=SERVER_ENGINES, default="thread",
+                        help="engine of the --local server")
+    parser.add_argument("--server-workers", type=int, default=1,
+                        help="pre-forked processes of the --local server (0 = one per core)")
+    parser.add_argument("--payload", default="filler", metavar="SOURCE",
+                        help="data the --local server sends: filler, random[:seed] or a file path")
+    parser.add_argument("--log-level", choices=tuple(serverLog.LOG_LEVELS), default="warning",
+                        help="log level of the --local server (default warning: no per-transfer messages)")
+    parser.add_argument("--sizes", default="1MB..100MB",
+                        type=lambda text: parse_sweep(text, SIZE_UNITS, 10),
+                        help="file sizes, e.g. '1MB,10MB' or '1MB..10GB[:factor]' (default x10)")
+    parser.add_argument("--tcp", default="1", type=lambda text: parse_sweep(text, COUNT_UNITS, 2),
+                        help="tcp stream counts, e.g. '1..64' (default x2); concurrent clients in connections mode")
+    parser.add_argument("--udp", default="0", type=lambda text: parse_sweep(text, COUNT_UNITS, 2),
+                        help="udp stream counts, e.g. '0..16' (default x2)")
+    parser.add_argument("--rates", default="0", type=lambda text: parse_sweep(text, RATE_UNITS, 2),
+                        help="udp target rates in bits/sec, e.g. '100M..1G' (0 = unpaced)")
+    parser.add_argument("--segment-sizes", default="0", type=lambda text: parse_sweep(text, SIZE_UNITS, 2),
+                        help="udp segment sizes the client asks for, e.g. '1400,8KiB,32KiB' or '512..64000' "
+                             "(default x2, 0 = the server's default); clamped by the server to the path mtu")
+    parser.add_argument("--udp-fragment", action="store_true",
+                        help="let the server exceed the path mtu with --segment-sizes, ip fragments the datagrams")
+    parser.add_argument("--trace-dir", metavar="DIR",
+                        help="write a packet trace of every udp stream (and, with --local, of what the server sent) "
+                             "to DIR, for `python packetTrace.py`")
+    parser.add_argument("--connections", type=int, default=1000,
+                        help="connections every client opens in connections mode (use small --sizes, e.g. 1)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per sweep cell")
+    parser.add_argument("--client-processes", type=int, default=1,
+                        help="worker processes the streams are sharded across (0 = one per core)")
+    parser.add_argument("--fast-udp-recv", action="store_true",
+                        help="use the high-rate udp receive path")
+    parser.add_argument("--reliable-udp", action="store_true",
+                        help="recover lost udp segments with nacks and retransmissions")
+    parser.add_argument("--tcp-keepalive", type=int, default=0, metavar="REQUESTS",
+                        help="pipelined requests per pooled keep-alive tcp connection (0 = one connection per transfer)")
+    parser.add_argument("--verify", action="store_true",
+                        help="check received data against the server's crc32 (per udp segment, per tcp transfer)")
+    parser.add_argument("--stripe", action="store_true",
+                        help="the tcp streams of a cell fetch one object as byte ranges (time_to_last_byte per object)")
+    parser.add_argument("--socket-profile", choices=tuple(PROFILES), default="default",
+                        help="socket options of the client (and of the --local server): buffers, congestion control, "
+                             "backlog, busy polling")
+    parser.add_argument("--autotune", action="store_true",
+                        help="run every cell once per --autotune-buffers size on top of --socket-profile and report "
+                             "the fastest; only the client side is tuned unless the server is --local")
+    parser.add_argument("--autotune-buffers", default=",".join(str(size) for size in AUTOTUNE_BUFFER_SIZES),
+                        type=lambda text: parse_sweep(text, SIZE_UNITS, 4),
+                        help="socket buffer sizes --autotune tries, e.g. '0,256KiB..16MiB:4' (0 = kernel default)")
+    parser.add_argument("--server-select", choices=SELECTION_POLICIES, default="first",
+                        help="server picked when several answer the discovery probe (without --local / --server)")
+    parser.add_argument("--probe-host", action="append", default=[], metavar="HOST",
+                        help="also probe this host by unicast (repeatable)")
+    parser.add_argument("--codec", choices=tuple(CODEC_IDS), default="none",
+                        help="ask for compressed payloads (use a compressible --payload file for meaningful ratios)")
+    add_impairment_arguments(parser)
+    parser.add_argument("--format", choices=("json", "csv"), default="json")
+    parser.add_argument("--output", "-o", help="write results here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.stripe and (args.client_processes != 1 or args.tcp_keepalive):
+        parser.error("--stripe cannot be combined with --client-processes or --tcp-keepalive")
+    if args.autotune and args.mode != "throughput":
+        parser.error("--autotune sweeps throughput cells only")
+    if args.segment_sizes[-1] > 0xffff:
+        parser.error("--segment-sizes are at most 65535 bytes")
+    return args
+
+
+@contextlib.contextmanager
+def local_server(args, profile=None):
+    """
+    run the --local server for the duration of the with block, yields its (ip, udp port, tcp port)
+    """
+    stop_event = threading.Event()
+    ready = threading.Event()
+    threads = start_server(
+        stop_event, args.udp_port, args.tcp_port, args.engine,
+        tcp_payload=make_payload(args.payload, TCP_CHUNK_SIZE), workers=args.server_workers, profile=profile,
+        trace_dir=args.trace_dir, ready=ready
+    )
+    try:
+        if not ready.wait(SERVER_START_TIMEOUT):
+            raise RuntimeError(f"the local server did not listen on its ports within {SERVER_START_TIMEOUT} seconds")
+        yield ('127.0.0.1', args.udp_port, args.tcp_port)
+    finally:
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+
+
+@contextlib.contextmanager
+def impaired_server(serve, args, impairment, profile=None):
+    """
+    the server of serve(profile), reached through an impairment proxy on --udp-port / --tcp-port
+    + PROXY_PORT_OFFSET of this host for the duration of the with block
+    """
+    with serve(profile) as server:
+        stop_event = threading.Event()
+        ports = (args.udp_port + PROXY_PORT_OFFSET, args.tcp_port + PROXY_PORT_OFFSET)
+        thread = start_proxy(stop_event, *ports, server, impairment)
+        try:
+            time.sleep(0.2)
+            yield ('127.0.0.1', *ports)
+        finally:
+            stop_event.set()
+            thread.join()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    profile = PROFILES[args.socket_profile]
+    impairment = impairment_from_args(args)
+    if args.trace_dir:
+        os.makedirs(args.trace_dir, exist_ok=True)
+
+    # keep the human readable progress off stdout so it only carries the json / csv
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.local or impairment is not None:
+            serverLog.configure(args.log_level)
+        if args.local:
+            serve = functools.partial(local_server, args)
+        else:
+            if args.server:
+                ip, udp_port, tcp_port = args.server.rsplit(':', 2)
+                server = (ip, int(udp_port), int(tcp_port))
+            else:
+                server = discover(OfferCache(), args.server_select, args.probe_host).address
+            serve = lambda _: contextlib.nullcontext(server)
+        if impairment is not None:
+            serve = functools.partial(impaired_server, serve, args, impairment)
+
+        options = dict(
+            processes=args.client_processes, fast_recv=args.fast_udp_recv, reliable=args.reliable_udp,
+            tcp_requests=args.tcp_keepalive, verify=args.verify, codec=CODEC_IDS[args.codec], stripe=args.stripe,
+            segment_sizes=args.segment_sizes, fragment=args.udp_fragment, trace_dir=args.trace_dir
+        )
+        if args.autotune:
+            records = run_autotune(serve, args.sizes, args.tcp, args.udp, args.rates, args.repeat,
+                                   args.autotune_buffers, profile, **options)
+        else:
+            with serve(profile) as server:
+                if args.mode == "connections":
+                    records = run_connection_sweep(server, args.sizes, args.tcp, args.connections, args.repeat,
+                                                   profile)
+                else:
+                    records = run_sweep(server, args.sizes, args.tcp, args.udp, args.rates, args.repeat,
+                                        profile=profile, **options)
+        if args.mode == "throughput" and len(args.segment_sizes) > 1:
+            report_segment_sweep(records)
+
+    if args.format == "json":
+        write = write_json
+    else:
+        write = write_connection_csv if args.mode == "connections" else write_csv
+    if args.output:
+        with open(args.output, 'w', newline='') as out:
+            write(records, out)
+    else:
+        write(records, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# crc32 of a concatenation from the crcs of its parts, the algorithm of zlib's crc32_combine
+# (which python's zlib module does not expose): appending n zero bytes to a message is a linear
+# map over GF(2) on its crc, so the crc of A + B is that map applied to crc(A), xor crc(B)
+
+CRC32_POLYNOMIAL = 0xedb88320  # reflected crc-32 polynomial, as used by zlib.crc32
+_MAX_LENGTH_BITS = 64
+
+_zero_operators = []  # [k] = 32x32 bit matrix that appends 2**k zero bytes to a crc
+
+
+def _gf2_times(matrix, vector):
+    total = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return total
+
+
+def _gf2_square(matrix):
+    return [_gf2_times(matrix, column) for column in matrix]
+
+
+def _operators():
+    if not _zero_operators:
+        # operator for a single zero bit, squared three times: one zero byte
+        operator = [CRC32_POLYNOMIAL] + [1 << n for n in range(31)]
+        for _ in range(3):
+            operator = _gf2_square(operator)
+        operators = [operator]
+        for _ in range(_MAX_LENGTH_BITS - 1):
+            operators.append(_gf2_square(operators[-1]))
+        _zero_operators[:] = operators
+    return _zero_operators
+
+
+def crc32_combine(crc1, crc2, length2):
+    """
+    crc32 of A + B given crc1 = crc32(A), crc2 = crc32(B) and length2 = len(B)
+    costs one matrix-vector product per set bit of length2, whatever the data size
+    """
+    operators = _operators()
+    bit = 0
+    while length2:
+        if length2 & 1:
+            crc1 = _gf2_times(operators[bit], crc1)
+        length2 >>= 1
+        bit += 1
+    return crc1 ^ crc2
+
+
+def crc32_repeat(crc, length, count):
+    """
+    crc32 of a block of `length` bytes with crc32 `crc` repeated `count` times, by doubling
+    """
+    result = 0  # crc32 of nothing
+    while count:
+        if count & 1:
+            result = crc32_combine(result, crc, length)
+        count >>= 1
+        if count:
+            crc = crc32_combine(crc, crc, length)
+            length *= 2
+    return result
+
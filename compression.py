@@ -0,0 +1,212 @@
+import concurrent.futures
+import os
+import threading
+import time
+import zlib
+import metrics
+import packetBuilder
+from Exceptions import RequestRejectedError
+from constants import *
+
+try:
+    import lzma
+except ImportError:  # python built without liblzma: zlib and uncompressed only
+    lzma = None
+
+COMPRESSION_BLOCK_SIZE = 256 * 1024  # raw bytes per compressed tcp block
+COMPRESSION_WORKERS = os.cpu_count() or 1  # threads of the compression pool; zlib and lzma release the gil
+ZLIB_LEVEL = 1  # throughput tests want cheap compression, not the best ratio
+LZMA_PRESET = 0
+SEGMENT_LZMA_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": LZMA_PRESET, "dict_size": 64 * 1024}] if lzma else None
+
+SUPPORTED_CODECS = (1 << CODEC_NONE) | (1 << CODEC_ZLIB) | ((1 << CODEC_LZMA) if lzma else 0)
+CODEC_IDS = {name: codec for codec, name in CODEC_NAMES.items()}
+DECODE_ERRORS = (zlib.error, lzma.LZMAError) if lzma else (zlib.error,)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def pool():
+    """
+    the compression worker pool of this process, created on first use (so every pre-fork worker
+    gets its own); compression runs here instead of on the threads that own the sockets
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(COMPRESSION_WORKERS, thread_name_prefix="compress")
+        return _pool
+
+
+def codecs_in(mask):
+    """
+    names of the codecs in an offer's bitmask
+    """
+    return [name for codec, name in CODEC_NAMES.items() if mask & (1 << codec)]
+
+
+def check_codec(codec):
+    """
+    raises requestrejectederror if this server cannot serve the codec a request asked for
+    """
+    if codec not in CODEC_NAMES or not SUPPORTED_CODECS & (1 << codec):
+        raise RequestRejectedError(ERROR_UNSUPPORTED_CODEC)
+
+
+def _stream_compressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.compressobj(ZLIB_LEVEL)
+    return lzma.LZMACompressor(lzma.FORMAT_XZ, check=lzma.CHECK_NONE, preset=LZMA_PRESET)
+
+
+def _stream_decompressor(codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    return lzma.LZMADecompressor(lzma.FORMAT_XZ)
+
+
+class SegmentCodec:
+    """
+    compresses every udp segment on its own, so each datagram can be decoded without the others
+    zlib keeps one raw deflate compressor and fully flushes it after each segment (a new
+    compressor per segment would spend most of its time setting up); lzma has no such flush
+    and compresses each segment with a small dictionary
+
+    not thread safe, one instance per transfer
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.deflate = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS) if codec == CODEC_ZLIB else None
+
+    def encode(self, data):
+        if self.codec == CODEC_ZLIB:
+            return self.deflate.compress(data) + self.deflate.flush(zlib.Z_FULL_FLUSH)
+        if self.codec == CODEC_LZMA:
+            return lzma.compress(data, lzma.FORMAT_RAW, filters=SEGMENT_LZMA_FILTERS)
+        return bytes(data)
+
+    def decode(self, data):
+        if self.codec == CODEC_ZLIB:
+            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
+        if self.codec == CODEC_LZMA:
+            return lzma.decompress(data, lzma.FORMAT_RAW, filters=SEGMENT_LZMA_FILTERS)
+        return data
+
+
+class CompressedStream:
+    """
+    compressed body of one tcp response: raw_length bytes of the payload stream from offset on,
+    fed to one streaming compressor COMPRESSION_BLOCK_SIZE bytes at a time
+
+    the blocks are compressed in the pool, one block ahead of the sender: while block n goes
+    out, block n + 1 is being compressed. every block is flushed so the client can decode it
+    as soon as it arrives; the body is framed as described in packetBuilder.build_compressed_block
+    """
+
+    def __init__(self, payload, codec, raw_length, offset=0):
+        self.payload = payload
+        self.codec = codec
+        self.raw_length = raw_length
+        self.offset = offset
+        self.compressor = _stream_compressor(codec)
+        self.position = 0  # raw bytes handed to the compressor so far
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+        self.finished = False
+        self.future = pool().submit(self._compress_next)
+
+    def _compress_next(self):
+        # runs in the pool, never concurrently for the same stream
+        started = time.thread_time()
+        length = min(COMPRESSION_BLOCK_SIZE, self.raw_length - self.position)
+        data = self.compressor.compress(self.payload.read(self.offset + self.position, length))
+        self.position += length
+        if self.position >= self.raw_length:
+            data += self.compressor.flush()
+        elif self.codec == CODEC_ZLIB:
+            data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        elapsed = time.thread_time() - started
+        self.cpu_seconds += elapsed
+        metrics.COMPRESS_SECONDS.inc(elapsed)
+        return data
+
+    def ready(self):
+        """
+        true if next_block will not wait for the pool
+        """
+        return self.future is None or self.future.done()
+
+    def next_block(self):
+        """
+        the next framed block, then the end of the body, then None
+        waits for the pool if the block is still being compressed
+        """
+        while self.future is not None:
+            data = self.future.result()
+            self.future = pool().submit(self._compress_next) if self.position < self.raw_length else None
+            if data:
+                block = packetBuilder.build_compressed_block(data)
+                self.wire_bytes += len(block)
+                return block
+        if self.finished:
+            return None
+        self.finished = True
+        return packetBuilder.build_compressed_stream_end(self.cpu_seconds)
+
+    def send(self, sock, budget=None):
+        """
+        send the whole body to a blocking socket, drawing the wire bytes from budget if given
+        returns the number of bytes sent
+        """
+        sent = 0
+        while True:
+            block = self.next_block()
+            if block is None:
+                return sent
+            if budget is not None:
+                budget.wait()
+            sock.sendall(block)
+            if budget is not None:
+                budget.consume(len(block))
+            metrics.TCP_BYTES_SENT.inc(len(block))
+            sent += len(block)
+
+    def close(self):
+        if self.future is not None:
+            self.future.cancel()
+
+
+class Decompressor:
+    """
+    client side of a codec: decodes udp segments one by one or a tcp body block by block,
+    counting the wire bytes it was given and the cpu time it spent
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.segments = SegmentCodec(codec)
+        self.stream = _stream_decompressor(codec) if codec != CODEC_NONE else None
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def reset(self):
+        """
+        start decoding a new tcp body, keeping the counters
+        """
+        self.stream = _stream_decompressor(self.codec)
+
+    def segment(self, data):
+        started = time.thread_time()
+        raw = self.segments.decode(data)
+        self.cpu_seconds += time.thread_time() - started
+        self.wire_bytes += len(data)
+        return raw
+
+    def feed(self, data):
+        started = time.thread_time()
+        raw = self.stream.decompress(data)
+        self.cpu_seconds += time.thread_time() - started
+        self.wire_bytes += len(data)
+        return raw
@@ -0,0 +1,80 @@
+import select
+import socket
+import threading
+import time
+from socketProfiles import connect_tcp
+
+MAX_IDLE_CONNECTIONS = 64  # idle keep-alive connections kept per server
+CONNECT_TIMEOUT = 10
+
+
+class TcpConnectionPool:
+    """
+    idle keep-alive tcp connections to one server, shared by the client threads
+
+    a connection handed back with release() is reused by the next acquire(), so repeated test
+    rounds skip the handshake and start on a window that already left slow start
+    connections the server closed in the meantime are detected and replaced on acquire
+    new connections get the options of profile (socketProfiles.SocketProfile, kernel defaults if None)
+    """
+
+    def __init__(self, server_addr, max_idle=MAX_IDLE_CONNECTIONS, profile=None):
+        self.server_addr = server_addr
+        self.max_idle = max_idle
+        self.profile = profile
+        self.idle = []
+        self.lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+
+    def acquire(self):
+        """
+        returns (sock, connect_time); connect_time is None when an idle connection was reused
+        """
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                sock = self.idle.pop()
+            if _is_idle_alive(sock):
+                with self.lock:
+                    self.reused += 1
+                return sock, None
+            sock.close()
+
+        start = time.perf_counter()
+        sock = connect_tcp(self.server_addr, self.profile, CONNECT_TIMEOUT)
+        connect_time = time.perf_counter() - start
+        # pipelined request headers are tiny, send them without waiting for nagle
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.created += 1
+        return sock, connect_time
+
+    def release(self, sock):
+        """
+        hand back a connection whose responses were all read completely
+        """
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(sock)
+                return
+        sock.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for sock in idle:
+            sock.close()
+
+
+def _is_idle_alive(sock):
+    """
+    an idle keep-alive connection has nothing to read; readable means the server closed it
+    (or sent something unexpected), either way it cannot be reused
+    """
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
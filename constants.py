@@ -1,4 +1,68 @@
 MAGIC_COOKIE = 0xabcddcba
 OFFER_TYPE = 0x2  # server -> client (udp)
-REQUEST_TYPE = 0x3  # client -> server (udp)
-PAYLOAD_TYPE = 0x4  # server -> client (udp payload segments)
\ No newline at end of file
+REQUEST_TYPE = 0x3  # client -> server (udp, and the fixed-size binary tcp request header)
+PAYLOAD_TYPE = 0x4  # server -> client (udp payload segments)
+NACK_TYPE = 0x5  # client -> server (udp, missing segment ranges of a reliable transfer)
+RESPONSE_TYPE = 0x6  # server -> client (tcp, frame header in front of every keep-alive response)
+ERROR_TYPE = 0x7  # server -> client (udp or tcp, the request was rejected)
+CHECKED_PAYLOAD_TYPE = 0x8  # server -> client (udp payload segments carrying a crc32 of their payload)
+PROBE_TYPE = 0x9  # client -> server (udp discovery probe, broadcast or unicast to the discovery port)
+PROBE_REPLY_TYPE = 0xa  # server -> client (unicast answer to a probe: ports, codecs and current load)
+
+# bits of the flags byte of a probe reply
+PROBE_REPLY_SATURATED = 0x1  # the server turns new requests away at the moment
+
+# optional fields appended after the 13 byte request header (cookie, type, file size), in this order
+# a request carries the fields up to the last one that differs from its default (0), so a plain
+# 13 byte request stays valid and means "defaults for everything"; over tcp every field is always
+# present and the header carries its own length (REQUEST_FLAG_SIZED), so a server reads exactly
+# the header of a client with more or fewer fields than it knows
+REQUEST_EXTENSION_FIELDS = (
+    ('target_rate', '>Q'),  # udp pacing rate in bits/sec, 0 = unpaced
+    ('flags', '>B'),  # REQUEST_FLAG_* bits
+    ('codec', '>B'),  # CODEC_* the payload is compressed with, 0 = uncompressed
+    ('offset', '>Q'),  # byte range requests: position in the payload stream of the first byte to send
+    ('segment_size', '>H'),  # udp payload bytes per datagram, 0 = the server's default (clamped by the server)
+    ('transfer_id', '>Q'),  # udp: id the client picked for the transfer, names the packet traces of both ends
+)
+
+# request flags
+REQUEST_FLAG_RELIABLE = 0x1  # udp: keep the transfer open and retransmit segments the client nacks
+REQUEST_FLAG_KEEPALIVE = 0x2  # tcp: frame the response and keep the connection open for more requests
+# udp: send checked payload segments; tcp: follow the payload with a 4 byte crc32 trailer
+# (after the payload of a framed response, not counted in its length)
+REQUEST_FLAG_CHECKSUM = 0x4
+# udp: the segment size may exceed the path mtu, datagrams above it are fragmented by the sending kernel
+REQUEST_FLAG_FRAGMENT = 0x8
+# tcp: the binary header is versioned, a 1 byte header length follows the flags byte (set by every
+# binary tcp request, a header without it is from a client older than the length and is rejected)
+REQUEST_FLAG_SIZED = 0x10
+TCP_REQUEST_LENGTH_OFFSET = 22  # the length byte of a tcp header: after cookie, type, file size, target rate, flags
+
+# payload compression codecs; an offer advertises the ones a server supports as a bitmask
+# (1 << codec) in an optional trailing byte, an offer without it means CODEC_NONE only
+CODEC_NONE = 0x0
+CODEC_ZLIB = 0x1
+CODEC_LZMA = 0x2
+CODEC_NAMES = {
+    CODEC_NONE: "none",
+    CODEC_ZLIB: "zlib",
+    CODEC_LZMA: "lzma",
+}
+
+# error codes of an error message
+ERROR_SERVER_BUSY = 0x1  # too many transfers in flight
+ERROR_CLIENT_QUOTA = 0x2  # the client ip has too many transfers in flight
+ERROR_REQUEST_TOO_LARGE = 0x3  # file size above the per-request limit
+ERROR_UNSUPPORTED_CODEC = 0x4  # the requested codec is not available on the server
+ERROR_BAD_REQUEST = 0x5  # the request header could not be parsed
+ERROR_REASONS = {
+    ERROR_SERVER_BUSY: "server busy",
+    ERROR_CLIENT_QUOTA: "per-client quota exceeded",
+    ERROR_REQUEST_TOO_LARGE: "requested file size too large",
+    ERROR_UNSUPPORTED_CODEC: "requested codec not supported",
+    ERROR_BAD_REQUEST: "malformed request header",
+}
+
+# a nack carries at most this many (first segment, length) ranges, so it fits in one small datagram
+NACK_MAX_RANGES = 100
\ No newline at end of file
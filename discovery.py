@@ -0,0 +1,263 @@
+import itertools
+import random
+import socket
+import time
+import compression
+import packetBuilder
+import packetParser
+import serverLog
+from Client import listen_for_offer
+from Exceptions import *
+from ANSI import ANSI
+from constants import *
+
+DISCOVERY_PORT = 13118  # servers answer probes here, next to the broadcast port of the offers
+PROBE_TIMEOUT = 0.25  # seconds a client waits for the first probe reply before falling back to offers
+PROBE_WINDOW = 0.02  # seconds other servers get to answer after the first reply, when choosing among them
+PING_COUNT = 3  # probes per server when timing round trips, the fastest counts
+OFFER_CACHE_TTL = 30.0  # seconds a discovered server is used without probing again
+PROBE_POLL_INTERVAL = 0.5
+UDP_PROBE_BUFFER = 1024
+SELECTION_POLICIES = ("first", "least-loaded", "lowest-rtt")
+
+discovery_log = serverLog.get_logger("Discovery")
+
+
+# -----------------------------------------------------------------------------
+# server side
+# -----------------------------------------------------------------------------
+def serve_probes(stop_event, udp_port, tcp_port, admission=None, port=DISCOVERY_PORT):
+    """
+    answer every probe on the discovery port at once, by unicast to its sender, with the ports,
+    the supported codecs and the current load of the server (from the admission controller)
+    unlike offers, probes are answered while the server is saturated; the reply says so
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('', port))
+    sock.settimeout(PROBE_POLL_INTERVAL)
+    discovery_log.info("Answering discovery probes on port %d", port)
+
+    while not stop_event.is_set():
+        try:
+            data, addr = sock.recvfrom(UDP_PROBE_BUFFER)
+        except socket.timeout:
+            continue
+        except OSError as e:
+            discovery_log.error("Probe receive error: %s", e)
+            continue
+        try:
+            probe = packetParser.parse_udp_packet(data)
+        except PacketParsingError as e:
+            discovery_log.debug("Parsing error from %s: %s", addr, e)
+            continue
+        if probe['message_type'] != PROBE_TYPE:
+            continue
+
+        in_flight = max_transfers = flags = 0
+        if admission is not None:
+            in_flight = sum(admission.in_flight)
+            max_transfers = admission.max_transfers
+            flags = PROBE_REPLY_SATURATED if admission.saturated else 0
+        reply = packetBuilder.build_probe_reply_msg(probe['token'], udp_port, tcp_port, compression.SUPPORTED_CODECS,
+                                                    in_flight, max_transfers, flags)
+        try:
+            sock.sendto(reply, addr)
+        except OSError as e:
+            discovery_log.error("Error answering probe from %s: %s", addr, e)
+
+    sock.close()
+    discovery_log.info("Discovery thread stopped")
+
+
+
+# -----------------------------------------------------------------------------
+# client side
+# -----------------------------------------------------------------------------
+class KnownServer:
+    """
+    a server found by a probe (or an offer), as kept in the OfferCache
+    rtt is the fastest probe round trip in seconds (None for servers found by an offer)
+    """
+    __slots__ = ('ip', 'udp_port', 'tcp_port', 'codecs', 'in_flight', 'max_transfers', 'saturated', 'rtt', 'seen')
+
+    def __init__(self, ip, udp_port, tcp_port, codecs=1 << CODEC_NONE, in_flight=0, max_transfers=0,
+                 saturated=False, rtt=None):
+        self.ip = ip
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.codecs = codecs
+        self.in_flight = in_flight
+        self.max_transfers = max_transfers
+        self.saturated = saturated
+        self.rtt = rtt
+        self.seen = time.monotonic()
+
+    @property
+    def key(self):
+        return self.ip, self.tcp_port
+
+    @property
+    def address(self):
+        """
+        (ip, udp port, tcp port), the server tuple of benchmark.py and the regression suite
+        """
+        return self.ip, self.udp_port, self.tcp_port
+
+    @property
+    def load(self):
+        """
+        share of the server's transfer slots in use, or the raw in-flight count without a limit
+        """
+        return self.in_flight / self.max_transfers if self.max_transfers else float(self.in_flight)
+
+    def __repr__(self):
+        rtt = f", rtt {self.rtt * 1000:.3f} ms" if self.rtt is not None else ""
+        return (f"{self.ip} (UDP port={self.udp_port}, TCP port={self.tcp_port}, "
+                f"{self.in_flight} transfers in flight{', saturated' if self.saturated else ''}{rtt})")
+
+
+class OfferCache:
+    """
+    servers discovered in earlier rounds, each trusted for ttl seconds after it last answered
+    """
+
+    def __init__(self, ttl=OFFER_CACHE_TTL):
+        self.ttl = ttl
+        self.servers = {}  # (ip, tcp port) -> KnownServer, in discovery order
+
+    def update(self, server):
+        old = self.servers.get(server.key)
+        if old is not None and server.rtt is None:
+            server.rtt = old.rtt
+        self.servers[server.key] = server
+
+    def forget(self, server):
+        self.servers.pop(server.key, None)
+
+    def fresh(self):
+        """
+        the servers seen less than ttl seconds ago; expired ones are dropped
+        """
+        now = time.monotonic()
+        for key in [key for key, server in self.servers.items() if now - server.seen > self.ttl]:
+            del self.servers[key]
+        return list(self.servers.values())
+
+
+def probe_servers(targets=('<broadcast>',), timeout=PROBE_TIMEOUT, window=0.0, pings=1, port=DISCOVERY_PORT):
+    """
+    send a probe to every target host (the broadcast address finds the servers of the local
+    network) and collect the replies: until window seconds after the first one, or timeout
+    with pings > 1, every server that answered gets pings - 1 more unicast probes, so its rtt
+    is the fastest of several round trips rather than one that may include a cold arp lookup
+    waiting ends early once every unicast probe has been answered
+    returns the KnownServers that answered, in the order they did
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    tokens = itertools.count(random.getrandbits(48))
+    sent = {}  # token -> send time
+    pending = set()  # tokens of the current round not answered yet
+    servers = {}
+
+    def send_probe(host):
+        token = next(tokens)
+        try:
+            sock.sendto(packetBuilder.build_probe_msg(token), (host, port))
+        except OSError:
+            return
+        sent[token] = time.perf_counter()
+        pending.add(token)
+
+    def collect(deadline, window=None, until_answered=True):
+        while not (until_answered and not pending):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                return
+            sock.settimeout(remaining)
+            try:
+                data, addr = sock.recvfrom(UDP_PROBE_BUFFER)
+            except socket.timeout:
+                return
+            received = time.perf_counter()
+            try:
+                reply = packetParser.parse_udp_packet(data)
+            except PacketParsingError:
+                continue
+            if reply['message_type'] != PROBE_REPLY_TYPE or reply['token'] not in sent:
+                continue
+            pending.discard(reply['token'])
+            rtt = received - sent[reply['token']]
+            server = KnownServer(addr[0], reply['server_udp_port'], reply['server_tcp_port'], reply['codecs'],
+                                 reply['in_flight'], reply['max_transfers'], reply['saturated'], rtt)
+            known = servers.get(server.key)
+            if known is not None:
+                server.rtt = min(rtt, known.rtt)
+            elif window is not None and not servers:
+                deadline = min(deadline, received + window)
+            servers[server.key] = server
+
+    try:
+        for host in targets:
+            send_probe(host)
+        # a broadcast probe has no known number of answers
+        collect(time.perf_counter() + timeout, window, '<broadcast>' not in targets)
+        if pings > 1 and servers:
+            pending.clear()
+            for _ in range(pings - 1):
+                for server in list(servers.values()):
+                    send_probe(server.ip)
+            collect(time.perf_counter() + timeout)
+    finally:
+        sock.close()
+    return list(servers.values())
+
+
+def select_server(servers, policy="first"):
+    """
+    pick one of the servers: the first that answered, the least loaded or the nearest (lowest rtt);
+    saturated servers are only picked when every server is
+    """
+    if policy not in SELECTION_POLICIES:
+        raise ValueError(f"Unknown selection policy '{policy}', expected one of {SELECTION_POLICIES}")
+    if policy == "first":
+        return min(servers, key=lambda server: server.saturated)
+    unknown_rtt = float('inf')
+    if policy == "least-loaded":
+        return min(servers, key=lambda server: (server.saturated, server.load,
+                                                server.rtt if server.rtt is not None else unknown_rtt))
+    return min(servers, key=lambda server: (server.saturated, server.rtt if server.rtt is not None else unknown_rtt))
+
+
+def discover(cache, policy="first", hosts=(), timeout=PROBE_TIMEOUT):
+    """
+    find a server to test against, in milliseconds instead of waiting for the next offer:
+
+      - "first" uses a fresh cached server as is, without any traffic
+      - "least-loaded" and "lowest-rtt" re-probe the cached servers by unicast for their current
+        load and round trip time
+      - with nothing cached, probes go to the broadcast address and the given hosts; when no
+        server answers within timeout (servers that predate probes), the client waits for a
+        broadcast offer like before
+
+    the servers found are added to the cache; returns the selected KnownServer
+    """
+    servers = cache.fresh()
+    if servers and policy != "first":
+        # one probe per cached server, so each of several servers sharing an ip can answer one
+        servers = probe_servers([server.ip for server in servers], timeout, PROBE_WINDOW,
+                                PING_COUNT if policy == "lowest-rtt" else 1)
+    if not servers:
+        servers = probe_servers(('<broadcast>',) + tuple(hosts), timeout, PROBE_WINDOW if policy != "first" else 0.0,
+                                PING_COUNT if policy == "lowest-rtt" else 1)
+    if not servers:
+        print(f"{ANSI.WARNING}[Client] No reply to discovery probes, waiting for a broadcast offer{ANSI.ENDC}")
+        ip, udp_port, tcp_port, codecs = listen_for_offer()
+        servers = [KnownServer(ip, udp_port, tcp_port, codecs)]
+
+    for server in servers:
+        cache.update(server)
+    server = select_server(servers, policy)
+    print(f"{ANSI.OKGREEN}[Client] Using server {server}{ANSI.ENDC}")
+    return server
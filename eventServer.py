@@ -0,0 +1,622 @@
+import collections
+import selectors
+import socket
+import time
+import compression
+import metrics
+import packetBuilder
+import packetParser
+import serverLog
+from Exceptions import *
+from constants import *
+from payloadSource import TcpPayload
+from udpSender import UdpBatchSender, allow_fragments
+from packetTrace import TraceRecorder, trace_path, TRACE_SEND
+from socketProfiles import DEFAULT_PROFILE, effective_options, describe
+from Server import TCP_CHUNK_SIZE, NACK_IDLE_TIMEOUT, TCP_KEEPALIVE_TIMEOUT, udp_segment_size, reject_malformed_request
+
+MAX_SESSIONS = 1024  # upper bound on concurrent tcp + udp transfers
+UDP_BURST = 32  # datagrams drained from the udp socket per readiness event
+TCP_HEADER_TIMEOUT = 10  # seconds a tcp client has to send its request header
+TCP_SEND_TIMEOUT = 10  # seconds a response may go without send progress (the thread engine's socket timeout)
+SELECT_TIMEOUT = 0.5
+TCP_PIPELINE_BURST = 16  # pipelined keep-alive requests served per readiness event before yielding
+COMPRESS_POLL_INTERVAL = 0.001  # seconds between checks on transfers waiting for the compression pool
+
+event_log = serverLog.get_logger("EVENT")
+udp_log = serverLog.get_logger("UDP")
+tcp_log = serverLog.get_logger("TCP")
+
+
+class _TcpSession:
+    """
+    state of a single tcp client served by the event loop
+    a keep-alive session goes back to reading a request header after every response
+    """
+    __slots__ = ('sock', 'addr', 'header', 'header_len', 'file_size', 'offset', 'bytes_sent', 'deadline',
+                 'framed', 'keepalive', 'frame', 'trailer', 'admitted', 'stream', 'block')
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.header = bytearray(packetParser.TCP_REQUEST_MAX_SIZE)
+        self.header_len = 0
+        self.file_size = None  # None while still reading the request
+        self.offset = 0  # payload stream position of the first byte of the current response
+        self.bytes_sent = 0
+        self.deadline = time.monotonic() + TCP_HEADER_TIMEOUT  # for the request header, then for send progress
+        self.framed = False  # responses carry a frame header (session opened with keep-alive)
+        self.keepalive = False  # the current request asked to keep the connection open
+        self.frame = b''  # unsent part of the current response frame header
+        self.trailer = b''  # unsent part of the checksum trailer of the current response
+        self.admitted = False  # the current request holds an admission controller slot
+        self.stream = None  # compression.CompressedStream of a compressed response
+        self.block = None  # unsent part of the current compressed block
+
+
+class EventServer:
+    """
+    serves every tcp connection and udp request from one selector loop
+    at most max_sessions transfers run at once, the rest wait in the listen backlog (tcp)
+    or in a bounded pending queue (udp)
+
+    a reliable udp transfer keeps its slot after the first pass, parked in udp_waiting until the
+    client nacks more segments, confirms completion or stays silent for NACK_IDLE_TIMEOUT
+
+    with an admission controller, requests over its limits are answered with an error message,
+    and tcp sessions that outrun its byte budget are taken out of the selector until it refills
+
+    udp segments are cut from tcp_payload as well when it holds real (non-fill) data
+
+    profile (socketProfiles.SocketProfile) sets the options of the udp socket, the listening
+    socket (buffers, backlog) and every accepted connection
+
+    compression runs in the compression pool, never on this loop: a compressed tcp response
+    whose next block is not ready yet is parked in tcp_compressing (out of the selector), and
+    udp transfers wait the same way; both are polled every COMPRESS_POLL_INTERVAL
+    """
+
+    def __init__(self, udp_port, tcp_port, max_sessions=MAX_SESSIONS, tcp_payload=None, reuse_port=False,
+                 admission=None, profile=None, trace_dir=None):
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+        self.max_sessions = max_sessions
+        self.selector = selectors.DefaultSelector()
+        self.tcp_sessions = {}
+        self.udp_transfers = collections.deque()
+        self.udp_pending = collections.deque()
+        self.udp_reliable = {}  # addr -> sender of every reliable transfer, for routing nacks
+        self.udp_waiting = {}  # addr -> deadline of reliable transfers idle until the next nack
+        self.accepting = False
+        self.admission = admission
+        self.budget = admission.budget if admission is not None else None
+        self.tcp_throttled = set()  # sessions waiting for the byte budget, not registered meanwhile
+        self.tcp_compressing = set()  # sessions waiting for their next compressed block, not registered either
+        self.tcp_payload = tcp_payload if tcp_payload is not None else TcpPayload(TCP_CHUNK_SIZE)
+        self.profile = profile if profile is not None else DEFAULT_PROFILE
+        self.trace_dir = trace_dir  # every udp transfer writes a send trace here if set
+
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.profile.apply_udp(self.udp_sock)
+        allow_fragments(self.udp_sock)
+        self.udp_sock.bind(('', udp_port))
+        self.udp_sock.setblocking(False)
+
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.profile.apply_tcp(self.tcp_sock)
+        self.tcp_sock.bind(('', tcp_port))
+        self.tcp_sock.listen(self.profile.listen_backlog(max_sessions))
+        self.tcp_sock.setblocking(False)
+
+        self.selector.register(self.udp_sock, selectors.EVENT_READ, None)
+        self._set_accepting(True)
+
+    @property
+    def active_sessions(self):
+        return len(self.tcp_sessions) + len(self.udp_transfers) + len(self.udp_waiting)
+
+    # -------------------------------------------------------------------------
+    # main loop
+    # -------------------------------------------------------------------------
+    def serve(self, stop_event):
+        event_log.info("Server listening on UDP port %d and TCP port %d (max %d sessions)",
+                       self.udp_port, self.tcp_port, self.max_sessions)
+        event_log.info("Socket profile %s (udp), %s (tcp)", describe(effective_options(self.udp_sock, self.profile)),
+                       describe(effective_options(self.tcp_sock, self.profile)))
+        try:
+            while not stop_event.is_set():
+                # only ask for udp writability while some transfer is due to send, paced
+                # transfers that are waiting for tokens bound the select timeout instead
+                pacing_delay = self._udp_pacing_delay()
+                udp_events = selectors.EVENT_READ
+                timeout = SELECT_TIMEOUT
+                if pacing_delay == 0:
+                    udp_events |= selectors.EVENT_WRITE
+                elif pacing_delay is not None:
+                    timeout = min(timeout, pacing_delay)
+                if self.tcp_throttled:
+                    timeout = min(timeout, self.budget.delay())
+                if self.tcp_compressing:
+                    timeout = min(timeout, COMPRESS_POLL_INTERVAL)
+                self.selector.modify(self.udp_sock, udp_events, None)
+
+                for key, mask in self.selector.select(timeout):
+                    if key.fileobj is self.udp_sock:
+                        if mask & selectors.EVENT_READ:
+                            self._udp_readable()
+                        if mask & selectors.EVENT_WRITE:
+                            self._udp_writable()
+                    elif key.fileobj is self.tcp_sock:
+                        self._tcp_accept()
+                    else:
+                        self._tcp_session_ready(key.data, mask)
+
+                if pacing_delay:
+                    self._udp_writable()
+                self._resume_throttled()
+                self._resume_compressed()
+                self._expire_tcp_sessions()
+                self._expire_udp_sessions()
+                self._admit()
+        finally:
+            self.close()
+        event_log.info("Event server loop stopped")
+
+    def close(self):
+        for session in list(self.tcp_sessions.values()):
+            self._close_tcp_session(session)
+        # hand back the admission slots, the in-flight counter may be shared with other workers
+        for sender in list(self.udp_transfers):
+            self._end_udp_transfer(sender)
+        for addr in list(self.udp_waiting):
+            self._end_udp_transfer(self.udp_reliable[addr])
+        self.selector.close()
+        self.udp_sock.close()
+        self.tcp_sock.close()
+
+    def _set_accepting(self, accepting):
+        if accepting and not self.accepting:
+            self.selector.register(self.tcp_sock, selectors.EVENT_READ, None)
+        elif not accepting and self.accepting:
+            self.selector.unregister(self.tcp_sock)
+        self.accepting = accepting
+
+    def _admit(self):
+        """
+        start pending udp requests and re-open the tcp listener while there is free capacity
+        """
+        while self.udp_pending and self.active_sessions < self.max_sessions:
+            self._start_udp_transfer(*self.udp_pending.popleft())
+        self._set_accepting(self.active_sessions < self.max_sessions)
+
+    # -------------------------------------------------------------------------
+    # udp
+    # -------------------------------------------------------------------------
+    def _udp_readable(self):
+        # drain a bounded number of datagrams so a flood cannot starve the senders
+        for _ in range(UDP_BURST):
+            try:
+                data, addr = self.udp_sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as e:
+                event_log.error("UDP recvfrom error: %s", e)
+                return
+
+            try:
+                result = packetParser.parse_udp_packet(data)
+            except (PacketTooShortError, CookieMismatchError, UnknownMessageTypeError) as e:
+                udp_log.error("Parsing error from %s: %s", addr, e)
+                continue
+            except Exception as e:
+                udp_log.error("Unexpected error handling packet from %s: %s", addr, e)
+                continue
+
+            if result['message_type'] == NACK_TYPE:
+                self._udp_nack(addr, result['ranges'])
+                continue
+            if result['message_type'] != REQUEST_TYPE:
+                udp_log.debug("Received unexpected message type %d from %s, ignoring", result['message_type'], addr)
+                continue
+
+            if self.active_sessions < self.max_sessions:
+                self._start_udp_transfer(addr, result)
+            elif len(self.udp_pending) < self.max_sessions:
+                self.udp_pending.append((addr, result))
+            else:
+                udp_log.warning("Too many pending requests, dropping request from %s", addr)
+
+    def _start_udp_transfer(self, addr, request):
+        file_size = request['file_size']
+        target_rate = request['target_rate']
+        if target_rate:
+            udp_log.info("%s Requested %d bytes at %d bits/sec", addr, file_size, target_rate)
+        else:
+            udp_log.info("%s Requested %d bytes", addr, file_size)
+        metrics.UDP_REQUESTS.inc()
+        try:
+            compression.check_codec(request['codec'])
+            if self.admission is not None:
+                self.admission.admit(addr[0], file_size)
+        except RequestRejectedError as e:
+            try:
+                self.udp_sock.sendto(packetBuilder.build_error_msg(e.error_code, e.retry_after), addr)
+            except OSError:
+                pass
+            metrics.UDP_REJECTED.inc()
+            udp_log.warning("%s %s", addr, e)
+            return
+        metrics.UDP_ACTIVE.inc()
+        segment_size, fragmented = udp_segment_size(request, addr)
+        trace = None
+        try:
+            if self.trace_dir:
+                trace = TraceRecorder(trace_path(self.trace_dir, TRACE_SEND, request['transfer_id'], addr),
+                                      TRACE_SEND, request['transfer_id'])
+            sender = UdpBatchSender(self.udp_sock, addr, file_size, segment_size,
+                                    use_gso=False if fragmented else None, target_rate=target_rate,
+                                    budget=self.budget, payload=self.tcp_payload,
+                                    checksum=bool(request['flags'] & REQUEST_FLAG_CHECKSUM), codec=request['codec'],
+                                    offset=request['offset'], trace=trace)
+        except Exception as e:
+            # the transfer never started, give back what was taken for it
+            if trace is not None:
+                trace.close()
+            metrics.UDP_ACTIVE.dec()
+            if self.admission is not None:
+                self.admission.release(addr[0])
+            udp_log.error("Error starting transfer to %s: %s", addr, e)
+            return
+        if request['flags'] & REQUEST_FLAG_RELIABLE:
+            self.udp_reliable[addr] = sender
+        self.udp_transfers.append(sender)
+
+    def _end_udp_transfer(self, sender):
+        """
+        forget a transfer that is no longer in udp_transfers and give back its admission slot
+        """
+        if sender.trace is not None:
+            sender.trace.close()
+        if self.udp_reliable.get(sender.addr) is sender:
+            del self.udp_reliable[sender.addr]
+            self.udp_waiting.pop(sender.addr, None)
+        metrics.UDP_ACTIVE.dec()
+        if self.admission is not None:
+            self.admission.release(sender.addr[0])
+
+    def _udp_nack(self, addr, ranges):
+        """
+        queue the retransmissions a client asked for, or end its transfer on an empty nack
+        """
+        sender = self.udp_reliable.get(addr)
+        if sender is None:
+            return
+        if not ranges:
+            self._finish_reliable(addr, "confirmed")
+            return
+        sender.retransmit(ranges)
+        if self.udp_waiting.pop(addr, None) is not None:
+            self.udp_transfers.append(sender)
+
+    def _finish_reliable(self, addr, outcome):
+        sender = self.udp_reliable[addr]
+        if addr not in self.udp_waiting:
+            try:
+                self.udp_transfers.remove(sender)
+            except ValueError:
+                pass
+        self._end_udp_transfer(sender)
+        udp_log.info("Reliable transfer to %s %s: %d bytes in %d segments, %d retransmitted",
+                     addr, outcome, sender.bytes_sent, sender.total_segments, sender.retransmitted)
+
+    def _expire_udp_sessions(self):
+        now = time.monotonic()
+        for addr, deadline in list(self.udp_waiting.items()):
+            if now > deadline:
+                self._finish_reliable(addr, "timed out waiting for nacks")
+
+    def _udp_pacing_delay(self):
+        """
+        seconds until the next udp transfer is due, None when there are no transfers
+        transfers waiting for the compression pool are due again after COMPRESS_POLL_INTERVAL
+        """
+        if not self.udp_transfers:
+            return None
+        return min(transfer.pacing_delay() if transfer.ready() else COMPRESS_POLL_INTERVAL
+                   for transfer in self.udp_transfers)
+
+    def _udp_writable(self):
+        """
+        round-robin over the active transfers, sending one burst each
+        until the socket buffer fills up; paced transfers that are not due yet and transfers
+        still waiting for the compression pool are skipped
+        """
+        for _ in range(len(self.udp_transfers)):
+            transfer = self.udp_transfers.popleft()
+            if transfer.pacing_delay() > 0 or not transfer.ready():
+                self.udp_transfers.append(transfer)
+                continue
+            blocked = False
+            try:
+                transfer.send_burst()
+            except (BlockingIOError, InterruptedError):
+                blocked = True
+            except Exception as e:
+                udp_log.error("Error sending to %s: %s", transfer.addr, e)
+                self._end_udp_transfer(transfer)
+                continue
+
+            if transfer.done and self.udp_reliable.get(transfer.addr) is transfer:
+                self.udp_waiting[transfer.addr] = time.monotonic() + NACK_IDLE_TIMEOUT
+            elif transfer.done:
+                udp_log.info("Finished sending %d bytes to %s in %d segments of %d bytes",
+                             transfer.bytes_sent, transfer.addr, transfer.next_segment, transfer.segment_size)
+                self._end_udp_transfer(transfer)
+            else:
+                self.udp_transfers.append(transfer)
+
+            if blocked:
+                return
+
+    # -------------------------------------------------------------------------
+    # tcp
+    # -------------------------------------------------------------------------
+    def _tcp_accept(self):
+        while self.active_sessions < self.max_sessions:
+            try:
+                client_sock, addr = self.tcp_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except Exception as e:
+                tcp_log.error("Accept error: %s", e)
+                return
+
+            tcp_log.info("New connection from %s", addr)
+            metrics.TCP_ACTIVE.inc()
+            self.profile.apply_tcp(client_sock, buffers=False)
+            client_sock.setblocking(False)
+            session = _TcpSession(client_sock, addr)
+            self.tcp_sessions[client_sock.fileno()] = session
+            self.selector.register(client_sock, selectors.EVENT_READ, session)
+
+    def _tcp_session_ready(self, session, mask):
+        if mask & selectors.EVENT_WRITE:
+            # writable again: the client has been reading
+            session.deadline = time.monotonic() + TCP_SEND_TIMEOUT
+        try:
+            for _ in range(TCP_PIPELINE_BURST):
+                if session.file_size is None and not self._tcp_read_request(session):
+                    return
+                if not self._tcp_send(session):
+                    return
+                self._tcp_release(session)
+                if not session.keepalive:
+                    self._close_tcp_session(session)
+                    return
+                self._tcp_await_request(session)
+        except PacketParsingError as e:
+            tcp_log.error("Parsing error from %s: %s", session.addr, e)
+            reject_malformed_request(session.sock)
+            self._close_tcp_session(session)
+        except Exception as e:
+            tcp_log.error("Error handling %s: %s", session.addr, e)
+            self._close_tcp_session(session)
+
+    def _tcp_read_request(self, session):
+        """
+        returns true once a complete request header has been read
+        """
+        try:
+            end = session.header_len + packetParser.tcp_request_remaining(session.header[:session.header_len])
+            nbytes = session.sock.recv_into(memoryview(session.header)[session.header_len:end])
+        except (BlockingIOError, InterruptedError):
+            return False
+        if not nbytes:
+            if session.framed and not session.header_len:
+                # the client ended its keep-alive session between requests
+                self._close_tcp_session(session)
+                return False
+            raise ConnectionError("Client closed before sending its request")
+        session.header_len += nbytes
+        request = packetParser.parse_tcp_request(session.header[:session.header_len])
+        if request is None:
+            return False
+
+        session.file_size = request['file_size']
+        session.offset = request['offset']
+        session.deadline = time.monotonic() + TCP_SEND_TIMEOUT
+        session.keepalive = bool(request['flags'] & REQUEST_FLAG_KEEPALIVE)
+        if session.keepalive and not session.framed:
+            session.framed = True
+            session.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if session.framed:
+            session.frame = packetBuilder.build_response_header(session.file_size)
+
+        if session.offset:
+            tcp_log.info("%s requested %d bytes at offset %d", session.addr, session.file_size, session.offset)
+        else:
+            tcp_log.info("%s requested %d bytes", session.addr, session.file_size)
+        metrics.TCP_REQUESTS.inc()
+        try:
+            compression.check_codec(request['codec'])
+            if self.admission is not None:
+                self.admission.admit(session.addr[0], session.file_size)
+                session.admitted = True
+        except RequestRejectedError as e:
+            try:
+                session.sock.send(packetBuilder.build_error_msg(e.error_code, e.retry_after))
+            except OSError:
+                pass
+            metrics.TCP_REJECTED.inc()
+            tcp_log.warning("%s %s", session.addr, e)
+            self._close_tcp_session(session)
+            return False
+        if request['codec'] != CODEC_NONE:
+            session.stream = compression.CompressedStream(self.tcp_payload, request['codec'], session.file_size,
+                                                          session.offset)
+        if request['flags'] & REQUEST_FLAG_CHECKSUM:
+            session.trailer = packetBuilder.build_checksum_trailer(
+                self.tcp_payload.checksum(session.offset, session.file_size))
+        self.selector.modify(session.sock, selectors.EVENT_WRITE, session)
+        return True
+
+    def _tcp_release(self, session):
+        if session.admitted:
+            session.admitted = False
+            self.admission.release(session.addr[0])
+
+    def _resume_throttled(self):
+        """
+        put the sessions that were waiting for the byte budget back into the selector
+        """
+        if self.tcp_throttled and self.budget.delay() == 0:
+            deadline = time.monotonic() + TCP_SEND_TIMEOUT
+            for session in self.tcp_throttled:
+                session.deadline = deadline
+                self.selector.register(session.sock, selectors.EVENT_WRITE, session)
+            self.tcp_throttled.clear()
+
+    def _resume_compressed(self):
+        """
+        put the sessions whose next compressed block is ready back into the selector
+        """
+        for session in [session for session in self.tcp_compressing if session.stream.ready()]:
+            self.tcp_compressing.discard(session)
+            session.deadline = time.monotonic() + TCP_SEND_TIMEOUT
+            self.selector.register(session.sock, selectors.EVENT_WRITE, session)
+
+    def _tcp_await_request(self, session):
+        """
+        keep-alive: reset the session for the next request on the same connection
+        """
+        session.header_len = 0
+        session.file_size = None
+        session.bytes_sent = 0
+        session.deadline = time.monotonic() + TCP_KEEPALIVE_TIMEOUT
+        self.selector.modify(session.sock, selectors.EVENT_READ, session)
+
+    def _tcp_send(self, session):
+        """
+        returns true once the whole response has been sent
+        """
+        while session.frame:
+            try:
+                sent = session.sock.send(session.frame)
+            except (BlockingIOError, InterruptedError):
+                return False
+            session.frame = session.frame[sent:]
+
+        if session.stream is not None and not self._tcp_send_compressed(session):
+            return False
+
+        while session.bytes_sent < session.file_size:
+            if self.budget is not None and self.budget.delay() > 0:
+                # out of budget: stop polling this socket until _resume_throttled
+                self.selector.unregister(session.sock)
+                self.tcp_throttled.add(session)
+                return False
+            remaining = session.file_size - session.bytes_sent
+            try:
+                sent = self.tcp_payload.send_some(session.sock, session.offset + session.bytes_sent, remaining)
+            except (BlockingIOError, InterruptedError):
+                return False
+            if sent == 0:
+                raise ConnectionError("Connection closed while sending payload")
+            if self.budget is not None:
+                self.budget.consume(sent)
+            session.bytes_sent += sent
+
+        while session.trailer:
+            try:
+                sent = session.sock.send(session.trailer)
+            except (BlockingIOError, InterruptedError):
+                return False
+            session.trailer = session.trailer[sent:]
+
+        tcp_log.info("Finished sending %d bytes to %s", session.bytes_sent, session.addr)
+        return True
+
+    def _tcp_send_compressed(self, session):
+        """
+        send the blocks of a compressed response as the pool produces them
+        returns true once the end of the body has been sent
+        """
+        stream = session.stream
+        while True:
+            if not session.block:
+                if not stream.ready():
+                    self.selector.unregister(session.sock)
+                    self.tcp_compressing.add(session)
+                    return False
+                block = stream.next_block()
+                if block is None:
+                    break
+                session.block = memoryview(block)
+            if self.budget is not None and self.budget.delay() > 0:
+                self.selector.unregister(session.sock)
+                self.tcp_throttled.add(session)
+                return False
+            try:
+                sent = session.sock.send(session.block)
+            except (BlockingIOError, InterruptedError):
+                return False
+            if self.budget is not None:
+                self.budget.consume(sent)
+            metrics.TCP_BYTES_SENT.inc(sent)
+            session.block = session.block[sent:]
+        stream.close()
+        session.stream = None
+        # the body carried the whole payload, only the trailer is left
+        session.bytes_sent = session.file_size
+        return True
+
+    def _expire_tcp_sessions(self):
+        """
+        close sessions whose client sent no request, or stopped reading its response, in time
+        (sessions waiting for the byte budget or the compression pool are not the client's fault)
+        """
+        now = time.monotonic()
+        for session in list(self.tcp_sessions.values()):
+            if now <= session.deadline or session in self.tcp_throttled or session in self.tcp_compressing:
+                continue
+            if session.file_size is None:
+                tcp_log.error("Error handling %s: timed out waiting for a request", session.addr)
+            else:
+                tcp_log.error("Error handling %s: timed out sending, %d of %d bytes sent", session.addr,
+                              session.bytes_sent, session.file_size)
+            self._close_tcp_session(session)
+
+    def _close_tcp_session(self, session):
+        self._tcp_release(session)
+        self.tcp_throttled.discard(session)
+        self.tcp_compressing.discard(session)
+        if session.stream is not None:
+            session.stream.close()
+            session.stream = None
+        self.tcp_sessions.pop(session.sock.fileno(), None)
+        try:
+            self.selector.unregister(session.sock)
+        except (KeyError, ValueError):
+            pass
+        session.sock.close()
+        metrics.TCP_ACTIVE.dec()
+        tcp_log.info("Connection with %s closed", session.addr)
+
+
+def event_server_loop(stop_event, udp_port, tcp_port, max_sessions=MAX_SESSIONS, tcp_payload=None, reuse_port=False,
+                      admission=None, profile=None, trace_dir=None, ready=None):
+    """
+    serves all tcp and udp sessions from a single selector loop until stop_event is set
+    drop-in alternative to running udp_server_loop and tcp_server_loop in their own threads
+    ready is an optional semaphore, released once both sockets are bound
+    """
+    server = EventServer(udp_port, tcp_port, max_sessions, tcp_payload, reuse_port, admission, profile, trace_dir)
+    if ready is not None:
+        ready.release()
+    server.serve(stop_event)
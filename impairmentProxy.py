@@ -0,0 +1,689 @@
+import argparse
+import errno
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+import serverLog
+from udpSender import SOL_UDP, UDP_SEGMENT, GSO_MAX_SEGMENTS, GSO_MAX_BYTES
+
+WHEEL_TICK = 0.00025  # seconds per timer wheel slot, the resolution of every delay
+WHEEL_SLOTS = 4096  # slots per rotation (about one second), longer delays wait for later rotations
+PROXY_POLL_INTERVAL = 0.5  # select timeout while nothing is in flight, bounds the reaction to stop_event
+UDP_PROXY_BUFFER = 65535
+UDP_SOCKET_BUFFER = 8 * 1024 * 1024  # SO_RCVBUF / SO_SNDBUF of the udp sockets, absorbs bursts between selects
+# linux udp generic receive offload: one recvmsg returns a train of equally sized datagrams
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+GRO_CMSG_SPACE = socket.CMSG_SPACE(4) if hasattr(socket, 'CMSG_SPACE') else 0
+UDP_READ_BATCH = 64  # datagrams read from one socket per readiness event, so no socket starves the others
+UDP_FLOW_TIMEOUT = 30.0  # seconds an idle udp flow (client address) keeps its upstream socket
+TCP_PROXY_CHUNK = 65536
+TCP_PROXY_WINDOW = 4 * 1024 * 1024  # bytes a relayed tcp direction holds in flight before it stops reading
+DEFAULT_QUEUE = 0.05  # seconds of traffic the rate limited link buffers before it drops (udp) or stalls (tcp)
+PROXY_PORT_OFFSET = 2  # main.py and benchmark.py put the proxy on the server's udp / tcp port + this
+
+proxy_log = serverLog.get_logger("Proxy")
+
+
+class Impairment:
+    """
+    what the proxy does to the traffic, the same in both directions (each has its own link)
+      - delay, jitter: one way latency in seconds, each packet gets delay +- a uniform jitter
+      - loss: probability that a udp datagram is dropped at random
+      - burst_loss, burst_length: long-run fraction of udp datagrams lost in bursts of that mean
+        length (a two state gilbert-elliott model, every datagram of a burst is lost)
+      - reorder: probability that a udp datagram skips the delay and overtakes the ones in flight
+      - rate: link rate in bits/sec (0 = unlimited), packets are serialized one after another
+      - queue: seconds of traffic the link buffers at rate; udp beyond it is tail dropped,
+        tcp stops being read until the queue drains
+      - tcp_window: bytes of one relayed tcp direction in flight inside the proxy
+      - seed: seed of the random decisions, the same seed replays the same loss pattern
+    tcp is relayed as a byte stream over two connections, so it only sees delay, jitter (without
+    reordering) and the rate; loss and reordering would corrupt the stream and apply to udp only
+    """
+    __slots__ = ("delay", "jitter", "loss", "burst_loss", "burst_length", "reorder", "rate", "queue",
+                 "tcp_window", "seed")
+
+    def __init__(self, delay=0.0, jitter=0.0, loss=0.0, burst_loss=0.0, burst_length=1.0, reorder=0.0, rate=0,
+                 queue=DEFAULT_QUEUE, tcp_window=TCP_PROXY_WINDOW, seed=None):
+        if not 0 <= loss < 1 or not 0 <= burst_loss < 1 or not 0 <= reorder <= 1:
+            raise ValueError("loss, burst loss and reorder are probabilities below 1")
+        if burst_length < 1:
+            raise ValueError(f"burst length is at least one packet, got {burst_length}")
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.burst_loss = burst_loss
+        self.burst_length = burst_length
+        self.reorder = reorder
+        self.rate = rate
+        self.queue = queue
+        self.tcp_window = tcp_window
+        self.seed = seed
+
+    def __repr__(self):
+        parts = [f"delay {self.delay * 1000:g} ms"]
+        if self.jitter:
+            parts.append(f"jitter {self.jitter * 1000:g} ms")
+        if self.loss:
+            parts.append(f"loss {self.loss:.2%}")
+        if self.burst_loss:
+            parts.append(f"burst loss {self.burst_loss:.2%} (mean {self.burst_length:g} packets)")
+        if self.reorder:
+            parts.append(f"reorder {self.reorder:.2%}")
+        if self.rate:
+            parts.append(f"rate {self.rate} bits/sec, queue {self.queue * 1000:g} ms")
+        return ", ".join(parts)
+
+
+class TimerWheel:
+    """
+    hashed timing wheel: schedule() and the expiry of every item are O(1), whatever the number of
+    packets in flight, where a heap would pay O(log n) per packet
+
+    items are due at the tick their deadline falls in (so up to one tick early); items of the same
+    tick expire in the order they were scheduled, and ticks in increasing order
+    """
+
+    def __init__(self, tick=WHEEL_TICK, slots=WHEEL_SLOTS):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = int(time.monotonic() / tick)
+        self.count = 0
+
+    def schedule(self, deadline, item):
+        tick = max(int(deadline / self.tick), self.current)
+        self.slots[tick % len(self.slots)].append((tick, item))
+        self.count += 1
+
+    def expire(self, now):
+        """
+        remove and return the items due by now, in deadline order
+        """
+        target = int(now / self.tick)
+        if not self.count:
+            self.current = max(self.current, target)
+            return []
+        due = []
+        while True:
+            slot = self.slots[self.current % len(self.slots)]
+            if slot:
+                later = [entry for entry in slot if entry[0] > self.current]
+                if len(later) != len(slot):
+                    due.extend(item for tick, item in slot if tick <= self.current)
+                    slot[:] = later
+            # the current tick stays open: items scheduled for it later in this tick still expire
+            if self.current >= target:
+                break
+            self.current += 1
+        self.count -= len(due)
+        return due
+
+
+class _Direction:
+    """
+    one direction of the emulated link: the serialization queue of the rate limit, the burst
+    loss state and the counters
+    """
+    __slots__ = ("name", "impairment", "rng", "free_at", "in_burst", "enter_burst", "leave_burst",
+                 "packets", "lost", "queue_drops", "reordered")
+
+    def __init__(self, name, impairment, rng):
+        self.name = name
+        self.impairment = impairment
+        self.rng = rng
+        self.free_at = 0.0
+        self.in_burst = False
+        # stationary loss of the two state chain: p_enter / (p_enter + p_leave) = burst_loss
+        self.leave_burst = 1.0 / impairment.burst_length
+        self.enter_burst = impairment.burst_loss * self.leave_burst / (1.0 - impairment.burst_loss)
+        self.packets = 0
+        self.lost = 0
+        self.queue_drops = 0
+        self.reordered = 0
+
+    def backlog(self, now):
+        return self.free_at - now
+
+    def depart(self, size, now, drop=True):
+        """
+        time the last bit of a size byte packet leaves the rate limited link, None if the queue
+        is full and drop is set
+        """
+        rate = self.impairment.rate
+        if not rate:
+            return now
+        start = max(now, self.free_at)
+        if drop and start - now > self.impairment.queue:
+            self.queue_drops += 1
+            return None
+        self.free_at = start + size * 8 / rate
+        return self.free_at
+
+    def is_lost(self):
+        impairment = self.impairment
+        if impairment.burst_loss:
+            if self.in_burst:
+                self.in_burst = self.rng.random() >= self.leave_burst
+            else:
+                self.in_burst = self.rng.random() < self.enter_burst
+            if self.in_burst:
+                return True
+        return bool(impairment.loss) and self.rng.random() < impairment.loss
+
+    def latency(self):
+        impairment = self.impairment
+        if not impairment.jitter:
+            return impairment.delay
+        return max(0.0, impairment.delay + self.rng.uniform(-impairment.jitter, impairment.jitter))
+
+    def summary(self):
+        return (f"{self.name}: {self.packets} packets, {self.lost} lost, {self.queue_drops} queue drops, "
+                f"{self.reordered} reordered")
+
+
+def _prepare_udp_socket(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_SOCKET_BUFFER)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDP_SOCKET_BUFFER)
+    if GRO_CMSG_SPACE:
+        try:
+            sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+        except OSError:
+            pass
+
+
+def _receive_datagrams(sock):
+    """
+    one recvmsg from sock: ([datagram, ...], sender address); with gro the kernel may hand over
+    several datagrams at once, split again here so every one is impaired on its own
+    """
+    if not GRO_CMSG_SPACE:
+        data, addr = sock.recvfrom(UDP_PROXY_BUFFER)
+        return [data], addr
+    data, ancdata, _, addr = sock.recvmsg(UDP_PROXY_BUFFER, GRO_CMSG_SPACE)
+    for level, kind, value in ancdata:
+        if level == SOL_UDP and kind == UDP_GRO:
+            size = struct.unpack('=i', value[:4])[0]
+            if 0 < size < len(data):
+                return [data[offset:offset + size] for offset in range(0, len(data), size)], addr
+    return [data], addr
+
+
+class _UdpFlow:
+    """
+    the datagrams of one client address: relayed upstream from a socket of their own, so the
+    server's answers (and the path of the nacks) come back to this flow
+    """
+    __slots__ = ("addr", "sock", "last_active")
+
+    def __init__(self, addr, sock):
+        self.addr = addr
+        self.sock = sock
+        self.last_active = time.monotonic()
+
+
+class _TcpPipe:
+    """
+    one direction of a relayed tcp connection: bytes read from src are held in the wheel until
+    their delivery time, then written to dst
+    """
+    __slots__ = ("kind", "src", "dst", "link", "queued", "out", "last", "eof_read", "eof_due", "eof_sent")
+
+    def __init__(self, kind, src, dst, link):
+        self.kind = kind  # "tcp_up" or "tcp_down", the wheel item kind of its chunks
+        self.src = src
+        self.dst = dst
+        self.link = link
+        self.queued = 0  # bytes in the wheel
+        self.out = bytearray()  # delivered bytes dst did not take yet
+        self.last = 0.0  # delivery time of the last chunk, later chunks never overtake it
+        self.eof_read = False
+        self.eof_due = False  # the end of the stream was delivered, shut dst down once out is empty
+        self.eof_sent = False
+
+
+class _TcpFlow:
+    __slots__ = ("client", "upstream", "up", "down", "connected", "masks")
+
+    def __init__(self, client, upstream, up_link, down_link):
+        self.client = client
+        self.upstream = upstream
+        self.up = _TcpPipe("tcp_up", client, upstream, up_link)
+        self.down = _TcpPipe("tcp_down", upstream, client, down_link)
+        self.connected = False
+        self.masks = {client: 0, upstream: 0}
+
+
+class ImpairmentProxy:
+    """
+    udp and tcp relay between clients and a server that delays, drops, reorders and rate limits
+    the traffic passing through it (see Impairment), to test wan behaviour over loopback
+
+    everything runs on one selector loop; packets in flight wait in a TimerWheel rather than in
+    sleeping threads, so the proxy keeps up with high packet rates and many flows. clients talk to
+    the proxy's udp_port / tcp_port, the proxy talks to upstream (server ip, udp port, tcp port)
+    """
+
+    def __init__(self, udp_port, tcp_port, upstream, impairment):
+        self.upstream = upstream
+        self.impairment = impairment
+        self.rng = random.Random(impairment.seed)
+        self.up_link = _Direction("client -> server", impairment, self.rng)
+        self.down_link = _Direction("server -> client", impairment, self.rng)
+        self.wheel = TimerWheel()
+        self.selector = selectors.DefaultSelector()
+        self.udp_flows = {}  # client addr -> _UdpFlow
+        self.tcp_flows = set()
+        self.stalled = set()  # tcp flows that stopped reading, checked again every loop iteration
+        self.use_gso = hasattr(socket.socket, 'sendmsg')  # turned off the first time the kernel rejects it
+
+        self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        _prepare_udp_socket(self.udp_sock)
+        self.udp_sock.bind(('', udp_port))
+        self.udp_sock.setblocking(False)
+        self.tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_sock.bind(('', tcp_port))
+        self.tcp_sock.listen(128)
+        self.tcp_sock.setblocking(False)
+        self.selector.register(self.udp_sock, selectors.EVENT_READ, None)
+        self.selector.register(self.tcp_sock, selectors.EVENT_READ, None)
+        self.udp_port = udp_port
+        self.tcp_port = tcp_port
+
+    def serve(self, stop_event):
+        proxy_log.info("Relaying UDP port %d and TCP port %d to %s:%d / %d (%r)", self.udp_port, self.tcp_port,
+                       self.upstream[0], self.upstream[1], self.upstream[2], self.impairment)
+        next_expiry = time.monotonic() + UDP_FLOW_TIMEOUT
+        try:
+            while not stop_event.is_set():
+                timeout = self.wheel.tick if self.wheel.count else PROXY_POLL_INTERVAL
+                for key, mask in self.selector.select(timeout):
+                    if key.fileobj is self.udp_sock:
+                        self._udp_from_client()
+                    elif key.fileobj is self.tcp_sock:
+                        self._tcp_accept()
+                    elif isinstance(key.data, _UdpFlow):
+                        self._udp_from_server(key.data)
+                    else:
+                        self._tcp_ready(key.data, key.fileobj, mask)
+
+                now = time.monotonic()
+                self._deliver_all(self.wheel.expire(now))
+                for flow in list(self.stalled):
+                    self._update_interest(flow)
+                if now >= next_expiry:
+                    self._expire_udp_flows(now)
+                    next_expiry = now + UDP_FLOW_TIMEOUT
+        finally:
+            self.close()
+            proxy_log.info("Proxy stopped, %s; %s", self.up_link.summary(), self.down_link.summary())
+
+    def close(self):
+        for flow in self.udp_flows.values():
+            flow.sock.close()
+        for flow in list(self.tcp_flows):
+            self._tcp_close(flow)
+        self.udp_sock.close()
+        self.tcp_sock.close()
+        self.selector.close()
+
+    # -------------------------------------------------------------------------
+    # udp
+    # -------------------------------------------------------------------------
+    def _impair_datagram(self, link, data, kind, target, now):
+        link.packets += 1
+        if link.is_lost():
+            link.lost += 1
+            return
+        departure = link.depart(len(data), now)
+        if departure is None:
+            return
+        if self.impairment.reorder and self.rng.random() < self.impairment.reorder:
+            link.reordered += 1
+            self.wheel.schedule(departure, (kind, target, data))
+            return
+        self.wheel.schedule(departure + link.latency(), (kind, target, data))
+
+    def _udp_from_client(self):
+        for _ in range(UDP_READ_BATCH):
+            try:
+                datagrams, addr = _receive_datagrams(self.udp_sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                proxy_log.debug("udp receive error: %s", e)
+                return
+            flow = self.udp_flows.get(addr)
+            if flow is None:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                _prepare_udp_socket(sock)
+                sock.connect((self.upstream[0], self.upstream[1]))
+                sock.setblocking(False)
+                flow = self.udp_flows[addr] = _UdpFlow(addr, sock)
+                self.selector.register(sock, selectors.EVENT_READ, flow)
+                proxy_log.debug("New udp flow from %s", addr)
+            flow.last_active = now = time.monotonic()
+            for data in datagrams:
+                self._impair_datagram(self.up_link, data, "udp_up", flow, now)
+
+    def _udp_from_server(self, flow):
+        for _ in range(UDP_READ_BATCH):
+            try:
+                datagrams, _ = _receive_datagrams(flow.sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # e.g. connection refused: nothing listens on the upstream udp port
+                proxy_log.debug("udp receive error on flow %s: %s", flow.addr, e)
+                return
+            flow.last_active = now = time.monotonic()
+            for data in datagrams:
+                self._impair_datagram(self.down_link, data, "udp_down", flow, now)
+
+    def _expire_udp_flows(self, now):
+        for addr, flow in list(self.udp_flows.items()):
+            if now - flow.last_active > UDP_FLOW_TIMEOUT:
+                self.selector.unregister(flow.sock)
+                flow.sock.close()
+                del self.udp_flows[addr]
+
+    # -------------------------------------------------------------------------
+    # tcp
+    # -------------------------------------------------------------------------
+    def _tcp_accept(self):
+        while True:
+            try:
+                client, addr = self.tcp_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                proxy_log.error("Accept error: %s", e)
+                return
+            client.setblocking(False)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            upstream.setblocking(False)
+            upstream.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            result = upstream.connect_ex((self.upstream[0], self.upstream[2]))
+            if result not in (0, errno.EINPROGRESS):
+                proxy_log.error("Cannot connect to the server for %s: %s", addr, errno.errorcode.get(result, result))
+                client.close()
+                upstream.close()
+                continue
+            flow = _TcpFlow(client, upstream, self.up_link, self.down_link)
+            self.tcp_flows.add(flow)
+            self._update_interest(flow)
+            proxy_log.debug("New tcp connection from %s", addr)
+
+    def _can_read(self, pipe):
+        if pipe.eof_read or pipe.queued + len(pipe.out) >= self.impairment.tcp_window:
+            return False
+        return not self.impairment.rate or pipe.link.backlog(time.monotonic()) <= self.impairment.queue
+
+    def _update_interest(self, flow):
+        """
+        (re)register both sockets of flow for what they can do now; a flow that stopped reading
+        only because its window or the link queue is full goes into stalled
+        """
+        if flow not in self.tcp_flows:
+            self.stalled.discard(flow)
+            return
+        stalled = False
+        for sock, inbound, outbound in ((flow.client, flow.up, flow.down), (flow.upstream, flow.down, flow.up)):
+            mask = 0
+            if sock is flow.upstream and not flow.connected:
+                mask = selectors.EVENT_WRITE
+            else:
+                if self._can_read(inbound):
+                    mask |= selectors.EVENT_READ
+                elif not inbound.eof_read:
+                    stalled = True
+                if outbound.out:
+                    mask |= selectors.EVENT_WRITE
+            if mask == flow.masks[sock]:
+                continue
+            if not mask:
+                self.selector.unregister(sock)
+            elif not flow.masks[sock]:
+                self.selector.register(sock, mask, flow)
+            else:
+                self.selector.modify(sock, mask, flow)
+            flow.masks[sock] = mask
+        if stalled:
+            self.stalled.add(flow)
+        else:
+            self.stalled.discard(flow)
+
+    def _tcp_ready(self, flow, sock, mask):
+        try:
+            if sock is flow.upstream and not flow.connected:
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    raise ConnectionError(f"cannot connect to the server: {errno.errorcode.get(error, error)}")
+                flow.connected = True
+                self._flush(flow.up)
+            else:
+                inbound, outbound = (flow.up, flow.down) if sock is flow.client else (flow.down, flow.up)
+                if mask & selectors.EVENT_READ:
+                    self._tcp_read(flow, inbound)
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(outbound)
+        except OSError as e:
+            proxy_log.debug("tcp relay error: %s", e)
+            self._tcp_close(flow)
+            return
+        self._tcp_finish(flow)
+
+    def _tcp_read(self, flow, pipe):
+        try:
+            data = pipe.src.recv(TCP_PROXY_CHUNK)
+        except (BlockingIOError, InterruptedError):
+            return
+        now = time.monotonic()
+        if not data:
+            # the end of the stream follows the last byte, through the same delay
+            pipe.eof_read = True
+            self.wheel.schedule(max(pipe.last, now), (pipe.kind, flow, None))
+            return
+        pipe.link.packets += 1
+        # tcp never drops; the queue limit applies by not reading (see _can_read)
+        delivery = max(pipe.link.depart(len(data), now, drop=False) + pipe.link.latency(), pipe.last)
+        pipe.last = delivery
+        pipe.queued += len(data)
+        self.wheel.schedule(delivery, (pipe.kind, flow, data))
+
+    def _flush(self, pipe):
+        while pipe.out:
+            try:
+                sent = pipe.dst.send(pipe.out)
+            except (BlockingIOError, InterruptedError):
+                return
+            del pipe.out[:sent]
+        if pipe.eof_due and not pipe.eof_sent:
+            pipe.dst.shutdown(socket.SHUT_WR)
+            pipe.eof_sent = True
+
+    def _tcp_finish(self, flow):
+        if flow.up.eof_sent and flow.down.eof_sent:
+            self._tcp_close(flow)
+        else:
+            self._update_interest(flow)
+
+    def _tcp_close(self, flow):
+        if flow not in self.tcp_flows:
+            return
+        self.tcp_flows.discard(flow)
+        self.stalled.discard(flow)
+        for sock in (flow.client, flow.upstream):
+            if flow.masks[sock]:
+                self.selector.unregister(sock)
+            sock.close()
+
+    # -------------------------------------------------------------------------
+    # delivery
+    # -------------------------------------------------------------------------
+    def _deliver_all(self, due):
+        """
+        deliver expired items in order; a run of datagrams of one flow and direction that are
+        due together (a burst that crossed the link) goes out as one gso sendmsg where the
+        kernel supports it, the per-datagram syscalls would otherwise cap the packet rate
+        """
+        i = 0
+        while i < len(due):
+            kind, target, data = due[i]
+            end = i + 1
+            if self.use_gso and kind.startswith("udp"):
+                size = total = len(data)
+                while end < len(due) and end - i < GSO_MAX_SEGMENTS:
+                    next_kind, next_target, next_data = due[end]
+                    if (next_kind != kind or next_target is not target or len(next_data) > size
+                            or total + len(next_data) > GSO_MAX_BYTES):
+                        break
+                    total += len(next_data)
+                    end += 1
+                    if len(next_data) < size:
+                        break  # gso needs every segment but the last one full sized
+            if end - i == 1 or not self._deliver_segmented(kind, target, [item[2] for item in due[i:end]]):
+                for item in due[i:end]:
+                    self._deliver(*item)
+            i = end
+
+    def _deliver_segmented(self, kind, target, datagrams):
+        """
+        returns false if the kernel rejected gso, the datagrams are then still to be delivered
+        """
+        cmsg = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', len(datagrams[0])))]
+        try:
+            if kind == "udp_up":
+                target.sock.sendmsg([b''.join(datagrams)], cmsg)
+            else:
+                self.udp_sock.sendmsg([b''.join(datagrams)], cmsg, 0, target.addr)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOPROTOOPT, errno.EIO, errno.EOPNOTSUPP):
+                proxy_log.debug("delivery error: %s", e)
+                return True
+            proxy_log.info("UDP segmentation offload not available, sending datagrams one by one")
+            self.use_gso = False
+            return False
+        return True
+
+    def _deliver(self, kind, target, data):
+        try:
+            if kind == "udp_up":
+                target.sock.send(data)
+            elif kind == "udp_down":
+                self.udp_sock.sendto(data, target.addr)
+            else:
+                self._deliver_tcp(target, target.up if kind == "tcp_up" else target.down, data)
+        except (BlockingIOError, InterruptedError):
+            # a full socket buffer drops the datagram, as a full router queue would
+            pass
+        except OSError as e:
+            proxy_log.debug("delivery error: %s", e)
+
+    def _deliver_tcp(self, flow, pipe, data):
+        if flow not in self.tcp_flows:
+            return
+        if data is None:
+            pipe.eof_due = True
+        else:
+            pipe.queued -= len(data)
+            pipe.out += data
+        if flow.connected:
+            try:
+                self._flush(pipe)
+            except OSError as e:
+                proxy_log.debug("tcp relay error: %s", e)
+                self._tcp_close(flow)
+                return
+        self._tcp_finish(flow)
+
+
+def impairment_proxy_loop(stop_event, udp_port, tcp_port, upstream, impairment):
+    """
+    relay udp_port / tcp_port to upstream (ip, udp port, tcp port) through impairment until
+    stop_event is set
+    """
+    ImpairmentProxy(udp_port, tcp_port, upstream, impairment).serve(stop_event)
+
+
+def start_proxy(stop_event, udp_port, tcp_port, upstream, impairment):
+    """
+    run the proxy in a daemon thread until stop_event is set; returns the thread
+    """
+    thread = threading.Thread(
+        target=impairment_proxy_loop, args=(stop_event, udp_port, tcp_port, upstream, impairment), daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def add_impairment_arguments(parser):
+    """
+    the --impair-* options shared by main.py, benchmark.py and the standalone proxy
+    """
+    group = parser.add_argument_group("network impairment (impairmentProxy.py)")
+    group.add_argument("--impair-delay", type=float, default=0.0, metavar="MS",
+                       help="one way delay added in each direction, in milliseconds")
+    group.add_argument("--impair-jitter", type=float, default=0.0, metavar="MS",
+                       help="uniform +- jitter around the delay, in milliseconds (reorders udp)")
+    group.add_argument("--impair-loss", type=float, default=0.0, metavar="PERCENT",
+                       help="random udp loss")
+    group.add_argument("--impair-burst-loss", type=float, default=0.0, metavar="PERCENT",
+                       help="udp loss in bursts (gilbert-elliott), on top of --impair-loss")
+    group.add_argument("--impair-burst-length", type=float, default=4.0, metavar="PACKETS",
+                       help="mean length of a loss burst")
+    group.add_argument("--impair-reorder", type=float, default=0.0, metavar="PERCENT",
+                       help="udp datagrams that skip the delay and overtake the ones in flight")
+    group.add_argument("--impair-rate", type=int, default=0, metavar="BITS_PER_SEC",
+                       help="link rate in each direction (0 = unlimited)")
+    group.add_argument("--impair-queue", type=float, default=DEFAULT_QUEUE * 1000, metavar="MS",
+                       help="queue of the rate limited link in milliseconds of traffic, udp beyond it is dropped")
+    group.add_argument("--impair-seed", type=int, default=None,
+                       help="seed of the loss / jitter / reorder decisions, for reproducible runs")
+
+
+def impairment_from_args(args):
+    """
+    the Impairment of parsed --impair-* options, None if none of them impairs anything
+    """
+    impairment = Impairment(
+        delay=args.impair_delay / 1000, jitter=args.impair_jitter / 1000, loss=args.impair_loss / 100,
+        burst_loss=args.impair_burst_loss / 100, burst_length=args.impair_burst_length,
+        reorder=args.impair_reorder / 100, rate=args.impair_rate, queue=args.impair_queue / 1000,
+        seed=args.impair_seed,
+    )
+    if not (impairment.delay or impairment.jitter or impairment.loss or impairment.burst_loss or impairment.reorder
+            or impairment.rate):
+        return None
+    return impairment
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Relay a speed test server through an impaired link")
+    parser.add_argument("--upstream", required=True, metavar="IP:UDP_PORT:TCP_PORT", help="server to relay to")
+    parser.add_argument("--udp-port", type=int, default=50003, help="udp port clients send their requests to")
+    parser.add_argument("--tcp-port", type=int, default=50004, help="tcp port clients connect to")
+    parser.add_argument("--log-level", choices=tuple(serverLog.LOG_LEVELS), default="info")
+    add_impairment_arguments(parser)
+    args = parser.parse_args(argv)
+    serverLog.configure(args.log_level)
+    ip, udp_port, tcp_port = args.upstream.rsplit(':', 2)
+    impairment = impairment_from_args(args) or Impairment()
+
+    stop_event = threading.Event()
+    try:
+        impairment_proxy_loop(stop_event, args.udp_port, args.tcp_port, (ip, int(udp_port), int(tcp_port)),
+                              impairment)
+    except KeyboardInterrupt:
+        stop_event.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import multiprocessing
+import os
+import sys
+import threading
+from Client import tcp_speed_test, tcp_session_test, udp_speed_test
+from connectionPool import TcpConnectionPool
+from ANSI import ANSI
+from constants import CODEC_NONE
+
+BARRIER_TIMEOUT = 30  # seconds the workers wait for each other before giving up
+
+
+def _run_shard(jobs, total, server_ip, udp_port, tcp_port, file_size, target_rate, fast_recv, reliable, tcp_requests,
+               verify, codec, profile, segment_size, fragment, trace_dir, progress_to_stderr, barrier, conn):
+    """
+    worker process body: run this process' share of the streams in threads
+    every worker creates its threads first and then waits on the barrier, so the streams of all
+    processes start at the same moment
+    progress_to_stderr prints the progress of the streams to stderr (a spawned worker writes to
+    the real stdout, whatever the parent redirected it to)
+    sends [(index, result), ...] back to the parent over conn
+    """
+    if progress_to_stderr:
+        sys.stdout = sys.stderr
+    results = [None] * total
+    threads = []
+    # sockets cannot outlive the worker, so keep-alive sessions get a pool per shard and round
+    tcp_pool = TcpConnectionPool((server_ip, tcp_port), profile=profile) if tcp_requests else None
+    for kind, index in jobs:
+        if kind == "TCP" and tcp_pool is not None:
+            thread = threading.Thread(
+                target=tcp_session_test, args=(tcp_pool, file_size, tcp_requests, results, index, verify, codec),
+                daemon=True
+            )
+        elif kind == "TCP":
+            thread = threading.Thread(
+                target=tcp_speed_test, args=(server_ip, tcp_port, file_size, results, index, verify, codec, profile),
+                daemon=True
+            )
+        else:
+            thread = threading.Thread(
+                target=udp_speed_test,
+                args=(server_ip, udp_port, file_size, results, index, target_rate, fast_recv, reliable, verify,
+                      codec, profile, segment_size, fragment, trace_dir),
+                daemon=True
+            )
+        threads.append(thread)
+
+    try:
+        barrier.wait(BARRIER_TIMEOUT)
+    except threading.BrokenBarrierError:
+        print(f"{ANSI.FAIL}[LoadGen {os.getpid()}] Start barrier broken, skipping {len(jobs)} streams{ANSI.ENDC}")
+        if tcp_pool is not None:
+            tcp_pool.close()
+        conn.send([])
+        conn.close()
+        return
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if tcp_pool is not None:
+        tcp_pool.close()
+
+    conn.send([(index, results[index]) for _, index in jobs])
+    conn.close()
+
+
+def run_sharded_test(server_ip, udp_port, tcp_port, file_size, num_tcp, num_udp,
+                     processes=None, target_rate=0, fast_recv=False, reliable=False, tcp_requests=0, verify=False,
+                     codec=CODEC_NONE, profile=None, segment_size=0, fragment=False, trace_dir=None,
+                     progress_to_stderr=False):
+    """
+    run num_tcp tcp and num_udp udp speed tests spread over worker processes
+    (one per core by default), so the gil of a single interpreter does not cap the load
+    tcp_requests > 0 runs the tcp streams as keep-alive sessions of that many pipelined requests
+    verify makes every stream check the integrity of what it received
+    codec (CODEC_*) asks for compressed payloads
+    profile (socketProfiles.SocketProfile) sets the options of every client socket
+    segment_size, fragment and trace_dir are passed on to every udp stream (see Client.udp_speed_test)
+    progress_to_stderr keeps the progress output of the workers off stdout, for callers that
+    write their results there
+
+    returns the same results list run_client builds with threads: tcp streams first, then udp,
+    None for streams that failed
+    """
+    jobs = [("TCP", i) for i in range(num_tcp)] + [("UDP", num_tcp + i) for i in range(num_udp)]
+    total = len(jobs)
+    results = [None] * total
+    if not jobs:
+        return results
+
+    processes = processes or os.cpu_count() or 1
+    processes = max(1, min(processes, total))
+    # deal the streams out round-robin so every process gets a mix of tcp and udp
+    shards = [jobs[i::processes] for i in range(processes)]
+
+    # spawn rather than fork: the parent usually has server and client threads running
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(processes)
+    workers = []
+    for shard in shards:
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        worker = ctx.Process(
+            target=_run_shard,
+            args=(shard, total, server_ip, udp_port, tcp_port, file_size, target_rate, fast_recv, reliable,
+                  tcp_requests, verify, codec, profile, segment_size, fragment, trace_dir, progress_to_stderr,
+                  barrier, child_conn),
+            daemon=True
+        )
+        worker.start()
+        child_conn.close()
+        workers.append((worker, parent_conn))
+
+    print(f"{ANSI.OKBLUE}[LoadGen] Running {total} streams across {processes} processes{ANSI.ENDC}")
+
+    for worker, parent_conn in workers:
+        try:
+            for index, result in parent_conn.recv():
+                results[index] = result
+        except EOFError:
+            print(f"{ANSI.FAIL}[LoadGen] Worker {worker.pid} exited without reporting results{ANSI.ENDC}")
+        finally:
+            parent_conn.close()
+        worker.join()
+
+    return results
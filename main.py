@@ -1,48 +1,136 @@
+import multiprocessing
+import os
 import threading
 import time
-from Server import broadcast_offers, udp_server_loop, tcp_server_loop
-from Client import listen_for_offer, tcp_speed_test, udp_speed_test, get_user_input
+import argparse
+from Server import broadcast_offers, udp_server_loop, tcp_server_loop, TCP_CHUNK_SIZE, UDP_CHUNK_SIZE
+from payloadSource import TcpPayload, HAVE_SENDFILE, PAYLOAD_SOURCES, make_payload
+from eventServer import event_server_loop, MAX_SESSIONS
+from compression import CODEC_IDS
+from discovery import serve_probes, discover, OfferCache, OFFER_CACHE_TTL, SELECTION_POLICIES
+from constants import CODEC_NONE, CODEC_NAMES
+from Client import tcp_speed_test, tcp_session_test, udp_speed_test, get_user_input
+from connectionPool import TcpConnectionPool
+from loadGenerator import run_sharded_test
+from socketProfiles import PROFILES, describe
+from impairmentProxy import add_impairment_arguments, impairment_from_args, start_proxy, PROXY_PORT_OFFSET
+from stripedTransfer import striped_transfer
+from serverPool import supervise_workers, default_worker_count
+from admission import AdmissionController, DEFAULT_MAX_TRANSFERS, DEFAULT_MAX_FILE_SIZE
+from metrics import REGISTRY, serve_metrics
+import serverLog
+from transferStats import summarize, distribution
 from ANSI import ANSI
 
+def _print_distribution(color, label, summary, unit, scale=1.0):
+    """
+    print a p50/p90/p99/max line produced by transferStats.distribution
+    """
+    if summary:
+        values = ", ".join(f"{name} {value * scale:.2f}" for name, value in summary.items())
+        print(f"{color}{label} ({unit}): {values}{ANSI.ENDC}")
+
+def _print_group_statistics(color, title, results):
+    """
+    print wall-clock and per-interval statistics of a group of concurrent streams
+    """
+    stats = summarize(results)
+    if not stats:
+        return
+    print(f"{color}\n[{title}]{ANSI.ENDC}")
+    print(f"{color}total bytes transferred: {stats['bytes_received']} bytes over {stats['streams']} streams{ANSI.ENDC}")
+    print(f"{color}wall-clock transfer time: {stats['wall_duration']:.2f} seconds{ANSI.ENDC}")
+    print(f"{color}aggregate transfer speed: {stats['throughput']:.2f} bits/sec{ANSI.ENDC}")
+    if stats['sample_interval']:
+        interval_ms = stats['sample_interval'] * 1000
+        _print_distribution(color, f"aggregate speed per {interval_ms:.0f} ms", stats['interval_throughput'], "bits/sec")
+        _print_distribution(color, f"per-stream speed per {interval_ms:.0f} ms", stats['stream_interval_throughput'], "bits/sec")
+    _print_distribution(color, "time to first byte", stats['ttfb'], "ms", 1000)
+    _print_distribution(color, "inter-arrival jitter", stats['jitter'], "ms", 1000)
+
 def collect_statistics(results):
     """
     collect and print statistics from the test results
+    streams run concurrently, so throughput is total bytes over the wall-clock span of the
+    group rather than an average of per-stream speeds
     """
     tcp_results = [r for r in results if r and r["type"] == "TCP"]
     udp_results = [r for r in results if r and r["type"] == "UDP"]
 
     # tcp statistics
-    if tcp_results:
-        print(f"{ANSI.HEADER}\n[TCP Statistics]{ANSI.ENDC}")
-        total_bytes = sum(r["bytes_received"] for r in tcp_results)
-        total_duration = sum(r["duration"] for r in tcp_results)
-        average_speed = sum(r["speed"] for r in tcp_results) / len(tcp_results)
-        print(f"{ANSI.HEADER}total bytes transferred: {total_bytes} bytes{ANSI.ENDC}")
-        print(f"{ANSI.HEADER}total transfer time: {total_duration:.2f} seconds{ANSI.ENDC}")
-        print(f"{ANSI.HEADER}average transfer speed: {average_speed:.2f} bits/sec{ANSI.ENDC}")
+    _print_group_statistics(ANSI.HEADER, "TCP Statistics", tcp_results)
+    sessions = [r for r in tcp_results if "steady_state_speed" in r]
+    if sessions:
+        reused = sum(1 for r in sessions if r["reused_connection"])
+        print(f"{ANSI.HEADER}keep-alive sessions: {len(sessions)} ({reused} on reused connections){ANSI.ENDC}")
+        _print_distribution(ANSI.HEADER, "connection setup",
+                            distribution([r["connect_time"] for r in sessions if r["connect_time"] is not None]),
+                            "ms", 1000)
+        _print_distribution(ANSI.HEADER, "steady-state speed",
+                            distribution([r["steady_state_speed"] for r in sessions]), "bits/sec")
 
     # udp statistics
+    _print_group_statistics(ANSI.OKCYAN, "UDP Statistics", udp_results)
     if udp_results:
-        print(f"{ANSI.OKCYAN}\n[UDP Statistics]{ANSI.ENDC}")
-        total_bytes = sum(r["bytes_received"] for r in udp_results)
-        total_duration = sum(r["duration"] for r in udp_results)
-        average_speed = sum(r["speed"] for r in udp_results) / len(udp_results)
         average_success_rate = sum(r["success_rate"] for r in udp_results) / len(udp_results)
-        print(f"{ANSI.OKCYAN}total bytes transferred: {total_bytes} bytes{ANSI.ENDC}")
-        print(f"{ANSI.OKCYAN}total transfer time: {total_duration:.2f} seconds{ANSI.ENDC}")
-        print(f"{ANSI.OKCYAN}average transfer speed: {average_speed:.2f} bits/sec{ANSI.ENDC}")
         print(f"{ANSI.OKCYAN}average success rate: {average_success_rate:.2f}%{ANSI.ENDC}")
+        segment_sizes = sorted({r["segment_size"] for r in udp_results if r.get("segment_size")})
+        if segment_sizes:
+            print(f"{ANSI.OKCYAN}segment size: {', '.join(map(str, segment_sizes))} bytes{ANSI.ENDC}")
+        reliable = [r for r in udp_results if "first_pass_success_rate" in r]
+        if reliable:
+            first_pass = sum(r["first_pass_success_rate"] for r in reliable) / len(reliable)
+            nacked = sum(r["retransmit_requests"] for r in reliable)
+            print(f"{ANSI.OKCYAN}average first-pass success rate: {first_pass:.2f}%, "
+                  f"segments nacked: {nacked}{ANSI.ENDC}")
+            _print_distribution(ANSI.OKCYAN, "time to complete",
+                                distribution([r["time_to_complete"] for r in reliable if r["time_to_complete"] is not None]),
+                                "ms", 1000)
+
+    # integrity of checked transfers
+    checked_tcp = [r for r in tcp_results if "checksum_ok" in r]
+    checked_udp = [r for r in udp_results if "corrupt_segments" in r]
+    if checked_tcp or checked_udp:
+        failed = sum(1 for r in checked_tcp if not r["checksum_ok"])
+        corrupt = sum(r["corrupt_segments"] for r in checked_udp)
+        color = ANSI.FAIL if failed or corrupt else ANSI.OKGREEN
+        print(f"{color}\nintegrity: {len(checked_tcp) - failed}/{len(checked_tcp)} tcp streams verified, "
+              f"{corrupt} corrupt udp segments{ANSI.ENDC}")
+
+    # a striped object: every tcp stream carries the object fields
+    striped = [r for r in tcp_results if "object_size" in r]
+    if striped:
+        obj = striped[0]
+        ttlb = f"{obj['time_to_last_byte']:.3f}" if obj["time_to_last_byte"] is not None else "-"
+        color = ANSI.BOLD if obj["object_complete"] else ANSI.FAIL
+        print(f"{color}\nstriped object: {obj['object_size']} bytes over {len(striped)} streams, "
+              f"time to last byte {ttlb} seconds ({obj['object_speed']:.2f} bits/sec), "
+              f"{sum(r['pieces'] for r in striped)} pieces, {sum(r['steals'] for r in striped)} steals"
+              f"{'' if obj['object_complete'] else ', INCOMPLETE'}{ANSI.ENDC}")
+
+    # compressed transfers: decompressed goodput against the bytes that crossed the wire
+    for label, group in (("tcp", tcp_results), ("udp", udp_results)):
+        compressed = [r for r in group if "wire_bytes" in r]
+        if not compressed:
+            continue
+        raw = sum(r["bytes_received"] for r in compressed)
+        wire = sum(r["wire_bytes"] for r in compressed)
+        duration = max(r["duration"] for r in compressed)
+        line = (f"\n{label} compression ({compressed[0]['codec']}): ratio {raw / wire if wire else 0.0:.2f}, "
+                f"{raw * 8 / duration if duration > 0 else 0.0:.2f} bits/sec decompressed, "
+                f"{wire * 8 / duration if duration > 0 else 0.0:.2f} bits/sec on the wire, "
+                f"decompress cpu {sum(r['decompress_cpu_seconds'] for r in compressed):.3f} s")
+        if label == "tcp":
+            line += f", server compress cpu {sum(r['compress_cpu_seconds'] for r in compressed):.3f} s"
+        print(f"{ANSI.BOLD}{line}{ANSI.ENDC}")
+
+    # effective socket options, read back from the first socket of each kind
+    for label, group in (("tcp", tcp_results), ("udp", udp_results)):
+        if group and "socket_profile" in group[0]:
+            print(f"{ANSI.BOLD}\n{label} socket profile {describe(group[0])}{ANSI.ENDC}")
 
     # overall statistics
-    total_results = tcp_results + udp_results
-    if total_results:
-        print(f"{ANSI.BOLD}\n[Overall Statistics]{ANSI.ENDC}")
-        total_bytes = sum(r["bytes_received"] for r in total_results)
-        total_duration = sum(r["duration"] for r in total_results)
-        average_speed = sum(r["speed"] for r in total_results) / len(total_results)
-        print(f"{ANSI.BOLD}total bytes transferred: {total_bytes} bytes{ANSI.ENDC}")
-        print(f"{ANSI.BOLD}total transfer time: {total_duration:.2f} seconds{ANSI.ENDC}")
-        print(f"{ANSI.BOLD}average transfer speed: {average_speed:.2f} bits/sec{ANSI.ENDC}")
+    _print_group_statistics(ANSI.BOLD, "Overall Statistics", tcp_results + udp_results)
 
 def log_result(result):
     """
@@ -54,57 +142,238 @@ def log_result(result):
         print(f"{ANSI.OKCYAN}[udp] {result['bytes_received']} bytes in {result['duration']:.2f} seconds "
               f"({result['speed']:.2f} bits/sec), success rate: {result['success_rate']:.2f}%{ANSI.ENDC}")
 
-def start_server(stop_event, udp_port, tcp_port):
+SERVER_ENGINES = ("thread", "event")
+READY_POLL_INTERVAL = 0.1  # seconds between checks of stop_event while waiting for the server to listen
+
+
+def _signal_ready(stop_event, listening, loops, ready):
+    """
+    set ready once the server's listening loops released listening `loops` times
+    """
+    while loops:
+        if listening.acquire(timeout=READY_POLL_INTERVAL):
+            loops -= 1
+        elif stop_event.is_set():
+            return
+    ready.set()
+
+
+def start_server(stop_event, udp_port, tcp_port, engine="thread", max_sessions=MAX_SESSIONS, tcp_payload=None,
+                 workers=1, admission=None, metrics_port=0, profile=None, advertise=None, trace_dir=None, ready=None):
     """
     start the server with specified udp and tcp ports
     includes broadcasting offers, udp, and tcp loops
+
+    engine selects how transfers are served:
+      - "thread": one thread per tcp connection and per udp datagram
+      - "event": a single selector loop serving every session, with at most
+        max_sessions transfers in flight
+
+    tcp_payload is the shared payloadSource.TcpPayload every tcp stream is served from
+    (defaults to a zero-copy payload with TCP_CHUNK_SIZE chunks); udp segments carry its bytes
+    too when it holds real data
+
+    workers > 1 (or 0 = one per core) pre-forks that many server processes that all bind the
+    same ports with SO_REUSEPORT, supervised and restarted from a thread of this process;
+    offers are still broadcast by a single thread
+
+    admission is an optional admission.AdmissionController applied to every tcp and udp request;
+    offers pause while it reports the server saturated
+
+    a non-zero metrics_port serves the server metrics in prometheus format on
+    http://127.0.0.1:<metrics_port>/metrics
+
+    profile is the socketProfiles.SocketProfile of every transfer socket (kernel defaults if None)
+
+    advertise = (udp port, tcp port) makes offers and probe replies announce those ports instead of
+    the ones the server binds, e.g. the ports of an impairment proxy in front of it
+
+    trace_dir makes every udp transfer write a packet trace of what it sends there (packetTrace.py)
+
+    ready is an optional threading.Event, set once the udp and tcp sockets of every worker are
+    bound and listening (before that, requests are refused or land on a subset of the workers)
     """
+    if engine not in SERVER_ENGINES:
+        raise ValueError(f"Unknown server engine '{engine}', expected one of {SERVER_ENGINES}")
+
+    if tcp_payload is None:
+        tcp_payload = TcpPayload(TCP_CHUNK_SIZE)
+
+    offer_udp_port, offer_tcp_port = advertise if advertise is not None else (udp_port, tcp_port)
     broadcast_thread = threading.Thread(
-        target=broadcast_offers, args=(stop_event, udp_port, tcp_port), daemon=True
+        target=broadcast_offers, args=(stop_event, offer_udp_port, offer_tcp_port, admission), daemon=True
+    )
+    discovery_thread = threading.Thread(
+        target=serve_probes, args=(stop_event, offer_udp_port, offer_tcp_port, admission), daemon=True
     )
+
+    worker_count = workers or default_worker_count()
+    listening = None
+    ready_threads = []
+    if ready is not None:
+        # released by every listening loop, the udp and the tcp one or a single event loop per worker
+        listening = multiprocessing.get_context("spawn").Semaphore(0) if workers != 1 else threading.Semaphore(0)
+        loops = worker_count * (1 if engine == "event" else 2)
+        ready_thread = threading.Thread(target=_signal_ready, args=(stop_event, listening, loops, ready), daemon=True)
+        ready_thread.start()
+        ready_threads.append(ready_thread)
+
+    metrics_threads = []
+    if metrics_port:
+        if admission is not None:
+            admission.register_metrics(REGISTRY)
+        metrics_thread = threading.Thread(target=serve_metrics, args=(stop_event, metrics_port), daemon=True)
+        metrics_thread.start()
+        metrics_threads.append(metrics_thread)
+
+    if workers != 1:
+        supervisor_thread = threading.Thread(
+            target=supervise_workers,
+            args=(stop_event, udp_port, tcp_port, worker_count, engine, max_sessions, tcp_payload, admission,
+                  profile, trace_dir, listening),
+            daemon=True
+        )
+        broadcast_thread.start()
+        discovery_thread.start()
+        supervisor_thread.start()
+        return [broadcast_thread, discovery_thread, supervisor_thread] + metrics_threads + ready_threads
+
+    if engine == "event":
+        event_thread = threading.Thread(
+            target=event_server_loop,
+            args=(stop_event, udp_port, tcp_port, max_sessions, tcp_payload, False, admission, profile, trace_dir,
+                  listening),
+            daemon=True
+        )
+        broadcast_thread.start()
+        discovery_thread.start()
+        event_thread.start()
+        return [broadcast_thread, discovery_thread, event_thread] + metrics_threads + ready_threads
+
     udp_thread = threading.Thread(
-        target=udp_server_loop, args=(stop_event, udp_port), daemon=True
+        target=udp_server_loop,
+        args=(stop_event, udp_port, False, admission, tcp_payload, profile, trace_dir, listening), daemon=True
     )
     tcp_thread = threading.Thread(
-        target=tcp_server_loop, args=(stop_event, tcp_port), daemon=True
+        target=tcp_server_loop, args=(stop_event, tcp_port, tcp_payload, False, admission, profile, listening),
+        daemon=True
     )
 
     broadcast_thread.start()
+    discovery_thread.start()
     udp_thread.start()
     tcp_thread.start()
 
-    return [broadcast_thread, udp_thread, tcp_thread]
+    return [broadcast_thread, discovery_thread, udp_thread, tcp_thread] + metrics_threads + ready_threads
 
-def run_client():
+def run_threaded_test(server_ip, udp_port, tcp_port, file_size, num_tcp, num_udp, target_rate=0, fast_recv=False,
+                      reliable=False, tcp_pool=None, tcp_requests=1, verify=False, codec=CODEC_NONE, stripe=False,
+                      profile=None, segment_size=0, fragment=False, trace_dir=None):
+    """
+    run all tcp and udp speed tests as threads of this process and wait for them
+    with a tcp_pool every tcp stream is a keep-alive session of tcp_requests pipelined requests
+    verify makes every stream check the integrity of what it received (crc32)
+    codec (CODEC_*) asks for compressed payloads
+    stripe fetches one object of file_size bytes as byte ranges over the num_tcp streams
+    (stripedTransfer.py, connections from tcp_pool) instead of a full copy per stream
+    profile (socketProfiles.SocketProfile) sets the options of the sockets the streams open
+    themselves, pooled connections get the profile of their pool
+    segment_size asks for udp datagrams of that many payload bytes (0 = the server's default),
+    clamped by the server to the path mtu unless fragment allows ip fragmentation
+    trace_dir makes every udp stream write a packet trace of what it receives there
+    returns the results list, tcp streams first, then udp
+    """
+    results = [None] * (num_tcp + num_udp)
+    threads = []
+
+    if stripe and num_tcp:
+        thread = threading.Thread(
+            target=striped_transfer, args=(tcp_pool, file_size, num_tcp, results, 0, verify, codec), daemon=True
+        )
+        threads.append(thread)
+        thread.start()
+
+    for i in range(num_tcp if not stripe else 0):
+        if tcp_pool is not None:
+            thread = threading.Thread(
+                target=tcp_session_test, args=(tcp_pool, file_size, tcp_requests, results, i, verify, codec),
+                daemon=True
+            )
+        else:
+            thread = threading.Thread(
+                target=tcp_speed_test, args=(server_ip, tcp_port, file_size, results, i, verify, codec, profile),
+                daemon=True
+            )
+        threads.append(thread)
+        thread.start()
+
+    for i in range(num_udp):
+        thread = threading.Thread(
+            target=udp_speed_test,
+            args=(server_ip, udp_port, file_size, results, num_tcp + i, target_rate, fast_recv, reliable, verify,
+                  codec, profile, segment_size, fragment, trace_dir),
+            daemon=True
+        )
+        threads.append(thread)
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return results
+
+def run_client(fast_recv=False, processes=1, reliable=False, tcp_requests=0, verify=False, codec=CODEC_NONE,
+               selection="first", probe_hosts=(), cache_ttl=OFFER_CACHE_TTL, stripe=False, profile=None,
+               segment_size=0, fragment=False, trace_dir=None):
     """
     keep the client running indefinitely, listening for offers and performing tests
+    fast_recv selects the high-rate udp receive path for every udp connection
+    reliable makes every udp connection nack and recover its lost segments
+    tcp_requests > 0 runs every tcp stream as a keep-alive session of that many pipelined requests,
+    on connections pooled across rounds
+    verify checks every transfer against the crc32 the server sends along
+    codec (CODEC_*) asks for compressed payloads, if the offering server supports it
+    processes > 1 (or 0 = one per core) shards the streams across worker processes
+    servers are found with discovery probes (also sent by unicast to probe_hosts) and cached for
+    cache_ttl seconds across rounds; selection is the discovery.SELECTION_POLICIES entry that
+    picks one when several answer
+    stripe turns the tcp streams of a round into the byte ranges of one striped object
+    profile is the socketProfiles.SocketProfile of every client socket
+    segment_size and fragment set the udp segment size every udp stream asks for
+    trace_dir is where the udp streams write their packet traces (None = no traces)
     """
+    pools = {}  # (server ip, tcp port) -> TcpConnectionPool, kept across rounds
+    cache = OfferCache(cache_ttl)
     while True:
+        server = None
         try:
-            print(f"{ANSI.OKBLUE}[Client] Listening for offer messages...{ANSI.ENDC}")
-            server_ip, udp_port, tcp_port = listen_for_offer()
+            print(f"{ANSI.OKBLUE}[Client] Looking for servers...{ANSI.ENDC}")
+            server = discover(cache, selection, probe_hosts)
+            server_ip, udp_port, tcp_port = server.address
+            round_codec = codec
+            if not server.codecs & (1 << codec):
+                print(f"{ANSI.WARNING}[Client] Server does not support {CODEC_NAMES[codec]}, testing uncompressed{ANSI.ENDC}")
+                round_codec = CODEC_NONE
 
-            file_size, num_tcp, num_udp = get_user_input()
+            file_size, num_tcp, num_udp, target_rate = get_user_input()
 
-            results = [None] * (num_tcp + num_udp)
-            threads = []
-
-            for i in range(num_tcp):
-                thread = threading.Thread(
-                    target=tcp_speed_test, args=(server_ip, tcp_port, file_size, results, i), daemon=True
+            if processes == 1:
+                tcp_pool = None
+                if tcp_requests or stripe:
+                    tcp_pool = pools.setdefault((server_ip, tcp_port), TcpConnectionPool((server_ip, tcp_port), profile=profile))
+                results = run_threaded_test(
+                    server_ip, udp_port, tcp_port, file_size, num_tcp, num_udp, target_rate, fast_recv, reliable,
+                    tcp_pool, tcp_requests, verify, round_codec, stripe, profile, segment_size, fragment, trace_dir
                 )
-                threads.append(thread)
-                thread.start()
-
-            for i in range(num_udp):
-                thread = threading.Thread(
-                    target=udp_speed_test, args=(server_ip, udp_port, file_size, results, num_tcp + i), daemon=True
+            else:
+                results = run_sharded_test(
+                    server_ip, udp_port, tcp_port, file_size, num_tcp, num_udp, processes, target_rate, fast_recv,
+                    reliable, tcp_requests, verify, round_codec, profile, segment_size, fragment, trace_dir
                 )
-                threads.append(thread)
-                thread.start()
 
-            for thread in threads:
-                thread.join()
+            if not any(results):
+                # nothing got through: look for servers again next round
+                cache.forget(server)
 
             print(f"{ANSI.OKGREEN}[Client] Collecting and printing statistics...{ANSI.ENDC}")
             collect_statistics(results)
@@ -112,24 +381,127 @@ def run_client():
 
         except KeyboardInterrupt:
             print(f"{ANSI.WARNING}[Client] Shutting down...{ANSI.ENDC}")
+            for pool in pools.values():
+                pool.close()
             break
         except Exception as e:
             print(f"{ANSI.FAIL}[Client] Unexpected error: {e}{ANSI.ENDC}")
+            if server is not None:
+                cache.forget(server)
+
+def parse_args():
+    """
+    parse the command line options of the combined server + client application
+    """
+    parser = argparse.ArgumentParser(description="Speed test server and client")
+    parser.add_argument("--engine", choices=SERVER_ENGINES, default="thread",
+                        help="server transfer engine (default: thread)")
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS,
+                        help="maximum concurrent transfers for the event engine")
+    parser.add_argument("--tcp-chunk-size", type=int, default=TCP_CHUNK_SIZE,
+                        help="maximum bytes handed to the kernel per tcp send syscall")
+    parser.add_argument("--tcp-send-mode", choices=("sendfile", "memoryview"),
+                        default="sendfile" if HAVE_SENDFILE else "memoryview",
+                        help="zero-copy os.sendfile or memoryview slices of the mapped payload")
+    parser.add_argument("--payload", default="filler", metavar="SOURCE",
+                        help=f"data the server sends: {' or '.join(PAYLOAD_SOURCES)}[:seed] (pseudo-random) or a file path")
+    parser.add_argument("--server-workers", type=int, default=1,
+                        help="pre-forked server processes sharing the ports via SO_REUSEPORT (0 = one per core)")
+    parser.add_argument("--max-transfers", type=int, default=DEFAULT_MAX_TRANSFERS,
+                        help="admission control: transfers in flight before requests are rejected (0 = unlimited)")
+    parser.add_argument("--max-request-size", type=int, default=DEFAULT_MAX_FILE_SIZE,
+                        help="admission control: largest file size a request may ask for, in bytes (0 = unlimited)")
+    parser.add_argument("--per-client-transfers", type=int, default=0,
+                        help="admission control: transfers in flight per client ip (0 = unlimited)")
+    parser.add_argument("--server-rate", type=int, default=0,
+                        help="admission control: bits/sec budget shared by all transfers of the server (0 = unlimited)")
+    parser.add_argument("--log-level", choices=tuple(serverLog.LOG_LEVELS), default="info",
+                        help="server log level; warning or error keeps per-transfer messages off the hot path")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="serve prometheus metrics on http://127.0.0.1:PORT/metrics (0 = disabled)")
+    parser.add_argument("--fast-udp-recv", action="store_true",
+                        help="receive udp payloads with recv_into a preallocated ring, parsing headers in place")
+    parser.add_argument("--client-processes", type=int, default=1,
+                        help="worker processes the client streams are sharded across (0 = one per core)")
+    parser.add_argument("--reliable-udp", action="store_true",
+                        help="udp clients nack missing segments and the server retransmits them")
+    parser.add_argument("--tcp-keepalive", type=int, default=0, metavar="REQUESTS",
+                        help="pipeline this many requests per pooled keep-alive tcp connection (0 = one connection per transfer)")
+    parser.add_argument("--verify", action="store_true",
+                        help="verify received data: crc32 per udp segment and a rolling crc32 per tcp transfer")
+    parser.add_argument("--codec", choices=tuple(CODEC_IDS), default="none",
+                        help="ask for compressed payloads: tcp as one stream per response, udp per segment")
+    parser.add_argument("--stripe", action="store_true",
+                        help="fetch one object of the requested size as byte ranges spread over the tcp streams, "
+                             "with work stealing, and report its time to last byte")
+    parser.add_argument("--socket-profile", choices=tuple(PROFILES), default="default",
+                        help="socket options of the server and client sockets: buffer sizes, congestion control, "
+                             "listen backlog, busy polling (default: kernel defaults)")
+    parser.add_argument("--udp-segment-size", type=int, default=0, metavar="BYTES",
+                        help="udp payload bytes per datagram the client asks for, clamped by the server to the path "
+                             f"mtu (0 = the server's default of {UDP_CHUNK_SIZE})")
+    parser.add_argument("--udp-fragment", action="store_true",
+                        help="let the server exceed the path mtu with --udp-segment-size, up to 64 KiB datagrams "
+                             "fragmented by ip")
+    parser.add_argument("--trace-dir", metavar="DIR",
+                        help="record every udp packet the server sends and the client receives in packet traces "
+                             "in DIR, for `python packetTrace.py`")
+    parser.add_argument("--server-select", choices=SELECTION_POLICIES, default="first",
+                        help="server picked when several answer the discovery probe (lowest-rtt pings each one)")
+    parser.add_argument("--probe-host", action="append", default=[], metavar="HOST",
+                        help="also probe this host by unicast, e.g. a server outside the broadcast domain (repeatable)")
+    parser.add_argument("--discovery-ttl", type=float, default=OFFER_CACHE_TTL,
+                        help="seconds a discovered server is reused across rounds without probing again")
+    add_impairment_arguments(parser)
+    args = parser.parse_args()
+    if args.stripe and (args.client_processes != 1 or args.tcp_keepalive):
+        parser.error("--stripe runs in one client process on its own keep-alive connections, "
+                     "it cannot be combined with --client-processes or --tcp-keepalive")
+    if not 0 <= args.udp_segment_size <= 0xffff:
+        parser.error("--udp-segment-size must be between 0 and 65535")
+    return args
 
 def main():
     """
     main function to start the server and client concurrently and handle cleanup
     """
+    args = parse_args()
+    serverLog.configure(args.log_level)
+    if args.trace_dir:
+        os.makedirs(args.trace_dir, exist_ok=True)
     stop_event = threading.Event()
+    server_threads = []
 
     udp_port = 50001
     tcp_port = 50002
+    impairment = impairment_from_args(args)
+    # with an impairment the server advertises the proxy, so the client only ever talks to it
+    advertise = (udp_port + PROXY_PORT_OFFSET, tcp_port + PROXY_PORT_OFFSET) if impairment is not None else None
 
     try:
         print(f"{ANSI.BOLD}[Main] Starting server...{ANSI.ENDC}")
-        server_threads = start_server(stop_event, udp_port, tcp_port)
+        tcp_payload = make_payload(args.payload, args.tcp_chunk_size, use_sendfile=args.tcp_send_mode == "sendfile")
+        admission = AdmissionController(
+            max_transfers=args.max_transfers,
+            max_file_size=args.max_request_size,
+            per_ip_transfers=args.per_client_transfers,
+            byte_rate=args.server_rate // 8,
+        )
+        server_threads = start_server(
+            stop_event, udp_port, tcp_port, args.engine, args.max_sessions, tcp_payload, args.server_workers,
+            admission, args.metrics_port, PROFILES[args.socket_profile], advertise, args.trace_dir
+        )
+        if impairment is not None:
+            print(f"{ANSI.BOLD}[Main] Starting impairment proxy ({impairment!r})...{ANSI.ENDC}")
+            server_threads.append(start_proxy(stop_event, *advertise, ('127.0.0.1', udp_port, tcp_port), impairment))
 
-        client_thread = threading.Thread(target=run_client, daemon=True)
+        client_thread = threading.Thread(target=run_client,
+                                         args=(args.fast_udp_recv, args.client_processes, args.reliable_udp,
+                                               args.tcp_keepalive, args.verify, CODEC_IDS[args.codec],
+                                               args.server_select, args.probe_host, args.discovery_ttl,
+                                               args.stripe, PROFILES[args.socket_profile], args.udp_segment_size,
+                                               args.udp_fragment, args.trace_dir),
+                                         daemon=True)
         client_thread.start()
 
         print(f"{ANSI.OKGREEN}[Main] Server and Client are running. Press CTRL + C to stop.{ANSI.ENDC}")
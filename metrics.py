@@ -0,0 +1,300 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+SEND_SECONDS_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2, 0.1)
+PRUNE_EVERY = 64  # new per-thread cells between sweeps of the cells of finished threads
+METRICS_PUBLISH_INTERVAL = 1.0  # seconds between the snapshots a pre-fork worker sends its supervisor
+METRICS_POLL_INTERVAL = 0.5
+
+
+class _Metric:
+    """
+    one labelled series; every thread updates a private cell (no lock on the hot path) and the
+    cells are only summed when the registry is collected. cells of finished threads are folded
+    into `retired`, so a thread-per-connection server does not keep one cell per connection
+    """
+    kind = None
+
+    def __init__(self, labels):
+        self.labels = labels
+        self._local = threading.local()
+        self._cells = []  # (thread, cell)
+        self._retired = self._new_cell()
+        self._lock = threading.Lock()
+
+    def _new_cell(self):
+        return [0]
+
+    def _cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = self._new_cell()
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+                if len(self._cells) % PRUNE_EVERY == 0:
+                    self._prune()
+            return cell
+
+    def _prune(self):
+        live = []
+        for thread, cell in self._cells:
+            if thread.is_alive():
+                live.append((thread, cell))
+            else:
+                _add_into(self._retired, cell)
+        self._cells = live
+
+    def value(self):
+        with self._lock:
+            self._prune()
+            total = list(self._retired)
+            for _, cell in self._cells:
+                _add_into(total, cell)
+        return total[0] if len(total) == 1 else total
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1):
+        self._cell()[0] += amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1):
+        self._cell()[0] += amount
+
+    def dec(self, amount=1):
+        self._cell()[0] -= amount
+
+
+class Histogram(_Metric):
+    """
+    cells hold one count per bucket (the last one is +Inf) followed by the sum of observations
+    """
+    kind = "histogram"
+
+    def __init__(self, labels, buckets):
+        self.buckets = tuple(buckets)
+        super().__init__(labels)
+
+    def _new_cell(self):
+        return [0] * (len(self.buckets) + 2)
+
+    def observe(self, value):
+        cell = self._cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+
+class _FunctionGauge:
+    """
+    gauge read from a callback at collection time, local to the process that registered it
+    """
+    kind = "gauge"
+
+    def __init__(self, labels, function):
+        self.labels = labels
+        self.function = function
+
+    def value(self):
+        return self.function()
+
+
+def _add_into(total, cell):
+    for i, value in enumerate(cell):
+        total[i] += value
+
+
+def _merge(total, value):
+    if isinstance(value, list):
+        if total is None:
+            return list(value)
+        _add_into(total, value)
+        return total
+    return value if total is None else total + value
+
+
+class MetricsRegistry:
+    """
+    counters, gauges and histograms of this process, plus the latest snapshots of other
+    processes (pre-fork workers) merged in when collected
+
+    a metric is one family name with a fixed set of labels; asking for the same name and
+    labels again returns the same series
+    """
+
+    def __init__(self):
+        self.families = {}  # name -> [kind, help, buckets, {labels: metric}]
+        self.remote = {}  # source -> snapshot
+        self.retired = {}  # counters and histograms of sources that went away
+        self.lock = threading.Lock()
+
+    def _series(self, kind, name, help, labels, factory, buckets=None):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.setdefault(name, [kind, help, buckets, {}])
+            if family[0] != kind:
+                raise ValueError(f"metric {name} is already registered as a {family[0]}")
+            series = family[3].get(labels)
+            if series is None:
+                series = family[3][labels] = factory(labels)
+            return series
+
+    def counter(self, name, help, **labels):
+        return self._series("counter", name, help, labels, Counter)
+
+    def gauge(self, name, help, **labels):
+        return self._series("gauge", name, help, labels, Gauge)
+
+    def gauge_function(self, name, help, function, **labels):
+        return self._series("gauge", name, help, labels, lambda l: _FunctionGauge(l, function))
+
+    def histogram(self, name, help, buckets=SEND_SECONDS_BUCKETS, **labels):
+        return self._series("histogram", name, help, labels, lambda l: Histogram(l, buckets), buckets)
+
+    def snapshot(self):
+        """
+        {name: {labels: value}} of this process only, picklable; callback gauges are left out
+        since they read state the receiving process has itself
+        """
+        with self.lock:
+            families = [(name, list(family[3].values())) for name, family in self.families.items()]
+        return {
+            name: {metric.labels: metric.value() for metric in series if not isinstance(metric, _FunctionGauge)}
+            for name, series in families
+        }
+
+    def update_remote(self, source, snapshot):
+        with self.lock:
+            self.remote[source] = snapshot
+
+    def retire_remote(self, source):
+        """
+        a source stopped for good: keep its counters and histograms, drop its gauges
+        """
+        with self.lock:
+            snapshot = self.remote.pop(source, None)
+            if snapshot is None:
+                return
+            for name, values in snapshot.items():
+                family = self.families.get(name)
+                if family is None or family[0] == "gauge":
+                    continue
+                retired = self.retired.setdefault(name, {})
+                for labels, value in values.items():
+                    retired[labels] = _merge(retired.get(labels), value)
+
+    def collect(self):
+        """
+        {name: {labels: value}} summed over this process, the remote sources and retired ones
+        """
+        with self.lock:
+            families = {name: list(family[3].values()) for name, family in self.families.items()}
+            others = list(self.remote.values()) + [self.retired]
+        collected = {name: {metric.labels: metric.value() for metric in series} for name, series in families.items()}
+        for snapshot in others:
+            for name, values in snapshot.items():
+                family = collected.setdefault(name, {})
+                for labels, value in values.items():
+                    family[labels] = _merge(family.get(labels), value)
+        return collected
+
+    def render(self):
+        """
+        prometheus text exposition format (version 0.0.4)
+        """
+        lines = []
+        for name, values in sorted(self.collect().items()):
+            kind, help, buckets, _ = self.families[name]
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(values.items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def serve_metrics(stop_event, port, registry=None, host="127.0.0.1"):
+    """
+    serve GET /metrics in prometheus text format on host:port until stop_event is set
+    """
+    registry = registry if registry is not None else REGISTRY
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    server.timeout = METRICS_POLL_INTERVAL
+    try:
+        while not stop_event.is_set():
+            server.handle_request()
+    finally:
+        server.server_close()
+
+
+def publish_metrics(stop_event, queue, source, registry=None):
+    """
+    pre-fork worker side: send (source, snapshot) to the supervisor every METRICS_PUBLISH_INTERVAL
+    and once more when stop_event is set
+    """
+    registry = registry if registry is not None else REGISTRY
+    while not stop_event.wait(METRICS_PUBLISH_INTERVAL):
+        queue.put((source, registry.snapshot()))
+    queue.put((source, registry.snapshot()))
+
+
+REGISTRY = MetricsRegistry()
+
+TCP_REQUESTS = REGISTRY.counter("speedtest_requests_total", "Transfer requests received", protocol="tcp")
+UDP_REQUESTS = REGISTRY.counter("speedtest_requests_total", "Transfer requests received", protocol="udp")
+TCP_REJECTED = REGISTRY.counter("speedtest_requests_rejected_total", "Requests turned away by admission control",
+                                protocol="tcp")
+UDP_REJECTED = REGISTRY.counter("speedtest_requests_rejected_total", "Requests turned away by admission control",
+                                protocol="udp")
+TCP_ACTIVE = REGISTRY.gauge("speedtest_active_sessions", "Transfers being served", protocol="tcp")
+UDP_ACTIVE = REGISTRY.gauge("speedtest_active_sessions", "Transfers being served", protocol="udp")
+TCP_BYTES_SENT = REGISTRY.counter("speedtest_bytes_sent_total", "Payload bytes handed to the kernel", protocol="tcp")
+UDP_BYTES_SENT = REGISTRY.counter("speedtest_bytes_sent_total", "Payload bytes handed to the kernel", protocol="udp")
+UDP_SEGMENTS_SENT = REGISTRY.counter("speedtest_segments_sent_total", "UDP payload segments sent", protocol="udp")
+UDP_RETRANSMITTED = REGISTRY.counter("speedtest_segments_retransmitted_total",
+                                     "UDP payload segments sent again after a NACK", protocol="udp")
+TCP_SEND_SECONDS = REGISTRY.histogram("speedtest_send_seconds", "Duration of payload send syscalls", protocol="tcp")
+UDP_SEND_SECONDS = REGISTRY.histogram("speedtest_send_seconds", "Duration of payload send syscalls", protocol="udp")
+TCP_SEND_ERRORS = REGISTRY.counter("speedtest_send_errors_total", "Payload sends that failed", protocol="tcp")
+UDP_SEND_ERRORS = REGISTRY.counter("speedtest_send_errors_total", "Payload sends that failed", protocol="udp")
+TCP_SEND_EAGAIN = REGISTRY.counter("speedtest_send_eagain_total", "Payload sends that found the socket buffer full",
+                                   protocol="tcp")
+UDP_SEND_EAGAIN = REGISTRY.counter("speedtest_send_eagain_total", "Payload sends that found the socket buffer full",
+                                   protocol="udp")
+COMPRESS_SECONDS = REGISTRY.counter("speedtest_compress_cpu_seconds_total", "CPU time spent compressing payloads")
@@ -1,8 +1,13 @@
 import struct
+import zlib
 from constants import *
+# the wire layouts are defined once, next to their decoders
+from packetParser import (OFFER_MSG, REQUEST_MSG, REQUEST_EXTENSIONS, PAYLOAD_HEADER, CHECKED_PAYLOAD_HEADER,
+                          CHECKSUM_TRAILER, COMPRESSED_BLOCK_HEADER, COMPRESSED_STREAM_END, NACK_HEADER, NACK_RANGE,
+                          RESPONSE_HEADER, ERROR_MSG, PROBE_MSG, PROBE_REPLY_MSG)
 
 
-def build_offer_msg(server_udp_port, server_tcp_port):
+def build_offer_msg(server_udp_port, server_tcp_port, codecs=None):
     """
     build the 'offer' message (server -> client)
 
@@ -11,16 +16,21 @@ def build_offer_msg(server_udp_port, server_tcp_port):
       1 byte: message type (0x2)
       2 bytes: server udp port
       2 bytes: server tcp port
+      optional 1 byte: bitmask of the supported codecs (1 << CODEC_*), appended when codecs is given
     """
     # use big-endian (network byte order) for consistent packet structure
     # format '>I B H H' means:
     #   I = unsigned int (4 bytes) for magic cookie
     #   B = unsigned char (1 byte) for message type
     #   H = unsigned short (2 bytes) for udp and tcp ports
-    return struct.pack('>I B H H', MAGIC_COOKIE, OFFER_TYPE, server_udp_port, server_tcp_port)
+    message = OFFER_MSG.pack(MAGIC_COOKIE, OFFER_TYPE, server_udp_port, server_tcp_port)
+    if codecs is not None:
+        message += struct.pack('>B', codecs)
+    return message
 
 
-def build_request_msg(file_size):
+def build_request_msg(file_size, target_rate=0, flags=0, codec=CODEC_NONE, offset=0, segment_size=0, transfer_id=0,
+                      full=False):
     """
     build the 'request' message (client -> server)
 
@@ -28,12 +38,121 @@ def build_request_msg(file_size):
       4 bytes: magic cookie (0xabcddcba)
       1 byte: message type (0x3)
       8 bytes: file size
+      optional extension fields (see constants.REQUEST_EXTENSION_FIELDS):
+        8 bytes: target rate in bits/sec (0 = send as fast as possible)
+        1 byte: flags (REQUEST_FLAG_* bits)
+        1 byte: codec (CODEC_*) the payload should be compressed with
+        8 bytes: offset, position in the payload stream of the first byte to send (byte range requests)
+        2 bytes: udp segment size, payload bytes per datagram (0 = the server's default)
+        8 bytes: transfer id the client picked, pairs the packet traces of both ends (0 = none)
+
+    full=True always appends every extension field (the fields of a tcp header, see build_tcp_request_msg)
     """
     # format '>I B Q' means:
     #   I = unsigned int (4 bytes) for magic cookie
     #   B = unsigned char (1 byte) for message type
     #   Q = unsigned long (8 bytes) for file size
-    return struct.pack('>I B Q', MAGIC_COOKIE, REQUEST_TYPE, file_size)
+    message = REQUEST_MSG.pack(MAGIC_COOKIE, REQUEST_TYPE, file_size)
+
+    # only append extension fields up to the last non-default one
+    extensions = [target_rate, flags, codec, offset, segment_size, transfer_id]
+    while extensions and not extensions[-1] and not full:
+        extensions.pop()
+    for (_, field), value in zip(REQUEST_EXTENSIONS, extensions):
+        message += field.pack(value)
+    return message
+
+
+def build_tcp_request_msg(file_size, target_rate=0, flags=0, codec=CODEC_NONE, offset=0, segment_size=0):
+    """
+    build the binary request header a tcp client sends after connecting
+
+    tcp request header format:
+      the request message with every extension field, REQUEST_FLAG_SIZED set in its flags and
+      1 byte: length of the whole header, inserted right after the flags byte
+    the server reads exactly that many bytes, so a header with fields it does not know yet is
+    skipped over and the next pipelined request stays in the socket
+    """
+    message = build_request_msg(file_size, target_rate, flags | REQUEST_FLAG_SIZED, codec, offset, segment_size,
+                                full=True)
+    split = TCP_REQUEST_LENGTH_OFFSET
+    return message[:split] + struct.pack('>B', len(message) + 1) + message[split:]
+
+
+def build_nack_msg(ranges):
+    """
+    build the 'nack' message (client -> server)
+
+    nack message format:
+      4 bytes: magic cookie (0xabcddcba)
+      1 byte: message type (0x5)
+      2 bytes: number of ranges n (at most NACK_MAX_RANGES)
+      n * 12 bytes: first missing segment (8 bytes) + number of missing segments (4 bytes)
+
+    a nack without ranges tells the server the transfer is complete
+    """
+    if len(ranges) > NACK_MAX_RANGES:
+        raise ValueError(f"a nack carries at most {NACK_MAX_RANGES} ranges, got {len(ranges)}")
+    message = NACK_HEADER.pack(MAGIC_COOKIE, NACK_TYPE, len(ranges))
+    for first, length in ranges:
+        message += NACK_RANGE.pack(first, length)
+    return message
+
+
+def build_response_header(length):
+    """
+    build the 'response' frame header (server -> client, tcp keep-alive sessions)
+
+    response header format:
+      4 bytes: magic cookie (0xabcddcba)
+      1 byte: message type (0x6)
+      8 bytes: length of the payload that follows (without the checksum trailer of a checked request)
+    """
+    return RESPONSE_HEADER.pack(MAGIC_COOKIE, RESPONSE_TYPE, length)
+
+
+def build_error_msg(error_code, retry_after=0.0):
+    """
+    build the 'error' message (server -> client), the answer to a rejected request
+
+    error message format:
+      4 bytes: magic cookie (0xabcddcba)
+      1 byte: message type (0x7)
+      1 byte: error code (ERROR_*)
+      4 bytes: milliseconds the client should wait before retrying (0 = do not retry)
+    """
+    return ERROR_MSG.pack(MAGIC_COOKIE, ERROR_TYPE, error_code, int(retry_after * 1000))
+
+
+def build_probe_msg(token):
+    """
+    build the 'probe' message (client -> server), asking every server that gets it for a probe reply
+
+    probe message format:
+      4 bytes: magic cookie (0xabcddcba)
+      1 byte: message type (0x9)
+      8 bytes: token, echoed in the reply (the client times round trips with it)
+    """
+    return PROBE_MSG.pack(MAGIC_COOKIE, PROBE_TYPE, token)
+
+
+def build_probe_reply_msg(token, server_udp_port, server_tcp_port, codecs, in_flight=0, max_transfers=0, flags=0):
+    """
+    build the 'probe reply' message (server -> client, unicast to the sender of a probe)
+
+    probe reply message format:
+      4 bytes: magic cookie (0xabcddcba)
+      1 byte: message type (0xa)
+      8 bytes: token of the probe
+      2 bytes: server udp port
+      2 bytes: server tcp port
+      1 byte: bitmask of the supported codecs (1 << CODEC_*)
+      4 bytes: transfers in flight
+      4 bytes: transfers the server admits at once (0 = unlimited)
+      1 byte: PROBE_REPLY_* flags
+    """
+    return PROBE_REPLY_MSG.pack(MAGIC_COOKIE, PROBE_REPLY_TYPE, token, server_udp_port, server_tcp_port, codecs,
+                                min(in_flight, 0xffffffff), min(max_transfers, 0xffffffff), flags)
 
 
 def build_payload_msg(total_segments, current_segment, payload):
@@ -52,7 +171,74 @@ def build_payload_msg(total_segments, current_segment, payload):
     #   B = unsigned char (1 byte) for message type
     #   Q = unsigned long (8 bytes) for total segments
     #   Q = unsigned long (8 bytes) for current segment number
-    header = struct.pack('>I B Q Q', MAGIC_COOKIE, PAYLOAD_TYPE, total_segments, current_segment)
+    header = PAYLOAD_HEADER.pack(MAGIC_COOKIE, PAYLOAD_TYPE, total_segments, current_segment)
 
     # append the payload to the header
     return header + payload
+
+
+def pack_payload_header_into(buffer, offset, total_segments, current_segment):
+    """
+    write a 'payload' message header into buffer at offset, in place
+
+    same layout as build_payload_msg, for senders that keep the payload bytes in a reusable
+    buffer and only rewrite the 21 header bytes in front of each segment
+    """
+    PAYLOAD_HEADER.pack_into(buffer, offset, MAGIC_COOKIE, PAYLOAD_TYPE, total_segments, current_segment)
+
+
+def build_checked_payload_msg(total_segments, current_segment, payload):
+    """
+    build the 'checked payload' message (server -> client), sent to requests with REQUEST_FLAG_CHECKSUM
+
+    checked payload message format:
+      4 bytes: magic cookie (0xabcddcba)
+      1 byte: message type (0x8)
+      8 bytes: total segment count
+      8 bytes: current segment number
+      4 bytes: crc32 of the payload
+      variable: payload
+    """
+    header = CHECKED_PAYLOAD_HEADER.pack(MAGIC_COOKIE, CHECKED_PAYLOAD_TYPE, total_segments, current_segment,
+                                         zlib.crc32(payload))
+    return header + payload
+
+
+def pack_checked_payload_header_into(buffer, offset, total_segments, current_segment, checksum):
+    """
+    write a 'checked payload' message header (25 bytes) into buffer at offset, in place
+    """
+    CHECKED_PAYLOAD_HEADER.pack_into(buffer, offset, MAGIC_COOKIE, CHECKED_PAYLOAD_TYPE, total_segments,
+                                     current_segment, checksum)
+
+
+def build_compressed_block(data):
+    """
+    frame one block of a compressed tcp response body (compressed responses have no known length)
+
+    compressed body format:
+      any number of blocks:
+        4 bytes: block length n (> 0)
+        n bytes: output of the codec's stream compressor, decodable as soon as it arrives
+      end of body:
+        4 bytes: 0
+        4 bytes: cpu time the server spent compressing the body, in microseconds
+
+    the response frame header of a keep-alive session and the crc32 of a checksum trailer both
+    refer to the uncompressed bytes
+    """
+    return COMPRESSED_BLOCK_HEADER.pack(len(data)) + data
+
+
+def build_compressed_stream_end(cpu_seconds):
+    """
+    build the end of a compressed tcp response body (see build_compressed_block)
+    """
+    return COMPRESSED_STREAM_END.pack(0, min(int(cpu_seconds * 1e6), 0xffffffff))
+
+
+def build_checksum_trailer(checksum):
+    """
+    build the 4 byte crc32 trailer that follows the payload of a checked tcp response
+    """
+    return CHECKSUM_TRAILER.pack(checksum)
@@ -1,8 +1,38 @@
 import struct
 from Exceptions import *
-from ANSI import ANSI
 from constants import *
 
+# precompiled wire layouts, shared by every parser below and by the encoders in packetBuilder
+MESSAGE_PREFIX = struct.Struct('>I B')
+OFFER_MSG = struct.Struct('>I B H H')
+REQUEST_MSG = struct.Struct('>I B Q')
+PAYLOAD_HEADER = struct.Struct('>I B Q Q')
+PAYLOAD_HEADER_SIZE = PAYLOAD_HEADER.size
+CHECKED_PAYLOAD_HEADER = struct.Struct('>I B Q Q I')  # a payload header followed by the crc32 of the payload
+CHECKED_PAYLOAD_HEADER_SIZE = CHECKED_PAYLOAD_HEADER.size
+CHECKSUM_TRAILER = struct.Struct('>I')
+CHECKSUM_TRAILER_SIZE = CHECKSUM_TRAILER.size
+COMPRESSED_BLOCK_HEADER = struct.Struct('>I')
+COMPRESSED_BLOCK_HEADER_SIZE = COMPRESSED_BLOCK_HEADER.size
+COMPRESSED_STREAM_END = struct.Struct('>I I')
+NACK_HEADER = struct.Struct('>I B H')
+NACK_RANGE = struct.Struct('>Q I')
+RESPONSE_HEADER = struct.Struct('>I B Q')
+RESPONSE_HEADER_SIZE = RESPONSE_HEADER.size
+ERROR_MSG = struct.Struct('>I B B I')
+ERROR_MSG_SIZE = ERROR_MSG.size
+PROBE_MSG = struct.Struct('>I B Q')
+PROBE_REPLY_MSG = struct.Struct('>I B Q H H B I I B')
+REQUEST_EXTENSIONS = tuple((name, struct.Struct(fmt)) for name, fmt in REQUEST_EXTENSION_FIELDS)
+
+# a binary tcp request header is a request message with every extension field present and a length
+# byte after its flags (see packetBuilder.build_tcp_request_msg); TCP_REQUEST_SIZE is the header this
+# version sends, a header may be anything up to TCP_REQUEST_MAX_SIZE
+TCP_REQUEST_SIZE = REQUEST_MSG.size + sum(field.size for _, field in REQUEST_EXTENSIONS) + 1
+TCP_REQUEST_MAX_SIZE = 0xff
+TCP_LEGACY_MAX_SIZE = 32  # ascii digits, whitespace and the newline of a legacy header
+_LEGACY_HEADER_START = b'0123456789 \t\r\n'
+
 def parse_udp_packet(data):
     """
     parse an incoming udp datagram according to your custom protocol
@@ -13,11 +43,24 @@ def parse_udp_packet(data):
       => then it branches based on message type:
 
       - offer (0x2):
-          total length = 9 bytes (4 cookie + 1 type + 2 udp port + 2 tcp port)
+          total length = 9 or 10 bytes (4 cookie + 1 type + 2 udp port + 2 tcp port + optional codec bitmask)
       - request (0x3):
-          total length = 13 bytes (4 cookie + 1 type + 8 file size)
+          total length >= 13 bytes (4 cookie + 1 type + 8 file size + optional extension fields)
       - payload (0x4):
           total length = >= 21 bytes (4 cookie + 1 type + 8 total seg + 8 curr seg + payload)
+      - nack (0x5):
+          total length = 7 + 12 * n bytes (4 cookie + 1 type + 2 range count + n * (8 first + 4 length))
+      - response (0x6, tcp frame header):
+          total length = 13 bytes (4 cookie + 1 type + 8 payload length)
+      - error (0x7):
+          total length = 10 bytes (4 cookie + 1 type + 1 error code + 4 retry after in ms)
+      - checked payload (0x8):
+          total length = >= 25 bytes (4 cookie + 1 type + 8 total seg + 8 curr seg + 4 crc32 + payload)
+      - probe (0x9):
+          total length = 13 bytes (4 cookie + 1 type + 8 token)
+      - probe reply (0xa):
+          total length = 27 bytes (4 cookie + 1 type + 8 token + 2 udp port + 2 tcp port + 1 codec bitmask
+          + 4 transfers in flight + 4 max transfers + 1 flags)
 
     raises:
       packettooshorterror, cookiemismatcherror, unknownmessagetypeerror
@@ -25,52 +68,57 @@ def parse_udp_packet(data):
       a dict with parsed fields if successful
     """
     # check minimum length for magic cookie + message type
-    if len(data) < 5:
-        error_msg = f"{ANSI.FAIL}received only {len(data)} bytes, but need at least 5 for header{ANSI.ENDC}"
-        raise PacketTooShortError(error_msg)
+    if len(data) < MESSAGE_PREFIX.size:
+        raise PacketTooShortError(len(data), MESSAGE_PREFIX.size)
 
     # unpack the first 5 bytes
-    cookie, msg_type = struct.unpack('>I B', data[:5])
+    cookie, msg_type = MESSAGE_PREFIX.unpack_from(data)
 
     # validate the magic cookie
     if cookie != MAGIC_COOKIE:
-        error_msg = (
-            f"{ANSI.FAIL}magic cookie mismatch: expected 0x{MAGIC_COOKIE:x}, got 0x{cookie:x}{ANSI.ENDC}"
-        )
         raise CookieMismatchError(expected_cookie=MAGIC_COOKIE, actual_cookie=cookie)
 
     # branch on message type
     if msg_type == OFFER_TYPE:
         # offer: total 9 bytes
-        if len(data) < 9:
-            error_msg = f"{ANSI.FAIL}offer packet requires 9 bytes, got {len(data)} bytes{ANSI.ENDC}"
-            raise PacketTooShortError(error_msg)
+        if len(data) < OFFER_MSG.size:
+            raise PacketTooShortError(len(data), OFFER_MSG.size)
         # unpack the entire offer packet
-        _, _, server_udp_port, server_tcp_port = struct.unpack('>I B H H', data[:9])
+        _, _, server_udp_port, server_tcp_port = OFFER_MSG.unpack_from(data)
+        # servers that predate compression send no codec bitmask: uncompressed only
+        codecs = data[OFFER_MSG.size] if len(data) > OFFER_MSG.size else 1 << CODEC_NONE
         return {
             'message_type': OFFER_TYPE,
             'server_udp_port': server_udp_port,
-            'server_tcp_port': server_tcp_port
+            'server_tcp_port': server_tcp_port,
+            'codecs': codecs
         }
 
     elif msg_type == REQUEST_TYPE:
-        # request: total 13 bytes
-        if len(data) < 13:
-            error_msg = f"{ANSI.FAIL}request packet requires 13 bytes, got {len(data)} bytes{ANSI.ENDC}"
-            raise PacketTooShortError(error_msg)
-        _, _, file_size = struct.unpack('>I B Q', data[:13])
-        return {
+        # request: at least 13 bytes
+        if len(data) < REQUEST_MSG.size:
+            raise PacketTooShortError(len(data), REQUEST_MSG.size)
+        _, _, file_size = REQUEST_MSG.unpack_from(data)
+        result = {
             'message_type': REQUEST_TYPE,
             'file_size': file_size
         }
+        # optional trailing fields, missing ones take their default of 0
+        offset = REQUEST_MSG.size
+        for name, field in REQUEST_EXTENSIONS:
+            if len(data) >= offset + field.size:
+                result[name] = field.unpack_from(data, offset)[0]
+            else:
+                result[name] = 0
+            offset += field.size
+        return result
 
     elif msg_type == PAYLOAD_TYPE:
         # payload: at least 21 bytes (4 + 1 + 8 + 8) + variable payload
-        if len(data) < 21:
-            error_msg = f"{ANSI.FAIL}payload packet requires at least 21 bytes, got {len(data)} bytes{ANSI.ENDC}"
-            raise PacketTooShortError(error_msg)
-        _, _, total_segments, current_segment = struct.unpack('>I B Q Q', data[:21])
-        payload = data[21:]  # the rest is the actual payload
+        if len(data) < PAYLOAD_HEADER_SIZE:
+            raise PacketTooShortError(len(data), PAYLOAD_HEADER_SIZE)
+        _, _, total_segments, current_segment = PAYLOAD_HEADER.unpack_from(data)
+        payload = data[PAYLOAD_HEADER_SIZE:]  # the rest is the actual payload
         return {
             'message_type': PAYLOAD_TYPE,
             'total_segments': total_segments,
@@ -79,7 +127,340 @@ def parse_udp_packet(data):
             'payload_size': len(payload)
         }
 
+    elif msg_type == NACK_TYPE:
+        # nack: 7 byte header followed by the missing segment ranges
+        if len(data) < NACK_HEADER.size:
+            raise PacketTooShortError(len(data), NACK_HEADER.size)
+        _, _, range_count = NACK_HEADER.unpack_from(data)
+        required = NACK_HEADER.size + range_count * NACK_RANGE.size
+        if len(data) < required:
+            raise PacketTooShortError(len(data), required)
+        ranges = list(NACK_RANGE.iter_unpack(data[NACK_HEADER.size:required]))
+        return {
+            'message_type': NACK_TYPE,
+            'ranges': ranges
+        }
+
+    elif msg_type == RESPONSE_TYPE:
+        if len(data) < RESPONSE_HEADER_SIZE:
+            raise PacketTooShortError(len(data), RESPONSE_HEADER_SIZE)
+        _, _, length = RESPONSE_HEADER.unpack_from(data)
+        return {
+            'message_type': RESPONSE_TYPE,
+            'length': length
+        }
+
+    elif msg_type == ERROR_TYPE:
+        if len(data) < ERROR_MSG_SIZE:
+            raise PacketTooShortError(len(data), ERROR_MSG_SIZE)
+        _, _, error_code, retry_after_ms = ERROR_MSG.unpack_from(data)
+        return {
+            'message_type': ERROR_TYPE,
+            'error_code': error_code,
+            'retry_after': retry_after_ms / 1000
+        }
+
+    elif msg_type == CHECKED_PAYLOAD_TYPE:
+        if len(data) < CHECKED_PAYLOAD_HEADER_SIZE:
+            raise PacketTooShortError(len(data), CHECKED_PAYLOAD_HEADER_SIZE)
+        _, _, total_segments, current_segment, checksum = CHECKED_PAYLOAD_HEADER.unpack_from(data)
+        payload = data[CHECKED_PAYLOAD_HEADER_SIZE:]
+        return {
+            'message_type': CHECKED_PAYLOAD_TYPE,
+            'total_segments': total_segments,
+            'current_segment': current_segment,
+            'checksum': checksum,
+            'payload': payload,
+            'payload_size': len(payload)
+        }
+
+    elif msg_type == PROBE_TYPE:
+        if len(data) < PROBE_MSG.size:
+            raise PacketTooShortError(len(data), PROBE_MSG.size)
+        _, _, token = PROBE_MSG.unpack_from(data)
+        return {
+            'message_type': PROBE_TYPE,
+            'token': token
+        }
+
+    elif msg_type == PROBE_REPLY_TYPE:
+        if len(data) < PROBE_REPLY_MSG.size:
+            raise PacketTooShortError(len(data), PROBE_REPLY_MSG.size)
+        _, _, token, server_udp_port, server_tcp_port, codecs, in_flight, max_transfers, flags = \
+            PROBE_REPLY_MSG.unpack_from(data)
+        return {
+            'message_type': PROBE_REPLY_TYPE,
+            'token': token,
+            'server_udp_port': server_udp_port,
+            'server_tcp_port': server_tcp_port,
+            'codecs': codecs,
+            'in_flight': in_flight,
+            'max_transfers': max_transfers,
+            'saturated': bool(flags & PROBE_REPLY_SATURATED)
+        }
+
     else:
         # unknown or unsupported message type
-        error_msg = f"{ANSI.FAIL}message type 0x{msg_type:x} is not recognized{ANSI.ENDC}"
-        raise UnknownMessageTypeError(error_msg)
+        raise UnknownMessageTypeError(msg_type)
+
+
+def tcp_request_remaining(header):
+    """
+    how many more bytes the tcp request header begun with the bytes in header may need at most,
+    so a reader can recv_into exactly that much and never take bytes of the next pipelined request
+    (call parse_tcp_request first, it rejects the headers this cannot size)
+    """
+    if header and header[0] in _LEGACY_HEADER_START:
+        return TCP_LEGACY_MAX_SIZE - len(header)
+    if len(header) <= TCP_REQUEST_LENGTH_OFFSET:
+        return TCP_REQUEST_LENGTH_OFFSET + 1 - len(header)
+    return header[TCP_REQUEST_LENGTH_OFFSET] - len(header)
+
+
+def parse_tcp_request(header):
+    """
+    parse the request header a tcp client sends after connecting, from the bytes received so far
+
+    two formats are accepted, told apart by the first byte (the magic cookie starts with 0xab):
+      - binary: a request message with every extension field, REQUEST_FLAG_SIZED set and a length
+        byte after the flags; fields after the ones this version knows are skipped, missing ones
+        take their default of 0
+      - legacy: the file size as ascii digits terminated by a newline
+
+    a binary header without REQUEST_FLAG_SIZED comes from a client older than the length byte, its
+    size is unknown, so it is rejected as soon as its flags arrived instead of waited for
+
+    raises:
+      packetparsingerror (and the parse_udp_packet errors) for malformed headers
+    returns:
+      the request dict (same fields as parse_udp_packet) once the header is complete, else None
+    """
+    if not header:
+        return None
+
+    if header[0] not in _LEGACY_HEADER_START:
+        if len(header) < TCP_REQUEST_LENGTH_OFFSET:
+            return None
+        cookie, msg_type = MESSAGE_PREFIX.unpack_from(header)
+        if cookie != MAGIC_COOKIE:
+            raise CookieMismatchError(expected_cookie=MAGIC_COOKIE, actual_cookie=cookie)
+        if msg_type != REQUEST_TYPE:
+            raise PacketParsingError(f"expected a request header, got message type 0x{msg_type:x}")
+        if not header[TCP_REQUEST_LENGTH_OFFSET - 1] & REQUEST_FLAG_SIZED:
+            raise PacketParsingError("binary request header without a length (REQUEST_FLAG_SIZED), "
+                                     "sent by a client older than versioned headers")
+        if len(header) == TCP_REQUEST_LENGTH_OFFSET:
+            return None
+        length = header[TCP_REQUEST_LENGTH_OFFSET]
+        if length <= TCP_REQUEST_LENGTH_OFFSET:
+            raise PacketTooShortError(length, TCP_REQUEST_LENGTH_OFFSET + 1)
+        if len(header) < length:
+            return None
+        # without its length byte the header is a request message
+        result = parse_udp_packet(bytes(header[:TCP_REQUEST_LENGTH_OFFSET])
+                                  + bytes(header[TCP_REQUEST_LENGTH_OFFSET + 1:length]))
+        result['flags'] &= ~REQUEST_FLAG_SIZED
+        return result
+
+    end = header.find(b'\n')
+    if end < 0:
+        if len(header) >= TCP_LEGACY_MAX_SIZE:
+            raise PacketParsingError(f"legacy request header longer than {TCP_LEGACY_MAX_SIZE} bytes")
+        return None
+    file_size_str = bytes(header[:end]).strip().decode(errors='replace')
+    try:
+        file_size = int(file_size_str)
+    except ValueError:
+        raise PacketParsingError(f"Invalid file size '{file_size_str}'")
+    result = {'message_type': REQUEST_TYPE, 'file_size': file_size}
+    result.update((name, 0) for name, _ in REQUEST_EXTENSION_FIELDS)
+    return result
+
+
+def unpack_payload_header(buffer, nbytes):
+    """
+    validate and unpack the header of a 'payload' message sitting at the start of buffer,
+    in place with struct.unpack_from, without slicing or copying the payload
+
+    nbytes is the datagram length (the buffer itself may be larger, e.g. a recv_into target)
+
+    raises:
+      packettooshorterror, cookiemismatcherror
+    returns:
+      (total_segments, current_segment), or None if the datagram is not a payload message
+    """
+    if nbytes < PAYLOAD_HEADER_SIZE:
+        raise PacketTooShortError(nbytes, PAYLOAD_HEADER_SIZE)
+
+    cookie, msg_type, total_segments, current_segment = PAYLOAD_HEADER.unpack_from(buffer)
+    if cookie != MAGIC_COOKIE:
+        raise CookieMismatchError(expected_cookie=MAGIC_COOKIE, actual_cookie=cookie)
+    if msg_type != PAYLOAD_TYPE:
+        return None
+    return total_segments, current_segment
+
+
+def unpack_checked_payload_header(buffer, nbytes):
+    """
+    unpack_payload_header for 'checked payload' messages
+
+    returns:
+      (total_segments, current_segment, checksum), or None if the datagram is not a checked payload
+    """
+    if nbytes < CHECKED_PAYLOAD_HEADER_SIZE:
+        raise PacketTooShortError(nbytes, CHECKED_PAYLOAD_HEADER_SIZE)
+
+    cookie, msg_type, total_segments, current_segment, checksum = CHECKED_PAYLOAD_HEADER.unpack_from(buffer)
+    if cookie != MAGIC_COOKIE:
+        raise CookieMismatchError(expected_cookie=MAGIC_COOKIE, actual_cookie=cookie)
+    if msg_type != CHECKED_PAYLOAD_TYPE:
+        return None
+    return total_segments, current_segment, checksum
+
+
+def unpack_response_header(buffer):
+    """
+    validate a 'response' frame header at the start of buffer and return the payload length
+
+    raises:
+      cookiemismatcherror, requestrejectederror (an error message instead of a response),
+      packetparsingerror (not a response header)
+    """
+    cookie, msg_type, length = RESPONSE_HEADER.unpack_from(buffer)
+    if cookie != MAGIC_COOKIE:
+        raise CookieMismatchError(expected_cookie=MAGIC_COOKIE, actual_cookie=cookie)
+    if msg_type == ERROR_TYPE:
+        raise rejection_error(buffer)
+    if msg_type != RESPONSE_TYPE:
+        raise PacketParsingError(f"expected a response header, got message type 0x{msg_type:x}")
+    return length
+
+
+def rejection_error(data):
+    """
+    the requestrejectederror described by an error message at the start of data,
+    or None if data is not an error message
+    """
+    if len(data) < ERROR_MSG_SIZE:
+        return None
+    try:
+        result = parse_udp_packet(bytes(data[:ERROR_MSG_SIZE]))
+    except PacketParsingError:
+        return None
+    if result['message_type'] != ERROR_TYPE:
+        return None
+    return RequestRejectedError(result['error_code'], result['retry_after'])
+
+
+class PacketView:
+    """
+    header of one datagram decoded by parse_packet_view, referring to (not copying) its buffer
+
+    payload messages (the per-packet hot path) fill total_segments, current_segment and
+    payload_size; payload is a memoryview of the receive buffer, made only when asked for and
+    only valid until the buffer is reused. checked payload messages also fill checksum (None
+    for any other type). any other message type is decoded by parse_udp_packet and its dict is
+    kept in control
+
+    a view can be handed back to parse_packet_view to be refilled, so a receive loop over a
+    ring of buffers decodes every datagram without allocating
+    """
+    __slots__ = ('message_type', 'total_segments', 'current_segment', 'checksum', 'buffer', 'nbytes', 'control')
+
+    def __init__(self):
+        self.message_type = None
+        self.total_segments = 0
+        self.current_segment = 0
+        self.checksum = None
+        self.buffer = None
+        self.nbytes = 0
+        self.control = None
+
+    @property
+    def payload_size(self):
+        header_size = _PAYLOAD_HEADER_SIZES.get(self.message_type)
+        return self.nbytes - header_size if header_size else 0
+
+    @property
+    def payload(self):
+        header_size = _PAYLOAD_HEADER_SIZES.get(self.message_type)
+        if not header_size:
+            return None
+        return memoryview(self.buffer)[header_size:self.nbytes]
+
+
+_PAYLOAD_HEADER_SIZES = {PAYLOAD_TYPE: PAYLOAD_HEADER_SIZE, CHECKED_PAYLOAD_TYPE: CHECKED_PAYLOAD_HEADER_SIZE}
+
+
+def parse_packet_view(buffer, nbytes=None, view=None):
+    """
+    allocation-free alternative to parse_udp_packet: decodes the header with a precompiled
+    struct and unpack_from, without slicing the datagram or building a dict
+
+    buffer is a bytes object (recvfrom) or a reused bytearray (recv_into), of which only the
+    first nbytes (default: all of it) belong to the datagram. view is a PacketView to refill
+    instead of creating a new one
+
+    raises:
+      the same errors as parse_udp_packet
+    returns:
+      the PacketView
+    """
+    if nbytes is None:
+        nbytes = len(buffer)
+    if view is None:
+        view = PacketView()
+    view.buffer = buffer
+    view.nbytes = nbytes
+    if nbytes >= PAYLOAD_HEADER_SIZE:
+        cookie, msg_type, view.total_segments, view.current_segment = PAYLOAD_HEADER.unpack_from(buffer)
+        if cookie == MAGIC_COOKIE and msg_type == PAYLOAD_TYPE:
+            view.message_type = PAYLOAD_TYPE
+            view.checksum = None
+            view.control = None
+            return view
+        # a checked payload header is a payload header followed by the crc32
+        if cookie == MAGIC_COOKIE and msg_type == CHECKED_PAYLOAD_TYPE and nbytes >= CHECKED_PAYLOAD_HEADER_SIZE:
+            view.message_type = CHECKED_PAYLOAD_TYPE
+            view.checksum = CHECKSUM_TRAILER.unpack_from(buffer, PAYLOAD_HEADER_SIZE)[0]
+            view.control = None
+            return view
+
+    # control messages (and malformed datagrams) are rare, they take the dict parser
+    view.control = parse_udp_packet(bytes(buffer[:nbytes]))
+    view.message_type = view.control['message_type']
+    view.checksum = None
+    return view
+
+
+def parse_packet_batch(buffers, sizes=None, views=None):
+    """
+    parse_packet_view over a batch of datagrams (e.g. a recv_into ring), sizes[i] being the
+    length of buffers[i]; views is an optional list of PacketViews to refill, one per buffer
+    malformed datagrams yield None instead of aborting the batch
+    """
+    if sizes is None:
+        sizes = [len(buffer) for buffer in buffers]
+    if views is None:
+        views = [PacketView() for _ in buffers]
+    parsed = []
+    append = parsed.append
+    unpack_from = PAYLOAD_HEADER.unpack_from
+    for buffer, nbytes, view in zip(buffers, sizes, views):
+        if nbytes >= PAYLOAD_HEADER_SIZE:
+            cookie, msg_type, total_segments, current_segment = unpack_from(buffer)
+            if cookie == MAGIC_COOKIE and msg_type == PAYLOAD_TYPE:
+                view.message_type = PAYLOAD_TYPE
+                view.total_segments = total_segments
+                view.current_segment = current_segment
+                view.checksum = None
+                view.buffer = buffer
+                view.nbytes = nbytes
+                view.control = None
+                append(view)
+                continue
+        try:
+            append(parse_packet_view(buffer, nbytes, view))
+        except PacketParsingError:
+            append(None)
+    return parsed
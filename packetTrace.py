@@ -0,0 +1,420 @@
+import argparse
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from time import perf_counter_ns
+from transferStats import distribution, SAMPLE_INTERVAL_NS
+from ANSI import ANSI
+
+# trace file layout: one header, then fixed-size records in the order they were written
+#   header: magic, version, direction (TRACE_SEND / TRACE_RECEIVE), perf_counter_ns and time_ns
+#           read together when the trace was opened (the clock anchors), number of records,
+#           transfer id of the request, total segments and segment size of the transfer
+#   record: segment number, perf_counter_ns of the send / arrival, payload bytes, TRACE_* flags
+TRACE_MAGIC = b'PTRC'
+TRACE_VERSION = 2
+TRACE_HEADER = struct.Struct('<4s H B x q q Q Q Q I 4x')
+TRACE_RECORD = struct.Struct('<Q q I I')
+TRACE_INITIAL_RECORDS = 65536  # 1.5 MiB; the file doubles whenever it fills up
+
+TRACE_SEND = 1
+TRACE_RECEIVE = 2
+TRACE_DIRECTIONS = {TRACE_SEND: "send", TRACE_RECEIVE: "receive"}
+
+# record flags
+TRACE_DUPLICATE = 0x1  # receive: the segment had already arrived
+TRACE_CORRUPT = 0x2  # receive: failed its crc32 or did not decompress, not counted as arrived
+TRACE_RETRANSMIT = 0x4  # send: a nacked segment sent again
+
+TRACE_BURSTS_LISTED = 20  # loss bursts listed one by one in a report, the rest only count
+
+_pack_record = TRACE_RECORD.pack_into
+_RECORD_SIZE = TRACE_RECORD.size
+_MISSING_RUNS = re.compile(rb'\x00+')
+
+
+class TraceRecorder:
+    """
+    appends one record per udp packet to a memory-mapped trace file
+
+    a record is a single pack_into at the end of the mapping plus one perf_counter_ns call, no
+    allocation and no syscall per packet; the file grows (mremap) in doubling steps. the
+    record count of the header is only written by close, a trace whose writer died keeps its
+    records (read_trace stops at the first unwritten one) and, once set_transfer was called,
+    the description of its transfer
+
+    close may be called from another thread to shut a trace down, but not while that thread
+    still records into it
+    """
+    __slots__ = ('path', 'direction', 'transfer_id', 'file', 'map', 'offset', 'end', 'clock_ns', 'wall_ns',
+                 'total_segments', 'segment_size', 'lock')
+
+    def __init__(self, path, direction, transfer_id=0, capacity=TRACE_INITIAL_RECORDS):
+        self.path = path
+        self.direction = direction
+        self.transfer_id = transfer_id
+        self.lock = threading.Lock()
+        self.file = open(path, 'w+b')
+        self.end = TRACE_HEADER.size + capacity * _RECORD_SIZE
+        self.file.truncate(self.end)
+        self.map = mmap.mmap(self.file.fileno(), self.end)
+        self.offset = TRACE_HEADER.size
+        self.wall_ns = time.time_ns()
+        self.clock_ns = perf_counter_ns()
+        self.total_segments = 0
+        self.segment_size = 0
+        self._write_header(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, segment, size, flags=0):
+        """
+        one packet of size payload bytes, timestamped now
+        """
+        offset = self.offset
+        if offset == self.end:
+            self._grow()
+        _pack_record(self.map, offset, segment, perf_counter_ns(), size, flags)
+        self.offset = offset + _RECORD_SIZE
+
+    def record_burst(self, segments, sizes, flags=0):
+        """
+        the segments of one send syscall (a gso burst), sharing one timestamp
+        """
+        now = perf_counter_ns()
+        for segment, size in zip(segments, sizes):
+            if self.offset == self.end:
+                self._grow()
+            _pack_record(self.map, self.offset, segment, now, size, flags)
+            self.offset += _RECORD_SIZE
+
+    def set_transfer(self, total_segments, segment_size):
+        """
+        describe the transfer in the header, written right away
+        """
+        self.total_segments = total_segments
+        self.segment_size = segment_size
+        with self.lock:
+            if self.map is not None:
+                self._write_header(0)
+
+    @property
+    def records(self):
+        return (self.offset - TRACE_HEADER.size) // _RECORD_SIZE
+
+    def _grow(self):
+        self.end = TRACE_HEADER.size + 2 * (self.end - TRACE_HEADER.size)
+        self.map.resize(self.end)
+
+    def _write_header(self, records):
+        TRACE_HEADER.pack_into(self.map, 0, TRACE_MAGIC, TRACE_VERSION, self.direction, self.clock_ns, self.wall_ns,
+                               records, self.transfer_id, self.total_segments, self.segment_size)
+
+    def close(self):
+        """
+        complete the header and cut the file to the records written, once
+        """
+        with self.lock:
+            if self.map is None:
+                return
+            self._write_header(self.records)
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            self.file.truncate(self.offset)
+            self.file.close()
+
+
+def trace_path(directory, direction, transfer_id=0, addr=None):
+    """
+    file name of the trace of one udp transfer, named after the transfer id of its request on
+    both sides, so the send and receive traces of a transfer pair up by name wherever the
+    datagrams went through (nat, the impairment proxy): <dir>/udp-<id>.recv.trace on the client,
+    <dir>/udp-<id>.send.trace on the server. a request without an id (a client that does not
+    trace) names the send trace after the client's address, <dir>/udp-<ip>-<port>.send.trace
+    """
+    suffix = "recv" if direction == TRACE_RECEIVE else "send"
+    if transfer_id:
+        return os.path.join(directory, f"udp-{transfer_id:016x}.{suffix}.trace")
+    return os.path.join(directory, f"udp-{addr[0]}-{addr[1]}.{suffix}.trace")
+
+
+def paired_trace(path, trace):
+    """
+    the path of the other end's trace of the same transfer next to path, None if there is none
+    """
+    if not trace.transfer_id:
+        return None
+    direction = TRACE_SEND if trace.direction == TRACE_RECEIVE else TRACE_RECEIVE
+    other = trace_path(os.path.dirname(path), direction, trace.transfer_id)
+    return other if os.path.exists(other) else None
+
+
+class Trace:
+    """
+    a trace file read back: the header fields and the records as (segment, time_ns, size, flags)
+    """
+    __slots__ = ('direction', 'clock_ns', 'wall_ns', 'transfer_id', 'total_segments', 'segment_size', 'records')
+
+    def __init__(self, direction, clock_ns, wall_ns, transfer_id, total_segments, segment_size, records):
+        self.direction = direction
+        self.clock_ns = clock_ns
+        self.wall_ns = wall_ns
+        self.transfer_id = transfer_id
+        self.total_segments = total_segments
+        self.segment_size = segment_size
+        self.records = records
+
+    def wall_time_ns(self, clock_ns):
+        """
+        a record timestamp on the wall clock, to line up traces written by different processes
+        """
+        return self.wall_ns + (clock_ns - self.clock_ns)
+
+
+def read_trace(path):
+    """
+    raises valueerror for files that are not traces of this version
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < TRACE_HEADER.size:
+        raise ValueError(f"{path}: too short for a packet trace")
+    magic, version, direction, clock_ns, wall_ns, count, transfer_id, total_segments, segment_size = \
+        TRACE_HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC:
+        raise ValueError(f"{path}: not a packet trace")
+    if version != TRACE_VERSION:
+        raise ValueError(f"{path}: trace version {version}, expected {TRACE_VERSION}")
+
+    available = (len(data) - TRACE_HEADER.size) // _RECORD_SIZE
+    body = memoryview(data)[TRACE_HEADER.size:TRACE_HEADER.size + available * _RECORD_SIZE]
+    records = list(TRACE_RECORD.iter_unpack(body))
+    if count:
+        records = records[:count]
+    else:
+        # never closed: the records end where the zero-filled rest of the file begins
+        while records and not records[-1][1]:
+            records.pop()
+    return Trace(direction, clock_ns, wall_ns, transfer_id, total_segments, segment_size, records)
+
+
+def reorder_distances(records):
+    """
+    for every intact arrival behind the highest segment that arrived before it, how many
+    segments behind it is
+    """
+    distances = []
+    highest = -1
+    for segment, _, _, flags in records:
+        if flags:
+            continue
+        if segment < highest:
+            distances.append(highest - segment)
+        else:
+            highest = segment
+    return distances
+
+
+def loss_bursts(records, total_segments):
+    """
+    runs of segments that never arrived intact, as (first segment, length, arrival_ns), arrival_ns
+    being when the segment after the run arrived (None if it did not), i.e. when the hole showed
+    """
+    arrived = bytearray(total_segments)
+    first_arrival = {}
+    for segment, time_ns, _, flags in records:
+        if flags & TRACE_CORRUPT or segment >= total_segments:
+            continue
+        if not arrived[segment]:
+            arrived[segment] = 1
+            first_arrival[segment] = time_ns
+    return [(match.start(), match.end() - match.start(), first_arrival.get(match.end()))
+            for match in _MISSING_RUNS.finditer(arrived)]
+
+
+def inter_arrival_histogram(records):
+    """
+    gaps between consecutive records in microseconds: a log2 histogram {upper bound: count}
+    (gaps under 1 us fall in the 1 us bucket) and their distribution
+    """
+    histogram = {}
+    gaps = []
+    for previous, current in zip(records, records[1:]):
+        gap = (current[1] - previous[1]) / 1000
+        gaps.append(gap)
+        bound = 1 << max(0, int(gap)).bit_length()
+        histogram[bound] = histogram.get(bound, 0) + 1
+    return dict(sorted(histogram.items())), distribution(gaps)
+
+
+def throughput_series(records, interval_ns=SAMPLE_INTERVAL_NS):
+    """
+    bits/sec of the intact, first-time packets in every interval from the first record on
+    """
+    if not records:
+        return []
+    start = records[0][1]
+    buckets = [0] * ((records[-1][1] - start) // interval_ns + 1)
+    for _, time_ns, size, flags in records:
+        if not flags & (TRACE_DUPLICATE | TRACE_CORRUPT):
+            buckets[(time_ns - start) // interval_ns] += size
+    return [nbytes * 8e9 / interval_ns for nbytes in buckets]
+
+
+def align(send, receive, interval_ns=SAMPLE_INTERVAL_NS):
+    """
+    line up the send and receive trace of one transfer on the wall clock anchors of their
+    headers (exact on one host, offset by the clock skew between two): the one-way delay of
+    every segment sent once (to its first intact arrival) and the number of first transmissions
+    per send interval that were lost (never arrived, or were nacked and sent again), i.e. when
+    the lost segments were sent
+    """
+    first_sent = {}
+    retransmitted = set()
+    for segment, time_ns, _, flags in send.records:
+        if flags & TRACE_RETRANSMIT:
+            retransmitted.add(segment)
+        elif segment not in first_sent:
+            first_sent[segment] = send.wall_time_ns(time_ns)
+    delays = []
+    arrived = set()
+    for segment, time_ns, _, flags in receive.records:
+        if flags or segment in arrived:
+            continue
+        arrived.add(segment)
+        sent = first_sent.get(segment)
+        if sent is not None and segment not in retransmitted:
+            delays.append((receive.wall_time_ns(time_ns) - sent) / 1e6)
+
+    lost_per_interval = []
+    if first_sent:
+        start = min(first_sent.values())
+        lost_per_interval = [0] * ((max(first_sent.values()) - start) // interval_ns + 1)
+        for segment, sent in first_sent.items():
+            if segment not in arrived or segment in retransmitted:
+                lost_per_interval[(sent - start) // interval_ns] += 1
+    return {
+        "one_way_delay_ms": distribution(delays),
+        "lost_per_send_interval": lost_per_interval,
+    }
+
+
+def analyze(trace, send=None, interval_ns=SAMPLE_INTERVAL_NS):
+    """
+    the report of one trace; send is the matching send trace of a receive trace, for align
+    """
+    records = trace.records
+    total_segments = trace.total_segments or (max(record[0] for record in records) + 1 if records else 0)
+    histogram, gaps = inter_arrival_histogram(records)
+    report = {
+        "direction": TRACE_DIRECTIONS.get(trace.direction, trace.direction),
+        "transfer_id": f"{trace.transfer_id:016x}" if trace.transfer_id else None,
+        "records": len(records),
+        "total_segments": total_segments,
+        "segment_size": trace.segment_size,
+        "duration": (records[-1][1] - records[0][1]) / 1e9 if records else 0.0,
+        "inter_arrival_us": gaps,
+        "inter_arrival_histogram": histogram,
+        "interval_ms": interval_ns / 1e6,
+        "throughput": throughput_series(records, interval_ns),
+    }
+    if trace.direction == TRACE_SEND:
+        report["retransmitted"] = sum(1 for record in records if record[3] & TRACE_RETRANSMIT)
+        return report
+
+    distances = reorder_distances(records)
+    bursts = loss_bursts(records, total_segments)
+    start = records[0][1] if records else 0
+    received = sum(1 for record in records if not record[3])
+    report.update({
+        "received": received,
+        "duplicates": sum(1 for record in records if record[3] & TRACE_DUPLICATE),
+        "corrupt": sum(1 for record in records if record[3] & TRACE_CORRUPT),
+        "success_rate": received / total_segments * 100 if total_segments else 0.0,
+        "reordered": len(distances),
+        "reorder_distance": distribution(distances),
+        "loss_bursts": len(bursts),
+        "loss_burst_length": distribution([length for _, length, _ in bursts]),
+        "first_loss_bursts": [
+            {"first_segment": first, "length": length,
+             "seen_at_ms": (seen - start) / 1e6 if seen is not None else None}
+            for first, length, seen in bursts[:TRACE_BURSTS_LISTED]
+        ],
+    })
+    if send is not None:
+        report.update(align(send, trace, interval_ns))
+    return report
+
+
+def _format_distribution(summary, unit):
+    if not summary:
+        return "none"
+    return ", ".join(f"{key} {value:.3f}{unit}" if isinstance(value, float) else f"{key} {value}{unit}"
+                     for key, value in summary.items())
+
+
+def print_report(report):
+    transfer = f" of transfer {report['transfer_id']}" if report["transfer_id"] else ""
+    print(f"{ANSI.BOLD}{report['direction']} trace{transfer}: {report['records']} packets of "
+          f"{report['total_segments']} segments ({report['segment_size'] or '?'} bytes) over "
+          f"{report['duration']:.3f} seconds{ANSI.ENDC}")
+    if "received" in report:
+        print(f"received {report['received']} ({report['success_rate']:.2f}%), {report['duplicates']} duplicates, "
+              f"{report['corrupt']} corrupt")
+        print(f"reordered {report['reordered']}, distance: {_format_distribution(report['reorder_distance'], '')}")
+        print(f"loss bursts {report['loss_bursts']}, length: {_format_distribution(report['loss_burst_length'], '')}")
+        for burst in report["first_loss_bursts"]:
+            seen = f"{burst['seen_at_ms']:.3f} ms" if burst["seen_at_ms"] is not None else "never"
+            print(f"  segments {burst['first_segment']}..{burst['first_segment'] + burst['length'] - 1} "
+                  f"({burst['length']}), hole seen at {seen}")
+    if "retransmitted" in report:
+        print(f"retransmitted {report['retransmitted']}")
+    gap = "inter-arrival" if "received" in report else "inter-send"
+    print(f"{gap}: {_format_distribution(report['inter_arrival_us'], ' us')}")
+    print(f"{gap} histogram: " + ", ".join(f"<{bound} us {count}"
+                                          for bound, count in report["inter_arrival_histogram"].items()))
+    print(f"throughput per {report['interval_ms']:g} ms (bits/sec): "
+          + ", ".join(f"{rate:.0f}" for rate in report["throughput"]))
+    if "one_way_delay_ms" in report:
+        print(f"one-way delay: {_format_distribution(report['one_way_delay_ms'], ' ms')}")
+        print(f"lost first transmissions per {report['interval_ms']:g} ms of sending: "
+              + ", ".join(map(str, report["lost_per_send_interval"])))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline analysis of udp packet traces (--trace-dir)")
+    parser.add_argument("trace", help="a .recv.trace or .send.trace file")
+    parser.add_argument("--send", metavar="TRACE",
+                        help="the server's send trace of the same transfer, to align with a receive trace "
+                             "(default: the send trace with the same transfer id next to it, if any)")
+    parser.add_argument("--interval", type=float, default=SAMPLE_INTERVAL_NS / 1e6, metavar="MS",
+                        help="throughput and loss timeline bucket, in milliseconds")
+    parser.add_argument("--json", action="store_true", help="print the report as json")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    trace = read_trace(args.trace)
+    send_path = args.send
+    if send_path is None and trace.direction == TRACE_RECEIVE:
+        send_path = paired_trace(args.trace, trace)
+    send = read_trace(send_path) if send_path else None
+    report = analyze(trace, send, int(args.interval * 1e6))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
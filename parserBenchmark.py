@@ -0,0 +1,143 @@
+import argparse
+import json
+import sys
+import time
+import packetBuilder
+import packetParser
+from Server import UDP_CHUNK_SIZE
+from Client import UDP_RING_SIZE
+
+BATCH_SIZE = UDP_RING_SIZE  # datagrams per parse_packet_batch call, one receive ring
+
+
+def make_packets(count, payload_size):
+    """
+    count payload datagrams of one transfer, as received: bytes (recvfrom) and a ring of
+    bytearrays with their lengths (recv_into)
+    """
+    payload = b'X' * payload_size
+    packets = [packetBuilder.build_payload_msg(count, i, payload) for i in range(count)]
+    ring = [bytearray(packet) for packet in packets]
+    return packets, ring, [len(packet) for packet in packets]
+
+
+def bench_dict(packets, ring, sizes):
+    parse = packetParser.parse_udp_packet
+    total = 0
+    for packet in packets:
+        total += len(parse(packet)['payload'])
+    return total
+
+
+def bench_view(packets, ring, sizes):
+    parse = packetParser.parse_packet_view
+    total = 0
+    for packet in packets:
+        total += parse(packet).payload_size
+    return total
+
+
+def bench_view_reuse(packets, ring, sizes):
+    parse = packetParser.parse_packet_view
+    view = packetParser.PacketView()
+    total = 0
+    for buffer, nbytes in zip(ring, sizes):
+        total += parse(buffer, nbytes, view).payload_size
+    return total
+
+
+def bench_batch(packets, ring, sizes):
+    parse_batch = packetParser.parse_packet_batch
+    views = [packetParser.PacketView() for _ in range(BATCH_SIZE)]
+    total = 0
+    for start in range(0, len(ring), BATCH_SIZE):
+        for view in parse_batch(ring[start:start + BATCH_SIZE], sizes[start:start + BATCH_SIZE], views):
+            total += view.nbytes - packetParser.PAYLOAD_HEADER_SIZE
+    return total
+
+
+def bench_header(packets, ring, sizes):
+    unpack = packetParser.unpack_payload_header
+    header_size = packetParser.PAYLOAD_HEADER_SIZE
+    total = 0
+    for buffer, nbytes in zip(ring, sizes):
+        unpack(buffer, nbytes)
+        total += nbytes - header_size
+    return total
+
+
+def check_malformed():
+    """
+    the batch parser must skip malformed datagrams (short, wrong cookie, unknown message type)
+    with None and keep parsing the rest of the batch
+    """
+    good = packetBuilder.build_payload_msg(1, 0, b'X')
+    malformed = [b'\xab\xcd', b'\x00\x00\x00\x00\x04', b'\xab\xcd\xdc\xba\x99']
+    parsed = packetParser.parse_packet_batch(malformed + [good])
+    if parsed[:-1] != [None] * len(malformed) or parsed[-1] is None:
+        raise AssertionError(f"parse_packet_batch did not skip malformed datagrams: {parsed}")
+
+
+PARSERS = {
+    "dict": bench_dict,  # parse_udp_packet: format decode, payload copy and a dict per packet
+    "view": bench_view,  # parse_packet_view on the bytes of recvfrom, a new view per packet
+    "view-reuse": bench_view_reuse,  # parse_packet_view refilling one view, recv_into buffers
+    "batch": bench_batch,  # parse_packet_batch over BATCH_SIZE buffers at a time, views reused
+    "header": bench_header,  # unpack_payload_header, the tuple-only path of the fast receiver
+}
+
+
+def run(parsers, count, payload_size, repeat):
+    """
+    best-of-repeat packets/sec of every parser over the same packets
+    """
+    check_malformed()
+    packets, ring, sizes = make_packets(count, payload_size)
+    expected = count * payload_size
+    results = {}
+    for name in parsers:
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parsed = PARSERS[name](packets, ring, sizes)
+            elapsed = time.perf_counter() - start
+            if parsed != expected:
+                raise AssertionError(f"{name} parsed {parsed} payload bytes, expected {expected}")
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {"seconds": best, "packets_per_second": count / best}
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Packet parser microbenchmark (packets/sec)")
+    parser.add_argument("--packets", type=int, default=200_000, help="payload datagrams parsed per run")
+    parser.add_argument("--payload-size", type=int, default=UDP_CHUNK_SIZE, help="payload bytes per datagram")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per parser, the best one counts")
+    parser.add_argument("--parsers", default=",".join(PARSERS),
+                        type=lambda text: [name.strip() for name in text.split(',')],
+                        help=f"comma separated subset of {', '.join(PARSERS)}")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args(argv)
+    unknown = set(args.parsers) - set(PARSERS)
+    if unknown:
+        parser.error(f"unknown parsers: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args.parsers, args.packets, args.payload_size, args.repeat)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    baseline = results.get("dict")
+    print(f"{args.packets} packets of {args.payload_size} payload bytes, best of {args.repeat}")
+    for name, result in results.items():
+        speedup = f"  x{result['packets_per_second'] / baseline['packets_per_second']:.2f}" if baseline else ""
+        print(f"  {name:<10} {result['packets_per_second']:>14,.0f} packets/sec{speedup}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import mmap
+import os
+import random
+import select
+import socket
+import tempfile
+import time
+import zlib
+import metrics
+from checksum import crc32_combine, crc32_repeat
+
+PAYLOAD_FILE_SIZE = 4 * 1024 * 1024  # size of the pre-built payload the tcp stream cycles over
+TMPFS_DIR = '/dev/shm'
+HAVE_SENDFILE = hasattr(os, 'sendfile')
+RANDOM_PAYLOAD_SEED = 0x5eed
+PAYLOAD_SOURCES = ("filler", "random")  # or the path of a file to serve
+
+
+def _wait_writable(sock, timeout):
+    """
+    block until sock is writable or timeout (seconds, None = forever) expires
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        ready = poller.poll(None if timeout is None else timeout * 1000)
+    else:
+        _, ready, _ = select.select([], [sock], [], timeout)
+    if not ready:
+        raise socket.timeout("timed out waiting for socket to become writable")
+
+
+class TcpPayload:
+    """
+    pre-built tcp payload kept in a tmpfs-backed, memory-mapped file
+
+    the requested byte stream is the payload file repeated over and over, and is handed to the
+    kernel either with os.sendfile (zero-copy) or as memoryview slices of the mapping (no
+    python-level copies), chunk_size bytes per syscall at most
+    one instance is shared by every connection of a server
+
+    the payload file holds constant fill bytes by default; with a seed it holds deterministic
+    pseudo-random bytes (generated in one call), and with a path the named file itself is
+    mapped and served. udp senders copy their segments out of real (non-fill) payloads too
+    """
+
+    def __init__(self, chunk_size, use_sendfile=None, fill=b'Z', size=PAYLOAD_FILE_SIZE, path=None, seed=None):
+        if chunk_size <= 0:
+            raise ValueError(f"chunk size must be positive, got {chunk_size}")
+        self.chunk_size = chunk_size
+        self.use_sendfile = HAVE_SENDFILE if use_sendfile is None else (use_sendfile and HAVE_SENDFILE)
+        self.fill = None  # the fill byte while the payload is constant
+        self._crc = None  # crc32 of the whole payload file, computed on first use
+
+        if path is not None:
+            self.source = path
+            self.file = open(path, 'rb')
+            size = os.fstat(self.file.fileno()).st_size
+            if not size:
+                self.file.close()
+                raise ValueError(f"payload file {path} is empty")
+        else:
+            self.file = tempfile.TemporaryFile(dir=TMPFS_DIR if os.path.isdir(TMPFS_DIR) else None)
+            if seed is not None:
+                self.source = f"random:{seed}"
+                self.file.write(random.Random(seed).randbytes(size))
+            else:
+                self.source = "filler"
+                self.fill = fill
+                self.file.write(fill * size)
+            self.file.flush()
+        self.size = size
+        self.fd = self.file.fileno()
+        self.mmap = mmap.mmap(self.fd, size, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+
+    @property
+    def mode(self):
+        return 'sendfile' if self.use_sendfile else 'memoryview'
+
+    def read_into(self, buffer, start, offset, length):
+        """
+        copy length bytes of the stream, from stream offset on, into buffer at start
+        """
+        position = offset % self.size
+        while length:
+            count = min(length, self.size - position)
+            buffer[start:start + count] = self.view[position:position + count]
+            start += count
+            length -= count
+            position = 0
+
+    def read(self, offset, length):
+        """
+        length bytes of the stream from stream offset on: a memoryview of the mapping, or a
+        copy when the range wraps around the end of the payload file
+        """
+        position = offset % self.size
+        if position + length <= self.size:
+            return self.view[position:position + length]
+        data = bytearray(length)
+        self.read_into(data, 0, offset, length)
+        return data
+
+    def checksum(self, offset, length):
+        """
+        crc32 of length bytes of the stream from stream offset on, the trailer of a checked tcp
+        response; whole repetitions of the payload file are folded in with crc32_combine, so at
+        most two partial payload files are hashed and the sent bytes themselves never are
+        """
+        if self._crc is None:
+            self._crc = zlib.crc32(self.view)
+        position = offset % self.size
+        head = min(length, self.size - position)
+        crc = zlib.crc32(self.view[position:position + head])
+        cycles, tail = divmod(length - head, self.size)
+        if cycles:
+            crc = crc32_combine(crc, crc32_repeat(self._crc, self.size, cycles), cycles * self.size)
+        if tail:
+            crc = crc32_combine(crc, zlib.crc32(self.view[:tail]), tail)
+        return crc
+
+    def send_some(self, sock, offset, count):
+        """
+        single non-retrying send of up to count bytes, starting at stream offset
+        returns the number of bytes the kernel accepted
+        raises blockingioerror when a non-blocking socket is full
+        """
+        position = offset % self.size
+        count = min(count, self.chunk_size, self.size - position)
+        started = time.perf_counter()
+        try:
+            if self.use_sendfile:
+                sent = os.sendfile(sock.fileno(), self.fd, position, count)
+            else:
+                sent = sock.send(self.view[position:position + count])
+        except BlockingIOError:
+            metrics.TCP_SEND_EAGAIN.inc()
+            raise
+        except OSError:
+            metrics.TCP_SEND_ERRORS.inc()
+            raise
+        metrics.TCP_SEND_SECONDS.observe(time.perf_counter() - started)
+        metrics.TCP_BYTES_SENT.inc(sent)
+        return sent
+
+    def send(self, sock, file_size, offset=0, budget=None):
+        """
+        send file_size bytes of payload to a blocking (or timeout) socket
+        honours the socket timeout while waiting for buffer space
+        budget is an optional shared TokenBucket (bytes/sec) every chunk is drawn from
+        returns the number of bytes sent
+        """
+        timeout = sock.gettimeout()
+        bytes_sent = 0
+        while bytes_sent < file_size:
+            if budget is not None:
+                budget.wait()
+            try:
+                sent = self.send_some(sock, offset + bytes_sent, file_size - bytes_sent)
+            except BlockingIOError:
+                # sendfile bypasses the socket timeout machinery, so wait for space ourselves
+                _wait_writable(sock, timeout)
+                continue
+            if sent == 0:
+                raise ConnectionError("Connection closed while sending payload")
+            if budget is not None:
+                budget.consume(sent)
+            bytes_sent += sent
+        return bytes_sent
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+def make_payload(source, chunk_size, use_sendfile=None):
+    """
+    the TcpPayload of a payload source: "filler" (constant bytes), "random[:seed]"
+    (deterministic pseudo-random bytes) or the path of a file to serve
+    """
+    if source == "filler":
+        return TcpPayload(chunk_size, use_sendfile)
+    kind, _, seed = source.partition(':')
+    if kind == "random":
+        return TcpPayload(chunk_size, use_sendfile, seed=int(seed, 0) if seed else RANDOM_PAYLOAD_SEED)
+    return TcpPayload(chunk_size, use_sendfile, path=source)
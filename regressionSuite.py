@@ -0,0 +1,498 @@
+import argparse
+import contextlib
+import errno
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+import timeit
+import zlib
+import compression
+import packetBuilder
+import packetParser
+import serverLog
+import udpSender
+from benchmark import run_cell, aggregate, run_connection_cell, connection_aggregate
+from transferStats import summarize
+from main import start_server, SERVER_ENGINES
+from Server import TCP_CHUNK_SIZE
+from payloadSource import make_payload
+from tokenBucket import TokenBucket
+from constants import *
+from ANSI import ANSI
+
+SUITE_VERSION = 1
+DEFAULT_THRESHOLD = 0.10  # relative change beyond which compare reports a regression
+SERVER_START_TIMEOUT = 10
+MEMORY_SETTLE_TIME = 1.0  # seconds the in-flight streams get before the server rss is sampled
+MEMORY_TCP_REQUEST = 2 ** 40  # never completes: the server blocks on a client that does not read
+MEMORY_UDP_RATE = 8_000_000  # bits/sec of the udp streams kept in flight for the memory benchmark
+MEMORY_NOISE = 4096  # bytes per stream; rss moves in pages, smaller changes are not reported
+INTEGRITY_NOISE = 5.0  # percentage points of verification overhead that are run to run noise
+
+# full / --quick workload
+PROFILES = {
+    "full": {
+        "codec_iterations": 200_000,
+        "transfer_size": 200_000_000,
+        "streams": 4,
+        "connections": 1000,
+        "memory_streams": 64,
+    },
+    "quick": {
+        "codec_iterations": 50_000,
+        "transfer_size": 20_000_000,
+        "streams": 4,
+        "connections": 200,
+        "memory_streams": 16,
+    },
+}
+
+
+def _metric(value, unit, better="higher", noise=0):
+    """
+    one baseline entry; changes smaller than noise (absolute, in unit) never count
+    """
+    return {"value": value, "unit": unit, "better": better, "noise": noise}
+
+
+# -----------------------------------------------------------------------------
+# codec
+# -----------------------------------------------------------------------------
+def codec_benchmarks(iterations, repeat):
+    """
+    ops/sec of building and parsing every message type, best of repeat
+    """
+    payload = b'X' * 1400
+    packets = {
+        "offer": packetBuilder.build_offer_msg(50001, 50002, compression.SUPPORTED_CODECS),
+        "request": packetBuilder.build_tcp_request_msg(10 ** 9, 10 ** 8, REQUEST_FLAG_RELIABLE),
+        "payload": packetBuilder.build_payload_msg(1000, 7, payload),
+        "checked_payload": packetBuilder.build_checked_payload_msg(1000, 7, payload),
+        "nack": packetBuilder.build_nack_msg([(i * 10, 5) for i in range(16)]),
+        "error": packetBuilder.build_error_msg(ERROR_SERVER_BUSY, 1.0),
+    }
+    ring_buffer = bytearray(packets["payload"])
+    ring_size = len(ring_buffer)
+    checked_buffer = bytearray(packets["checked_payload"])
+    checked_payload = memoryview(checked_buffer)[packetParser.CHECKED_PAYLOAD_HEADER_SIZE:]
+    view = packetParser.PacketView()
+    header_buffer = bytearray(64 * packetParser.PAYLOAD_HEADER_SIZE)
+
+    operations = {
+        "build.offer": lambda: packetBuilder.build_offer_msg(50001, 50002, compression.SUPPORTED_CODECS),
+        "build.request": lambda: packetBuilder.build_tcp_request_msg(10 ** 9, 10 ** 8, REQUEST_FLAG_RELIABLE),
+        "build.payload": lambda: packetBuilder.build_payload_msg(1000, 7, payload),
+        "build.payload_header_into": lambda: packetBuilder.pack_payload_header_into(header_buffer, 0, 1000, 7),
+        "build.checked_payload_header_into": lambda: packetBuilder.pack_checked_payload_header_into(
+            header_buffer, 0, 1000, 7, zlib.crc32(checked_payload)),
+        "build.nack": lambda: packetBuilder.build_nack_msg([(i * 10, 5) for i in range(16)]),
+        "build.error": lambda: packetBuilder.build_error_msg(ERROR_SERVER_BUSY, 1.0),
+        "parse.tcp_request": lambda: packetParser.parse_tcp_request(packets["request"]),
+        "parse.payload_view": lambda: packetParser.parse_packet_view(ring_buffer, ring_size, view),
+        "parse.payload_header": lambda: packetParser.unpack_payload_header(ring_buffer, ring_size),
+        "parse.checked_payload_header": lambda: packetParser.unpack_checked_payload_header(checked_buffer, len(checked_buffer)),
+        # what verification adds per segment on the receive side
+        "verify.segment_crc32": lambda: zlib.crc32(checked_payload),
+    }
+    # per-segment compression of a text-like udp segment, both ends
+    with open(packetBuilder.__file__, 'rb') as source:
+        text = source.read(len(payload))
+    for codec in (CODEC_ZLIB, CODEC_LZMA):
+        if not compression.SUPPORTED_CODECS & (1 << codec):
+            continue
+        segment_codec = compression.SegmentCodec(codec)
+        encoded = segment_codec.encode(text)
+        operations[f"compress.segment_{CODEC_NAMES[codec]}"] = lambda c=segment_codec: c.encode(text)
+        operations[f"decompress.segment_{CODEC_NAMES[codec]}"] = lambda c=segment_codec, e=encoded: c.decode(e)
+    for name, packet in packets.items():
+        operations[f"parse.{name}"] = lambda packet=packet: packetParser.parse_udp_packet(packet)
+
+    metrics = {}
+    for name, operation in operations.items():
+        best = min(timeit.repeat(operation, number=iterations, repeat=repeat))
+        metrics[f"codec.{name}"] = _metric(iterations / best, "ops/s")
+    return metrics
+
+
+# -----------------------------------------------------------------------------
+# correctness checks, run before anything is timed
+# -----------------------------------------------------------------------------
+class _BlockedSocket:
+    """
+    a udp socket whose send buffer is always full
+    """
+
+    def sendto(self, data, addr):
+        raise BlockingIOError(errno.EAGAIN, "send buffer full")
+
+    def sendmsg(self, buffers, ancdata, flags, addr):
+        raise BlockingIOError(errno.EAGAIN, "send buffer full")
+
+
+def check_retransmit_blocked():
+    """
+    a burst of retransmissions the socket refuses with eagain must stay queued and give its
+    byte budget back, on the gso path and the per-datagram one
+    """
+    for use_gso in (True, False):
+        budget = TokenBucket(1e6, 1e6)
+        sender = udpSender.UdpBatchSender(_BlockedSocket(), ('127.0.0.1', 9), 10 * 1000, 1000, use_gso=use_gso,
+                                          budget=budget)
+        sender.next_segment = sender.total_segments  # the first pass is over
+        sender.retransmit([(2, 3)])
+        try:
+            sender.send_burst()
+        except BlockingIOError:
+            pass
+        queued = sorted(s for first, length in sender.pending for s in range(first, first + length))
+        if queued != [2, 3, 4]:
+            raise AssertionError(f"blocked retransmissions (gso {use_gso}) were not requeued: {queued}")
+        if budget.capacity - budget.tokens > 1:
+            raise AssertionError(f"blocked retransmissions (gso {use_gso}) kept {budget.capacity - budget.tokens:.0f}"
+                                 " bytes of the budget")
+
+
+# -----------------------------------------------------------------------------
+# in-process server (in a child process, so it does not share the client's interpreter)
+# -----------------------------------------------------------------------------
+def _serve(stop_event, ready, udp_port, tcp_port, engine, payload):
+    # the memory benchmark resets connections on purpose, keep the server silent
+    serverLog.configure(logging.CRITICAL)
+    listening = threading.Event()
+    threads = start_server(stop_event, udp_port, tcp_port, engine, tcp_payload=make_payload(payload, TCP_CHUNK_SIZE),
+                           ready=listening)
+    listening.wait()
+    ready.set()
+    for thread in threads:
+        thread.join()
+
+
+def _free_ports():
+    """
+    a udp and a tcp port that are free right now (the kernel picks them)
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp, socket.socket() as tcp:
+        udp.bind(('127.0.0.1', 0))
+        tcp.bind(('127.0.0.1', 0))
+        return udp.getsockname()[1], tcp.getsockname()[1]
+
+
+@contextlib.contextmanager
+def local_server(engine, payload="filler"):
+    """
+    run a server with the given engine and payload source in a spawned process,
+    yields (server tuple, pid)
+    """
+    ctx = multiprocessing.get_context("spawn")
+    stop_event = ctx.Event()
+    ready = ctx.Event()
+    udp_port, tcp_port = _free_ports()
+    process = ctx.Process(target=_serve, args=(stop_event, ready, udp_port, tcp_port, engine, payload),
+                          daemon=True)
+    process.start()
+    try:
+        if not ready.wait(SERVER_START_TIMEOUT):
+            raise RuntimeError(f"{engine} server did not start within {SERVER_START_TIMEOUT} seconds")
+        time.sleep(0.5)
+        yield ('127.0.0.1', udp_port, tcp_port), process.pid
+    finally:
+        stop_event.set()
+        process.join(SERVER_START_TIMEOUT)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+
+def _rss(pid):
+    """
+    resident set size of a process in bytes, None where /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# -----------------------------------------------------------------------------
+# transfers
+# -----------------------------------------------------------------------------
+def transfer_benchmarks(engine, server, profile, repeat):
+    """
+    best-of-repeat aggregate throughput of single and multi stream tcp and udp transfers,
+    plus the udp success rate of the same runs
+    throughput spans first stream start to last byte (transferStats.summarize), so the idle
+    timeout that ends a udp receiver is not counted
+    """
+    size = profile["transfer_size"]
+    streams = profile["streams"]
+    cells = {
+        "tcp.single": (size, 1, 0),
+        "tcp.multi": (size // streams, streams, 0),
+        # unpaced udp over loopback: goodput, the success rate tells how much was lost
+        "udp.single": (size // 4, 0, 1),
+        "udp.multi": (size // 4 // streams, 0, streams),
+    }
+    metrics = {}
+    for name, (file_size, num_tcp, num_udp) in cells.items():
+        best = None
+        for _ in range(repeat):
+            results, wall_duration = run_cell(server, file_size, num_tcp, num_udp, 0, 1, num_udp > 0)
+            statistics = summarize(results) or {"throughput": 0.0}
+            if best is None or statistics["throughput"] > best[0]["throughput"]:
+                best = statistics, aggregate(results, wall_duration)
+        metrics[f"{name}.{engine}.throughput"] = _metric(best[0]["throughput"], "bits/s")
+        if num_udp:
+            metrics[f"{name}.{engine}.success_rate"] = _metric(best[1]["mean_success_rate"] or 0.0, "%")
+    return metrics
+
+
+def connection_benchmarks(engine, server, profile, repeat):
+    """
+    connection setup rate: one client opening 1-byte connections back to back
+    """
+    best = None
+    for _ in range(repeat):
+        results, wall_duration = run_connection_cell(server, 1, 1, profile["connections"])
+        rate = connection_aggregate(results, wall_duration)["connections_per_second"]
+        best = rate if best is None else max(best, rate)
+    return {f"connections.{engine}.rate": _metric(best, "connections/s")}
+
+
+def integrity_benchmarks(engine, server, profile, repeat):
+    """
+    cost of verifying the data: best-of-repeat single stream tcp and udp throughput against a
+    pseudo-random payload, plain and checked (crc32 trailer / crc32 per segment), and the
+    relative throughput lost to checking
+    """
+    size = profile["transfer_size"]
+    cells = {"tcp": (size, 1, 0), "udp": (size // 4, 0, 1)}
+    metrics = {}
+    for name, (file_size, num_tcp, num_udp) in cells.items():
+        throughput = {}
+        for verify in (False, True):
+            best = 0.0
+            for _ in range(repeat):
+                results, _ = run_cell(server, file_size, num_tcp, num_udp, 0, 1, num_udp > 0, verify=verify)
+                best = max(best, (summarize(results) or {"throughput": 0.0})["throughput"])
+            throughput[verify] = best
+        overhead = (1 - throughput[True] / throughput[False]) * 100 if throughput[False] else 0.0
+        metrics[f"integrity.{engine}.{name}.verified_throughput"] = _metric(throughput[True], "bits/s")
+        metrics[f"integrity.{engine}.{name}.overhead"] = _metric(overhead, "%", "lower", INTEGRITY_NOISE)
+    return metrics
+
+
+def memory_benchmarks(engine, server, pid, profile):
+    """
+    server rss growth per in-flight stream: tcp streams whose client never reads (the server
+    blocks on a full socket buffer) and slowly paced udp streams
+    """
+    streams = profile["memory_streams"]
+    server_ip, udp_port, tcp_port = server
+    metrics = {}
+
+    baseline = _rss(pid)
+    if baseline is None:
+        return metrics
+    request = packetBuilder.build_tcp_request_msg(MEMORY_TCP_REQUEST)
+    sockets = []
+    try:
+        for _ in range(streams):
+            sock = socket.create_connection((server_ip, tcp_port))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+            sock.sendall(request)
+            sockets.append(sock)
+        time.sleep(MEMORY_SETTLE_TIME)
+        metrics[f"memory.{engine}.tcp_stream"] = _metric((_rss(pid) - baseline) / streams, "bytes", "lower",
+                                                         MEMORY_NOISE)
+    finally:
+        for sock in sockets:
+            sock.close()
+    time.sleep(MEMORY_SETTLE_TIME)
+
+    baseline = _rss(pid)
+    # about 2 * MEMORY_SETTLE_TIME worth of data each, so they finish soon after the sample
+    file_size = int(MEMORY_UDP_RATE / 8 * 2 * MEMORY_SETTLE_TIME)
+    request = packetBuilder.build_request_msg(file_size, MEMORY_UDP_RATE)
+    sockets = []
+    try:
+        for _ in range(streams):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.sendto(request, (server_ip, udp_port))
+            sockets.append(sock)
+        time.sleep(MEMORY_SETTLE_TIME)
+        metrics[f"memory.{engine}.udp_stream"] = _metric((_rss(pid) - baseline) / streams, "bytes", "lower",
+                                                         MEMORY_NOISE)
+        time.sleep(2 * MEMORY_SETTLE_TIME)
+    finally:
+        for sock in sockets:
+            sock.close()
+    return metrics
+
+
+# -----------------------------------------------------------------------------
+# suite
+# -----------------------------------------------------------------------------
+GROUPS = ("codec", "transfer", "connections", "memory", "integrity")
+
+
+def run_suite(engines, groups, profile_name, repeat):
+    """
+    run the selected benchmark groups and return a baseline document
+    """
+    check_retransmit_blocked()
+    profile = PROFILES[profile_name]
+    metrics = {}
+    if "codec" in groups:
+        print(f"{ANSI.BOLD}[Suite] codec{ANSI.ENDC}")
+        metrics.update(codec_benchmarks(profile["codec_iterations"], repeat))
+
+    for engine in engines:
+        if set(groups) & {"transfer", "connections", "memory"}:
+            with local_server(engine) as (server, pid):
+                if "memory" in groups:
+                    print(f"{ANSI.BOLD}[Suite] {engine} engine: memory per stream{ANSI.ENDC}")
+                    metrics.update(memory_benchmarks(engine, server, pid, profile))
+                if "transfer" in groups:
+                    print(f"{ANSI.BOLD}[Suite] {engine} engine: transfers{ANSI.ENDC}")
+                    metrics.update(transfer_benchmarks(engine, server, profile, repeat))
+                if "connections" in groups:
+                    print(f"{ANSI.BOLD}[Suite] {engine} engine: connection setup{ANSI.ENDC}")
+                    metrics.update(connection_benchmarks(engine, server, profile, repeat))
+        # checked transfers are measured against real data, from a server of their own
+        if "integrity" in groups:
+            with local_server(engine, "random") as (server, _):
+                print(f"{ANSI.BOLD}[Suite] {engine} engine: integrity checks{ANSI.ENDC}")
+                metrics.update(integrity_benchmarks(engine, server, profile, repeat))
+
+    return {
+        "suite_version": SUITE_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "environment": {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": {"profile": profile_name, "engines": list(engines), "groups": list(groups), "repeat": repeat},
+        "metrics": metrics,
+    }
+
+
+def compare(baseline, current, threshold=DEFAULT_THRESHOLD):
+    """
+    compare the metrics two baseline documents have in common
+    returns a list of (name, baseline value, current value, relative change, status), status
+    being "regression", "improvement" or "ok" depending on threshold and the metric's direction
+    """
+    rows = []
+    for name in sorted(set(baseline["metrics"]) & set(current["metrics"])):
+        before = baseline["metrics"][name]
+        value = current["metrics"][name]["value"]
+        noise = max(before.get("noise", 0), current["metrics"][name].get("noise", 0))
+        if not before["value"]:
+            rows.append((name, before["value"], value, None, "ok"))
+            continue
+        change = (value - before["value"]) / abs(before["value"])
+        gain = change if before.get("better", "higher") == "higher" else -change
+        if abs(value - before["value"]) <= noise:
+            status = "ok"
+        elif gain < -threshold:
+            status = "regression"
+        elif gain > threshold:
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append((name, before["value"], value, change, status))
+    return rows
+
+
+def print_comparison(rows, baseline, current, out):
+    colors = {"regression": ANSI.FAIL, "improvement": ANSI.OKGREEN, "ok": ""}
+    width = max((len(name) for name, *_ in rows), default=10)
+    for name, before, value, change, status in rows:
+        delta = f"{change * 100:+7.1f}%" if change is not None else "    n/a"
+        print(f"{colors[status]}{name:<{width}}  {before:>16.6g}  {value:>16.6g}  {delta}  {status}{ANSI.ENDC}", file=out)
+    for label, missing in (("only in baseline", set(baseline["metrics"]) - set(current["metrics"])),
+                           ("only in current", set(current["metrics"]) - set(baseline["metrics"]))):
+        if missing:
+            print(f"{ANSI.WARNING}{label}: {', '.join(sorted(missing))}{ANSI.ENDC}", file=out)
+
+
+def _load(path):
+    with open(path) as f:
+        document = json.load(f)
+    if document.get("suite_version") != SUITE_VERSION:
+        raise SystemExit(f"{path}: unsupported suite version {document.get('suite_version')}")
+    return document
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Loopback benchmark and regression suite")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run the suite and write a json baseline")
+    run.add_argument("--engines", default=",".join(SERVER_ENGINES),
+                     type=lambda text: [engine.strip() for engine in text.split(',')],
+                     help=f"server engines to measure (default: {','.join(SERVER_ENGINES)})")
+    run.add_argument("--groups", default=",".join(GROUPS),
+                     type=lambda text: [group.strip() for group in text.split(',')],
+                     help=f"benchmark groups to run (default: {','.join(GROUPS)})")
+    run.add_argument("--quick", action="store_true", help="smaller workloads, for a fast sanity check")
+    run.add_argument("--repeat", type=int, default=3, help="runs per benchmark, the best one counts")
+    run.add_argument("--output", "-o", help="write the baseline here instead of stdout")
+    run.add_argument("--compare", metavar="BASELINE", help="also compare the results against this baseline")
+    run.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                     help="relative change that counts as a regression (default 0.10)")
+
+    cmp = commands.add_parser("compare", help="compare two baselines, exit status 1 on regressions")
+    cmp.add_argument("baseline")
+    cmp.add_argument("current")
+    cmp.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                     help="relative change that counts as a regression (default 0.10)")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        for name, values, known in (("engines", args.engines, SERVER_ENGINES), ("groups", args.groups, GROUPS)):
+            unknown = set(values) - set(known)
+            if unknown:
+                parser.error(f"unknown {name}: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.command == "compare":
+        baseline, current = _load(args.baseline), _load(args.current)
+    else:
+        # keep the human readable progress off stdout so it only carries the json
+        with contextlib.redirect_stdout(sys.stderr):
+            current = run_suite(args.engines, args.groups, "quick" if args.quick else "full", args.repeat)
+        if args.output:
+            with open(args.output, 'w') as out:
+                json.dump(current, out, indent=2)
+        else:
+            json.dump(current, sys.stdout, indent=2)
+            print()
+        if not args.compare:
+            return 0
+        baseline = _load(args.compare)
+
+    rows = compare(baseline, current, args.threshold)
+    print_comparison(rows, baseline, current, sys.stderr if args.command == "run" and not args.output else sys.stdout)
+    regressions = [row for row in rows if row[4] == "regression"]
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import collections
+import re
+
+# number of set bits for every byte value, used with bytes.translate for a c-speed popcount
+_POPCOUNT_TABLE = bytes(bin(value).count('1') for value in range(256))
+# runs of fully missing bytes, runs of fully received bytes, or a single mixed byte
+_BYTE_RUNS = re.compile(rb'\x00+|\xff+|[\x01-\xfe]')
+
+
+class SegmentBitmap:
+    """
+    tracks which udp segments of a transfer arrived, one bit per segment
+
+    sized from total_segments (announced in every payload header), so a 10 gb transfer of
+    1400 byte segments needs under 1 mb instead of millions of python ints in a set
+    """
+    __slots__ = ('total_segments', 'bits', 'received', 'duplicates', 'out_of_range', 'corrupt', 'segment_size')
+
+    def __init__(self, total_segments):
+        self.total_segments = total_segments
+        self.bits = bytearray((total_segments + 7) >> 3)
+        self.received = 0  # distinct segments marked so far
+        self.duplicates = 0
+        self.out_of_range = 0
+        self.corrupt = 0  # arrivals that failed their checksum, left unmarked like lost segments
+        self.segment_size = 0  # largest (decompressed) payload seen, the segment size the server picked
+
+    def mark(self, segment):
+        """
+        record the arrival of segment
+        returns true the first time a segment is seen, false for duplicates and bogus numbers
+        """
+        if segment >= self.total_segments:
+            self.out_of_range += 1
+            return False
+        index = segment >> 3
+        mask = 1 << (segment & 7)
+        byte = self.bits[index]
+        if byte & mask:
+            self.duplicates += 1
+            return False
+        self.bits[index] = byte | mask
+        self.received += 1
+        return True
+
+    def __contains__(self, segment):
+        return segment < self.total_segments and bool(self.bits[segment >> 3] & (1 << (segment & 7)))
+
+    def __len__(self):
+        return self.received
+
+    @property
+    def complete(self):
+        return self.received >= self.total_segments
+
+    @property
+    def success_rate(self):
+        if not self.total_segments:
+            return 0.0
+        return (self.received / self.total_segments) * 100
+
+    def popcount(self):
+        """
+        recount the set bits from scratch (received keeps the same number incrementally)
+        """
+        return sum(self.bits.translate(_POPCOUNT_TABLE))
+
+    def missing_ranges(self):
+        """
+        list of (first_segment, length) for every run of consecutive missing segments
+        whole 0x00 / 0xff bytes are skipped 8 segments at a time, only mixed bytes are walked bit by bit
+        """
+        ranges = []
+        gap_start = None
+
+        for match in _BYTE_RUNS.finditer(self.bits):
+            first = match.start() << 3
+            byte = self.bits[match.start()]
+            if byte == 0xff:
+                if gap_start is not None:
+                    ranges.append((gap_start, first - gap_start))
+                    gap_start = None
+            elif byte == 0:
+                if gap_start is None:
+                    gap_start = first
+            else:
+                for bit in range(8):
+                    if byte >> bit & 1:
+                        if gap_start is not None:
+                            ranges.append((gap_start, first + bit - gap_start))
+                            gap_start = None
+                    elif gap_start is None:
+                        gap_start = first + bit
+
+        # the padding bits of the last byte are never set, clip the trailing gap to the transfer
+        if gap_start is not None and gap_start < self.total_segments:
+            ranges.append((gap_start, self.total_segments - gap_start))
+        return ranges
+
+    def loss_runs(self):
+        """
+        lengths of the consecutive-loss runs, in segment order
+        many runs of 1 means random loss, few long runs means burst loss
+        """
+        return [length for _, length in self.missing_ranges()]
+
+    def loss_summary(self):
+        """
+        compact description of the loss pattern for result records
+        """
+        runs = self.loss_runs()
+        return {
+            "loss_runs": len(runs),
+            "max_loss_run": max(runs) if runs else 0,
+            "mean_loss_run": (sum(runs) / len(runs)) if runs else 0.0,
+            "loss_run_histogram": dict(sorted(collections.Counter(runs).items())),
+        }
@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+from ANSI import ANSI
+
+RATE_LIMIT_INTERVAL = 1.0  # seconds of one rate limiting window
+RATE_LIMIT_BURST = 20  # records of the same message template let through per window
+LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+TAG_COLORS = {
+    "UDP": ANSI.OKCYAN,
+    "EVENT": ANSI.OKCYAN,
+    "TCP": ANSI.HEADER,
+    "Supervisor": ANSI.BOLD,
+    "Metrics": ANSI.OKBLUE,
+    "Discovery": ANSI.OKBLUE,
+    "Socket": ANSI.BOLD,
+    "Proxy": ANSI.OKGREEN,
+}
+LEVEL_COLORS = {
+    logging.WARNING: ANSI.WARNING,
+    logging.ERROR: ANSI.FAIL,
+    logging.CRITICAL: ANSI.FAIL,
+}
+
+_root = logging.getLogger("server")
+
+
+def get_logger(tag):
+    """
+    logger of one server component, its records are printed as "[tag] message"
+    messages are %-style templates with separate arguments, so a record below the configured
+    level costs one level check and is never formatted
+    """
+    return _root.getChild(tag)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    lets at most `burst` records of the same message template through per `interval` seconds
+    the first record let through after a suppression reports how many were dropped
+    """
+
+    def __init__(self, burst=RATE_LIMIT_BURST, interval=RATE_LIMIT_INTERVAL):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.windows = {}  # (logger, template) -> [window start, records let through, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None:
+                window = self.windows[key] = [now, 0, 0]
+            elif now - window[0] >= self.interval:
+                window[0] = now
+                window[1] = 0
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+            record.suppressed, window[2] = window[2], 0
+        return True
+
+
+class _AnsiFormatter(logging.Formatter):
+    def format(self, record):
+        tag = record.name.rsplit(".", 1)[-1]
+        color = LEVEL_COLORS.get(record.levelno) or TAG_COLORS.get(tag, "")
+        message = record.getMessage()
+        if getattr(record, "suppressed", 0):
+            message += f" ({record.suppressed} similar messages suppressed)"
+        if record.exc_info:
+            message += "\n" + self.formatException(record.exc_info)
+        return f"{color}[{tag}] {message}{ANSI.ENDC}"
+
+
+class _StdoutHandler(logging.Handler):
+    """
+    prints to whatever sys.stdout is at the time, so redirect_stdout (benchmark.py) still applies
+    """
+
+    def emit(self, record):
+        try:
+            print(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+def configure(level="info"):
+    """
+    set the level of every server logger (one of LOG_LEVELS, or a logging level number)
+    """
+    _root.setLevel(LOG_LEVELS[level] if isinstance(level, str) else level)
+
+
+def current_level():
+    return _root.level
+
+
+_handler = _StdoutHandler()
+_handler.addFilter(RateLimitFilter())
+_handler.setFormatter(_AnsiFormatter())
+_root.addHandler(_handler)
+_root.propagate = False
+configure("info")
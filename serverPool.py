@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+import queue
+import threading
+import metrics
+import serverLog
+from Server import udp_server_loop, tcp_server_loop
+from eventServer import event_server_loop
+from payloadSource import make_payload
+from admission import AdmissionController
+
+SUPERVISE_INTERVAL = 0.5  # seconds between liveness checks of the workers
+WORKER_STOP_TIMEOUT = 5  # seconds a worker gets to exit cleanly before it is terminated
+
+log = serverLog.get_logger("Supervisor")
+
+
+def _serve_worker(stop_event, udp_port, tcp_port, engine, max_sessions, tcp_chunk_size, use_sendfile,
+                  payload_source, admission_limits, in_flight, log_level, metrics_queue, slot, profile=None,
+                  trace_dir=None, ready=None):
+    """
+    worker process body: bind the shared udp and tcp ports with SO_REUSEPORT and serve
+    until stop_event is set; the kernel spreads incoming flows across all workers
+    admission_limits (or None) configure this worker's admission controller, which counts its
+    transfers in its own slot of the shared in_flight array so the transfer limit stays global
+    metrics snapshots of the worker are sent to the supervisor over metrics_queue
+    profile is the socketProfiles.SocketProfile of the worker's sockets
+    trace_dir is where the worker's udp transfers write their send traces (None = no traces)
+    ready is an optional semaphore shared by all workers, released once per listening loop
+    (one with the event engine, the udp and the tcp loop with the thread engine)
+    """
+    serverLog.configure(log_level)
+    threading.Thread(
+        target=metrics.publish_metrics, args=(stop_event, metrics_queue, slot), daemon=True
+    ).start()
+    # the mmap backed payload cannot cross a process boundary, every worker builds its own
+    # from the same source (a random payload is seeded, so all workers serve the same bytes)
+    payload = make_payload(payload_source, tcp_chunk_size, use_sendfile=use_sendfile)
+    admission = None
+    if admission_limits is not None:
+        admission = AdmissionController(**admission_limits, in_flight=in_flight, slot=slot)
+    try:
+        if engine == "event":
+            event_server_loop(stop_event, udp_port, tcp_port, max_sessions, payload, reuse_port=True,
+                              admission=admission, profile=profile, trace_dir=trace_dir, ready=ready)
+            return
+
+        udp_thread = threading.Thread(
+            target=udp_server_loop, args=(stop_event, udp_port, True, admission, payload, profile, trace_dir, ready),
+            daemon=True
+        )
+        tcp_thread = threading.Thread(
+            target=tcp_server_loop, args=(stop_event, tcp_port, payload, True, admission, profile, ready), daemon=True
+        )
+        udp_thread.start()
+        tcp_thread.start()
+        udp_thread.join()
+        tcp_thread.join()
+    except KeyboardInterrupt:
+        # ctrl + c reaches the whole process group, shutdown is driven by the supervisor
+        pass
+    finally:
+        payload.close()
+
+
+def supervise_workers(stop_event, udp_port, tcp_port, workers, engine, max_sessions, tcp_payload, admission=None,
+                      profile=None, trace_dir=None, ready=None):
+    """
+    pre-fork server: keep `workers` server processes bound to the same ports running
+    any worker that dies is restarted until stop_event is set, then all are shut down
+    meant to run in its own thread next to the (single) broadcast_offers thread
+
+    with an admission controller, the workers count their transfers in its in-flight array, one
+    slot each (so max_transfers and the saturation seen by broadcast_offers are global); per-ip
+    quotas apply per worker and the byte budget is split evenly between the workers
+
+    the metrics the workers publish are merged into metrics.REGISTRY of this process; counters
+    of a worker that died are kept, its gauges dropped
+
+    ready is an optional semaphore of the spawn context the workers release as their loops start
+    listening (see _serve_worker), restarted workers release it again
+    """
+    # spawn rather than fork: the supervisor lives in a process that already runs threads
+    ctx = multiprocessing.get_context("spawn")
+    worker_stop = ctx.Event()
+    metrics_queue = ctx.Queue()
+    admission_limits = None
+    in_flight = None
+    if admission is not None:
+        admission_limits = admission.limits()
+        admission_limits["byte_rate"] = admission_limits["byte_rate"] / workers
+        # replace the controller's single counter with one slot per worker, shared with them
+        in_flight = admission.in_flight = ctx.Array('i', workers)
+    args = (worker_stop, udp_port, tcp_port, engine, max_sessions, tcp_payload.chunk_size, tcp_payload.use_sendfile,
+            tcp_payload.source, admission_limits, in_flight, serverLog.current_level(), metrics_queue)
+
+    def spawn(slot):
+        process = ctx.Process(target=_serve_worker, args=args + (slot, profile, trace_dir, ready),
+                              name=f"server-worker-{slot}", daemon=True)
+        process.start()
+        return process
+
+    def collect_metrics():
+        while True:
+            try:
+                slot, snapshot = metrics_queue.get_nowait()
+            except queue.Empty:
+                return
+            metrics.REGISTRY.update_remote(slot, snapshot)
+
+    processes = [spawn(slot) for slot in range(workers)]
+    log.info("Started %d %s server workers (pids %s)", workers, engine, ", ".join(str(p.pid) for p in processes))
+
+    while not stop_event.wait(SUPERVISE_INTERVAL):
+        collect_metrics()
+        for slot, process in enumerate(processes):
+            if not process.is_alive():
+                log.warning("Worker %d exited with code %s, restarting", process.pid, process.exitcode)
+                metrics.REGISTRY.retire_remote(slot)
+                if in_flight is not None:
+                    # a dead worker never released its transfers
+                    with in_flight.get_lock():
+                        in_flight[slot] = 0
+                process.join()
+                processes[slot] = spawn(slot)
+
+    worker_stop.set()
+    for process in processes:
+        process.join(WORKER_STOP_TIMEOUT)
+        if process.is_alive():
+            log.warning("Worker %d did not stop, terminating", process.pid)
+            process.terminate()
+            process.join()
+    collect_metrics()
+    log.info("All server workers stopped")
+
+
+def default_worker_count():
+    return os.cpu_count() or 1
@@ -0,0 +1,178 @@
+import socket
+import sys
+import serverLog
+
+LISTEN_BACKLOG = 1024  # backlog of the tuned profiles, the kernel caps it at net.core.somaxconn
+CONGESTION_NAME_SIZE = 16  # TCP_CA_NAME_MAX
+# buffer sizes an autotune run tries, 0 = leave the kernel default (and its tcp buffer autotuning) alone
+AUTOTUNE_BUFFER_SIZES = (0, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024)
+
+# linux only options; SO_BUSY_POLL is not exported by the socket module
+TCP_CONGESTION = getattr(socket, "TCP_CONGESTION", None)
+SO_BUSY_POLL = getattr(socket, "SO_BUSY_POLL", 46 if sys.platform.startswith("linux") else None)
+
+socket_log = serverLog.get_logger("Socket")
+
+
+class SocketProfile:
+    """
+    named set of socket options applied the same way by the server and the client
+
+    0 / None leaves an option at the kernel default; note that setting a tcp buffer size turns
+    off the kernel's buffer autotuning for that socket, and that linux doubles the requested
+    size (for its bookkeeping) and caps it at net.core.wmem_max / rmem_max, so what a socket
+    actually got is only known from effective_options
+      - sndbuf, rcvbuf: SO_SNDBUF / SO_RCVBUF of tcp sockets and SO_SNDBUF of udp sockets
+      - udp_rcvbuf: SO_RCVBUF of udp sockets (a receiver that falls behind drops datagrams)
+      - congestion: TCP_CONGESTION algorithm, e.g. "cubic" or "bbr" (must be loaded and allowed)
+      - nodelay: TCP_NODELAY on every tcp connection, not only on keep-alive sessions
+      - backlog: listen backlog of the tcp server, 0 = the engine's own default
+      - busy_poll: SO_BUSY_POLL microseconds a blocking receive spins on the device queue
+    """
+    __slots__ = ("name", "sndbuf", "rcvbuf", "udp_rcvbuf", "congestion", "nodelay", "backlog", "busy_poll")
+
+    def __init__(self, name, sndbuf=0, rcvbuf=0, udp_rcvbuf=0, congestion=None, nodelay=False, backlog=0,
+                 busy_poll=0):
+        self.name = name
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.udp_rcvbuf = udp_rcvbuf
+        self.congestion = congestion
+        self.nodelay = nodelay
+        self.backlog = backlog
+        self.busy_poll = busy_poll
+
+    def __repr__(self):
+        options = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__[1:] if getattr(self, name))
+        return f"{self.name}({options or 'kernel defaults'})"
+
+    def with_buffers(self, size):
+        """
+        copy of this profile with every buffer (tcp and udp) set to size, for buffer sweeps
+        """
+        return SocketProfile(f"{self.name}+buf{size}" if size else self.name, size, size, size, self.congestion,
+                             self.nodelay, self.backlog, self.busy_poll)
+
+    def listen_backlog(self, default):
+        return self.backlog or default
+
+    def apply_tcp(self, sock, buffers=True):
+        """
+        apply the tcp options to sock; buffers=False skips the buffer sizes, for accepted sockets
+        that inherit them from the listening socket (the window scale is fixed by the handshake,
+        so buffers only count when set before listen / connect)
+        """
+        if buffers:
+            _set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf, "SO_SNDBUF")
+            _set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf, "SO_RCVBUF")
+        if self.congestion and TCP_CONGESTION is not None:
+            _set(sock, socket.IPPROTO_TCP, TCP_CONGESTION, self.congestion.encode(), "TCP_CONGESTION")
+        if self.nodelay:
+            _set(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1, "TCP_NODELAY")
+        if SO_BUSY_POLL is not None:
+            _set(sock, socket.SOL_SOCKET, SO_BUSY_POLL, self.busy_poll, "SO_BUSY_POLL")
+
+    def apply_udp(self, sock):
+        _set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf, "SO_SNDBUF")
+        _set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, self.udp_rcvbuf, "SO_RCVBUF")
+        if SO_BUSY_POLL is not None:
+            _set(sock, socket.SOL_SOCKET, SO_BUSY_POLL, self.busy_poll, "SO_BUSY_POLL")
+
+
+def _set(sock, level, option, value, name):
+    """
+    best effort: an option the kernel refuses (unknown congestion algorithm, busy poll without
+    CAP_NET_ADMIN) is logged and left at its default, effective_options shows what applies
+    """
+    if not value:
+        return
+    try:
+        sock.setsockopt(level, option, value)
+    except OSError as e:
+        socket_log.warning("Cannot set %s to %r: %s", name, value, e)
+
+
+PROFILES = {
+    # kernel defaults, what every socket got before profiles existed
+    "default": SocketProfile("default"),
+    # request / response round trips: no nagle, spin briefly instead of sleeping on receive
+    "latency": SocketProfile("latency", nodelay=True, backlog=LISTEN_BACKLOG, busy_poll=50),
+    # bulk transfers on a lan: buffers well above the bandwidth-delay product of a 10 Gbit/s link
+    "throughput": SocketProfile("throughput", sndbuf=4 * 1024 * 1024, rcvbuf=4 * 1024 * 1024,
+                                udp_rcvbuf=8 * 1024 * 1024, backlog=LISTEN_BACKLOG),
+    # long fat networks: larger buffers and a model based congestion control that tolerates loss
+    "wan": SocketProfile("wan", sndbuf=16 * 1024 * 1024, rcvbuf=16 * 1024 * 1024, udp_rcvbuf=16 * 1024 * 1024,
+                         congestion="bbr", backlog=LISTEN_BACKLOG),
+}
+DEFAULT_PROFILE = PROFILES["default"]
+
+
+def connect_tcp(address, profile=None, timeout=None):
+    """
+    socket.create_connection for ipv4 that applies profile before connecting, so the buffer
+    sizes take part in the window scale negotiation
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if profile is not None:
+            profile.apply_tcp(sock)
+        sock.settimeout(timeout)
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def effective_options(sock, profile=None):
+    """
+    the options sock actually ended up with, read back with getsockopt, as result record fields
+    (congestion and nodelay are None for udp sockets, busy_poll off linux); read after a transfer,
+    the buffer sizes include what the kernel's autotuning grew them to
+    """
+    profile = profile if profile is not None else DEFAULT_PROFILE
+    options = {
+        "socket_profile": profile.name,
+        "sndbuf": sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+        "rcvbuf": sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+        "congestion": None,
+        "nodelay": None,
+        "busy_poll": None,
+    }
+    if sock.type == socket.SOCK_STREAM:
+        options["nodelay"] = bool(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+        if TCP_CONGESTION is not None:
+            name = sock.getsockopt(socket.IPPROTO_TCP, TCP_CONGESTION, CONGESTION_NAME_SIZE)
+            options["congestion"] = name.split(b'\0', 1)[0].decode()
+    if SO_BUSY_POLL is not None:
+        options["busy_poll"] = sock.getsockopt(socket.SOL_SOCKET, SO_BUSY_POLL)
+    return options
+
+
+def describe(options):
+    """
+    one line summary of effective_options for logs and progress output
+    """
+    fields = [f"sndbuf {options['sndbuf']}", f"rcvbuf {options['rcvbuf']}"]
+    if options["congestion"]:
+        fields.append(f"congestion {options['congestion']}")
+    if options["nodelay"]:
+        fields.append("nodelay")
+    if options["busy_poll"]:
+        fields.append(f"busy poll {options['busy_poll']} us")
+    return f"{options['socket_profile']}: " + ", ".join(fields)
+
+
+def autotune(measure, base=DEFAULT_PROFILE, sizes=AUTOTUNE_BUFFER_SIZES):
+    """
+    sweep the buffer sizes of base: measure(profile) runs the workload with one candidate and
+    returns its throughput in bits/sec (or None if it failed)
+    returns the candidates as (profile, throughput) pairs, best first
+    """
+    ranking = []
+    for size in sizes:
+        candidate = base.with_buffers(size)
+        throughput = measure(candidate)
+        ranking.append((candidate, throughput))
+    ranking.sort(key=lambda entry: entry[1] if entry[1] is not None else -1, reverse=True)
+    return ranking
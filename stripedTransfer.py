@@ -0,0 +1,261 @@
+import collections
+import threading
+import time
+import zlib
+import compression
+import packetBuilder
+import packetParser
+from Client import _recv_exactly, _check_trailer, _receive_compressed, _compression_stats, TCP_RECV_SIZE
+from Exceptions import *
+from transferStats import IntervalSampler
+from socketProfiles import effective_options
+from ANSI import ANSI
+from constants import *
+
+STRIPE_PIECE_SIZE = 4 * 2 ** 20  # largest byte range requested at once
+STRIPE_MIN_PIECE = 256 * 2 ** 10  # smallest piece; below 4 pieces per stream, pieces shrink down to this
+STRIPE_PIPELINE_DEPTH = 2  # requests in flight per connection, so the server never waits for the next one
+
+
+class StripeScheduler:
+    """
+    hands out the byte ranges of one object to the streams fetching it
+
+    the object starts split into one contiguous range per stream, and every stream requests its
+    range piece by piece. a stream that runs out steals from the stream with the most bytes not
+    requested yet: the upper half of that range becomes the thief's, so a slow stream ends up
+    fetching less and the fast ones finish its work. ranges of a stream that failed are handed
+    out again before anything else. thread safe
+    """
+
+    def __init__(self, object_size, streams, piece_size=None, steal=True):
+        self.object_size = object_size
+        if piece_size is None:
+            piece_size = min(STRIPE_PIECE_SIZE, max(STRIPE_MIN_PIECE, object_size // (streams * 4)))
+        self.piece_size = piece_size
+        self.steal = steal
+        bounds = [object_size * i // streams for i in range(streams + 1)]
+        self.ranges = [[bounds[i], bounds[i + 1]] for i in range(streams)]  # [next unrequested byte, end]
+        self.orphans = collections.deque()  # (offset, length) of pieces abandoned by failed streams
+        self.steals = [0] * streams
+        self.completed = []  # (offset, length) of every piece received
+        self.last_byte = None  # perf_counter time the last piece completed
+        self.lock = threading.Lock()
+
+    def next_piece(self, stream):
+        """
+        the next (offset, length) for stream to request, or None when nothing is left to request
+        """
+        with self.lock:
+            if self.orphans:
+                offset, length = self.orphans.popleft()
+                if length > self.piece_size:
+                    self.orphans.appendleft((offset + self.piece_size, length - self.piece_size))
+                    length = self.piece_size
+                return offset, length
+            current = self.ranges[stream]
+            if current[0] >= current[1] and not (self.steal and self._steal(stream)):
+                return None
+            offset = current[0]
+            length = min(self.piece_size, current[1] - offset)
+            current[0] += length
+            return offset, length
+
+    def _steal(self, thief):
+        victim = max(range(len(self.ranges)), key=lambda stream: self.ranges[stream][1] - self.ranges[stream][0])
+        start, end = self.ranges[victim]
+        # a victim with a piece or less left fetches it sooner than a new request would
+        if end - start <= self.piece_size:
+            return False
+        split = start + (end - start) // 2
+        self.ranges[victim][1] = split
+        self.ranges[thief] = [split, end]
+        self.steals[thief] += 1
+        return True
+
+    def complete(self, offset, length):
+        with self.lock:
+            self.completed.append((offset, length))
+            self.last_byte = time.perf_counter()
+
+    def abandon(self, stream, pieces):
+        """
+        a stream failed: its requested but unreceived pieces and the rest of its range go to the others
+        """
+        with self.lock:
+            self.orphans.extend(pieces)
+            start, end = self.ranges[stream]
+            if start < end:
+                self.orphans.append((start, end - start))
+            self.ranges[stream] = [end, end]
+
+    @property
+    def complete_object(self):
+        """
+        true if the pieces received cover the whole object
+        """
+        covered = 0
+        for offset, length in sorted(self.completed):
+            if offset > covered:
+                return False
+            covered = max(covered, offset + length)
+        return covered >= self.object_size
+
+
+def _stripe_stream(pool, sock, connect_time, scheduler, stream, results, index, verify, codec):
+    """
+    one connection of a striped transfer: keep STRIPE_PIPELINE_DEPTH byte range requests in
+    flight on a keep-alive connection of pool until the scheduler has nothing left
+    """
+    outstanding = collections.deque()
+    try:
+        sock.settimeout(10)
+        sampler = IntervalSampler()
+        flags = REQUEST_FLAG_KEEPALIVE | (REQUEST_FLAG_CHECKSUM if verify else 0)
+        decompressor = compression.Decompressor(codec) if codec != CODEC_NONE else None
+
+        def request_next():
+            piece = scheduler.next_piece(stream)
+            if piece is not None:
+                sock.sendall(packetBuilder.build_tcp_request_msg(piece[1], flags=flags, codec=codec, offset=piece[0]))
+                outstanding.append(piece)
+
+        for _ in range(STRIPE_PIPELINE_DEPTH):
+            request_next()
+
+        header = bytearray(packetParser.RESPONSE_HEADER_SIZE)
+        view = memoryview(bytearray(TCP_RECV_SIZE))
+        bytes_received = 0
+        pieces = 0
+        checksums_ok = True
+        while outstanding:
+            offset, length = outstanding[0]
+            received = _recv_exactly(sock, memoryview(header))
+            if received < len(header):
+                raise (packetParser.rejection_error(header[:received])
+                       or ConnectionError("Server closed the connection in the middle of a response"))
+            remaining = packetParser.unpack_response_header(header)
+            # ask for the piece after next while this one streams in
+            request_next()
+            crc = 0
+            if decompressor is not None:
+                decompressor.reset()
+                received, crc, _ = _receive_compressed(sock, decompressor, sampler, verify)
+                bytes_received += received
+                checksums_ok = checksums_ok and received == remaining
+                remaining = 0
+            while remaining:
+                nbytes = sock.recv_into(view, min(remaining, TCP_RECV_SIZE))
+                if not nbytes:
+                    raise ConnectionError("Server closed the connection in the middle of a response")
+                if verify:
+                    crc = zlib.crc32(view[:nbytes], crc)
+                remaining -= nbytes
+                bytes_received += nbytes
+                sampler.record(nbytes)
+            if verify and not _check_trailer(sock, crc):
+                checksums_ok = False
+            outstanding.popleft()
+            scheduler.complete(offset, length)
+            pieces += 1
+
+        options = effective_options(sock, pool.profile)
+        pool.release(sock)
+        sock = None
+        duration = sampler.finish().duration
+        speed = (bytes_received * 8) / duration if duration > 0 else 0.0
+        integrity = {"checksum_ok": checksums_ok} if verify else {}
+        results[index] = {
+            "type": "TCP",
+            "bytes_received": bytes_received,
+            "duration": duration,
+            "speed": speed,
+            "stripe": stream,
+            "pieces": pieces,
+            "steals": scheduler.steals[stream],
+            "reused_connection": connect_time is None,
+            "connect_time": connect_time,
+            **integrity,
+            **_compression_stats(decompressor, bytes_received, duration),
+            **options,
+            **sampler.to_dict()
+        }
+
+    except RequestRejectedError as e:
+        print(f"[TCP {index + 1}] {e}")
+        scheduler.abandon(stream, outstanding)
+        results[index] = None
+    except Exception as e:
+        print(f"{ANSI.FAIL}[TCP {index + 1}] ERROR: {e}{ANSI.ENDC}")
+        scheduler.abandon(stream, outstanding)
+        results[index] = None
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def striped_transfer(pool, object_size, streams, results, first_index=0, verify=False, codec=CODEC_NONE,
+                     piece_size=None, steal=True):
+    """
+    fetch one object of object_size bytes as byte ranges spread over `streams` keep-alive
+    connections of pool, instead of a full copy per connection
+
+    fills results[first_index:first_index + streams] with the tcp result of every stream
+    (bytes, pieces and steals of that stream) plus the object fields: object_size,
+    time_to_last_byte (from the moment every connection is up to the last piece, for the whole
+    object), object_speed and object_complete
+    returns the object fields
+    """
+    scheduler = StripeScheduler(object_size, streams, piece_size, steal)
+    # every connection is up before the clock starts, so time to last byte is the transfer alone
+    connections = []
+    for stream in range(streams):
+        try:
+            connections.append(pool.acquire())
+        except OSError as e:
+            print(f"{ANSI.FAIL}[TCP {first_index + stream + 1}] ERROR: {e}{ANSI.ENDC}")
+            scheduler.abandon(stream, ())
+            results[first_index + stream] = None
+            connections.append(None)
+
+    started = time.perf_counter()
+    threads = []
+    for stream, connection in enumerate(connections):
+        if connection is None:
+            continue
+        thread = threading.Thread(
+            target=_stripe_stream,
+            args=(pool, *connection, scheduler, stream, results, first_index + stream, verify, codec),
+            daemon=True
+        )
+        threads.append(thread)
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # streams that died left their ranges behind: one more connection fetches them
+    if scheduler.orphans and threads:
+        recovery = [None]
+        try:
+            _stripe_stream(pool, *pool.acquire(), scheduler, 0, recovery, 0, verify, codec)
+        except OSError as e:
+            print(f"{ANSI.FAIL}[TCP] Could not recover the ranges of failed streams: {e}{ANSI.ENDC}")
+
+    time_to_last_byte = (scheduler.last_byte - started) if scheduler.last_byte is not None else None
+    summary = {
+        "object_size": object_size,
+        "time_to_last_byte": time_to_last_byte,
+        "object_speed": (object_size * 8) / time_to_last_byte if time_to_last_byte else 0.0,
+        "object_complete": scheduler.complete_object,
+    }
+    for stream in range(streams):
+        if results[first_index + stream] is not None:
+            results[first_index + stream].update(summary)
+
+    steals = sum(scheduler.steals)
+    state = "complete" if summary["object_complete"] else f"{ANSI.FAIL}INCOMPLETE"
+    ttlb = f"{time_to_last_byte:.3f}" if time_to_last_byte is not None else "-"
+    print(f"{ANSI.HEADER}[TCP] Striped object {state}: {object_size} bytes over {streams} streams, time to last byte "
+          f"{ttlb} seconds ({summary['object_speed']:.2f} bits/sec), {len(scheduler.completed)} pieces, "
+          f"{steals} steals{ANSI.ENDC}")
+    return summary
@@ -0,0 +1,64 @@
+import threading
+import time
+
+SPIN_THRESHOLD = 0.0002  # below this many seconds wait() spins instead of sleeping
+
+
+class TokenBucket:
+    """
+    high-resolution token bucket driven by time.perf_counter_ns
+
+    rate is in tokens (bytes) per second and capacity bounds how many tokens can pile up while
+    idle. consume() may drive the bucket into debt, so a sender can spend a whole burst as soon
+    as the bucket is non-negative and the long-run rate still comes out exact
+    thread safe, so one bucket can be a budget shared by many senders
+    """
+
+    def __init__(self, rate, capacity):
+        if rate <= 0:
+            raise ValueError(f"token bucket rate must be positive, got {rate}")
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.last_ns = time.perf_counter_ns()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.perf_counter_ns()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_ns) * self.rate / 1e9)
+        self.last_ns = now
+
+    def delay(self):
+        """
+        seconds until the bucket is out of debt, 0.0 if tokens may be spent right now
+        """
+        with self.lock:
+            self._refill()
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def consume(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+
+    def refund(self, amount):
+        """
+        give back tokens consumed for bytes that were never sent
+        """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def wait(self):
+        """
+        block until delay() is 0: sleeps for the coarse part and spins for the last few
+        hundred microseconds, since time.sleep overshoots by far more than that
+        """
+        while True:
+            delay = self.delay()
+            if delay <= 0:
+                return
+            if delay > SPIN_THRESHOLD:
+                time.sleep(delay - SPIN_THRESHOLD)
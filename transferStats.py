@@ -0,0 +1,187 @@
+import itertools
+import time
+from array import array
+
+SAMPLE_INTERVAL_NS = 100_000_000  # 100 ms throughput buckets
+JITTER_GAIN = 16  # rfc 3550 smoothing factor for the inter-arrival jitter estimate
+PERCENTILES = (50, 90, 99)
+
+
+class IntervalSampler:
+    """
+    time series of one stream, timestamps from time.perf_counter_ns
+
+    bytes are accumulated into fixed-width interval buckets kept in an array('Q'), so a long
+    transfer costs 8 bytes per interval. also tracks time to first byte and, for udp, an
+    rfc 3550 style estimate of the inter-arrival jitter (variation of the gaps between datagrams)
+    """
+    __slots__ = ('interval_ns', 'start_ns', 'first_byte_ns', 'last_byte_ns', 'end_ns', 'buckets',
+                 'track_jitter', 'jitter_ns', '_prev_gap_ns')
+
+    def __init__(self, interval_ns=SAMPLE_INTERVAL_NS, track_jitter=False):
+        self.interval_ns = interval_ns
+        self.start_ns = time.perf_counter_ns()
+        self.first_byte_ns = None
+        self.last_byte_ns = None
+        self.end_ns = None
+        self.buckets = array('Q')
+        self.track_jitter = track_jitter
+        self.jitter_ns = 0.0
+        self._prev_gap_ns = None
+
+    def record(self, nbytes):
+        now = time.perf_counter_ns()
+        if self.first_byte_ns is None:
+            self.first_byte_ns = now
+        elif self.track_jitter:
+            gap = now - self.last_byte_ns
+            if self._prev_gap_ns is not None:
+                self.jitter_ns += (abs(gap - self._prev_gap_ns) - self.jitter_ns) / JITTER_GAIN
+            self._prev_gap_ns = gap
+        self.last_byte_ns = now
+
+        slot = (now - self.start_ns) // self.interval_ns
+        buckets = self.buckets
+        if slot >= len(buckets):
+            buckets.extend(itertools.repeat(0, slot + 1 - len(buckets)))
+        buckets[slot] += nbytes
+
+    def finish(self, at_last_byte=False):
+        """
+        stop the clock; at_last_byte ends the stream at its last arrival instead of now,
+        for receivers that only notice the end after an idle timeout (udp)
+        """
+        if at_last_byte and self.last_byte_ns is not None:
+            self.end_ns = self.last_byte_ns
+        else:
+            self.end_ns = time.perf_counter_ns()
+        return self
+
+    @property
+    def duration(self):
+        end_ns = self.end_ns if self.end_ns is not None else time.perf_counter_ns()
+        return (end_ns - self.start_ns) / 1e9
+
+    def to_dict(self):
+        """
+        plain, picklable / json-able form for result records
+        """
+        result = {
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "ttfb": (self.first_byte_ns - self.start_ns) / 1e9 if self.first_byte_ns is not None else None,
+            "sample_interval": self.interval_ns / 1e9,
+            "samples": self.buckets.tolist(),
+        }
+        if self.track_jitter:
+            result["jitter"] = self.jitter_ns / 1e9
+        return result
+
+
+def percentile(sorted_values, pct):
+    """
+    nearest-rank percentile of an already sorted, non-empty sequence
+    """
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def distribution(values):
+    """
+    p50 / p90 / p99 / max summary of a sequence, None when empty
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    summary = {f"p{pct}": percentile(ordered, pct) for pct in PERCENTILES}
+    summary["max"] = ordered[-1]
+    return summary
+
+
+def _interval_rates(samples, interval_ns, span_ns):
+    """
+    bits/sec of every bucket; the last bucket is usually partial, so it is divided by the
+    part of the interval that was actually covered (span_ns = time from bucket 0 to the end)
+    """
+    rates = [nbytes * 8e9 / interval_ns for nbytes in samples]
+    if rates and span_ns is not None:
+        covered = span_ns - (len(rates) - 1) * interval_ns
+        if 0 < covered < interval_ns:
+            rates[-1] = samples[-1] * 8e9 / covered
+    return rates
+
+
+def _span_ns(result):
+    if result.get("end_ns") is None:
+        return None
+    return result["end_ns"] - result["start_ns"]
+
+
+def aggregate_series(results):
+    """
+    sum the per-interval byte counts of concurrent streams on a common time axis
+    returns (interval seconds, [bits/sec per interval]) starting at the earliest stream start
+    """
+    timed = [r for r in results if r.get("samples") is not None]
+    if not timed:
+        return None, []
+    interval_ns = round(timed[0]["sample_interval"] * 1e9)
+    origin = min(r["start_ns"] for r in timed)
+
+    series = []
+    for r in timed:
+        shift = (r["start_ns"] - origin) // interval_ns
+        for slot, nbytes in enumerate(r["samples"], shift):
+            if slot >= len(series):
+                series.extend(itertools.repeat(0, slot + 1 - len(series)))
+            series[slot] += nbytes
+
+    ends = [r["end_ns"] for r in timed if r.get("end_ns") is not None]
+    span_ns = (max(ends) - origin) if ends else None
+    return interval_ns / 1e9, _interval_rates(series, interval_ns, span_ns)
+
+
+def stream_span(results):
+    """
+    seconds from the first stream start to the last stream end of concurrent results, None if
+    none of them is timed; a udp stream ends at its last byte, not at the idle timeout after it
+    """
+    timed = [r for r in results if r and r.get("start_ns") is not None and r.get("end_ns") is not None]
+    if not timed:
+        return None
+    return (max(r["end_ns"] for r in timed) - min(r["start_ns"] for r in timed)) / 1e9
+
+
+def summarize(results):
+    """
+    statistics of a group of concurrent streams (failed streams, i.e. None, are skipped)
+      - wall-clock aggregate throughput: total bytes over first start .. last end
+      - p50 / p90 / p99 / max of the aggregate throughput per interval
+      - p50 / p90 / p99 / max of every stream's own per-interval throughput, ttfb and jitter
+    """
+    completed = [r for r in results if r]
+    if not completed:
+        return None
+
+    total_bytes = sum(r["bytes_received"] for r in completed)
+    wall_duration = stream_span(completed) or 0.0
+
+    interval, series = aggregate_series(completed)
+    stream_samples = [
+        rate for r in completed if r.get("samples")
+        for rate in _interval_rates(r["samples"], round(r["sample_interval"] * 1e9), _span_ns(r))
+    ]
+    jitters = [r["jitter"] for r in completed if r.get("jitter") is not None]
+
+    return {
+        "streams": len(completed),
+        "failed_streams": len(results) - len(completed),
+        "bytes_received": total_bytes,
+        "wall_duration": wall_duration,
+        "throughput": (total_bytes * 8) / wall_duration if wall_duration > 0 else 0.0,
+        "sample_interval": interval,
+        "interval_throughput": distribution(series),
+        "stream_interval_throughput": distribution(stream_samples),
+        "ttfb": distribution([r["ttfb"] for r in completed if r.get("ttfb") is not None]),
+        "jitter": distribution(jitters),
+    }
@@ -0,0 +1,516 @@
+import collections
+import errno
+import socket
+import struct
+import sys
+import time
+import zlib
+import compression
+import metrics
+import packetBuilder
+from constants import CODEC_NONE
+from packetParser import PAYLOAD_HEADER_SIZE, CHECKED_PAYLOAD_HEADER_SIZE
+from packetTrace import TRACE_RETRANSMIT
+from tokenBucket import TokenBucket
+
+# linux udp generic segmentation offload: one sendmsg carries many equally sized datagrams
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+GSO_MAX_SEGMENTS = 64
+MAX_DATAGRAM_SIZE = 65507  # largest udp payload of an ipv4 datagram (the 16 bit ip length field)
+GSO_MAX_BYTES = MAX_DATAGRAM_SIZE  # a gso super-datagram is still bounded by the udp length field
+MAX_BATCH_SIZE = 64
+PACING_QUANTUM = 0.001  # a paced burst carries about this many seconds worth of the target rate
+RETRANSMIT_MIN_RATE = 125_000  # bytes/sec floor of the retransmission pacer (1 Mbit/s)
+
+# path mtu discovery (linux), IP_MTU and IP_MTU_DISCOVER are not exported by the socket module
+IP_MTU = getattr(socket, 'IP_MTU', 14 if sys.platform.startswith('linux') else None)
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10 if sys.platform.startswith('linux') else None)
+IP_PMTUDISC_WANT = 1  # DF on datagrams that fit the path mtu, larger ones are fragmented locally
+IP_UDP_OVERHEAD = 28  # ipv4 header without options + udp header
+DEFAULT_PATH_MTU = 1500  # assumed where the kernel cannot be asked
+
+# None = not probed yet, flips to False the first time the kernel rejects UDP_SEGMENT
+_gso_supported = None if hasattr(socket.socket, 'sendmsg') else False
+
+
+def path_mtu(addr):
+    """
+    mtu of the path to addr as the kernel knows it: the mtu of the route, lowered by the icmp
+    fragmentation-needed answers path mtu discovery got so far. read with IP_MTU from a udp
+    socket connected to addr (a route lookup, nothing is sent); DEFAULT_PATH_MTU off linux
+    """
+    if IP_MTU is None:
+        return DEFAULT_PATH_MTU
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe.connect(addr)
+        return probe.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return DEFAULT_PATH_MTU
+    finally:
+        probe.close()
+
+
+def max_segment_size(addr, header_size):
+    """
+    largest payload a datagram with a header_size byte header can carry to addr without being
+    fragmented
+    """
+    return min(path_mtu(addr) - IP_UDP_OVERHEAD, MAX_DATAGRAM_SIZE) - header_size
+
+
+def allow_fragments(sock):
+    """
+    IP_PMTUDISC_WANT on a sending socket, whatever the system default: datagrams that fit the
+    path mtu keep DF set (so path mtu discovery keeps lowering it), larger ones are fragmented
+    by the kernel instead of failing with EMSGSIZE
+    """
+    if IP_MTU_DISCOVER is None:
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_WANT)
+    except OSError:
+        pass
+
+
+class UdpBatchSender:
+    """
+    sends the payload segments of one udp transfer in bursts
+
+    a burst of up to batch_size segments is laid out back to back in one reusable bytearray
+    (21 byte header + payload each); the payload bytes are written once, only the headers are
+    re-packed in place for every burst. with gso a whole burst is a single sendmsg syscall,
+    otherwise every segment is sent as a memoryview slice of the same buffer
+
+    when target_rate (bits/sec) is set, bursts shrink to about PACING_QUANTUM worth of data and
+    are released by a token bucket instead of as fast as the socket accepts them
+
+    budget is an optional server-wide TokenBucket (bytes/sec) shared with the other transfers,
+    drawn from like the pacer
+
+    segments nacked by the client (reliable mode) are queued with retransmit() and go out in
+    later bursts once the first pass is done, through the same buffer. every round of
+    retransmissions is paced at the rate the client took in the previous round (segments sent
+    minus segments nacked, over the time it took to send them), never above target_rate and
+    never faster than an earlier round, so a round does not overflow the receive buffer the
+    previous one overflowed
+
+    payload is an optional payloadSource.TcpPayload holding real data: segment i then carries
+    stream bytes offset + i * segment_size onwards, copied into the buffer for every burst (a constant
+    fill payload keeps the write-once buffer). checksum sends checked payload messages, the
+    25 byte header carrying the crc32 of the segment's payload
+
+    codec (CODEC_*) compresses every segment on its own (compression.SegmentCodec). compressed
+    datagrams differ in length, so they are built as separate messages and sent one by one
+    without gso; the next first-pass burst is compressed in the compression pool while the
+    current one is sent. the crc32 of a checked segment covers its bytes as sent
+
+    gso cannot fragment: a segment_size whose datagrams exceed the path mtu needs use_gso=False
+
+    trace is an optional packetTrace.TraceRecorder getting a record for every segment sent
+    (the segments of a gso burst share one timestamp); the caller closes it
+    """
+
+    def __init__(self, sock, addr, file_size, segment_size, batch_size=None, use_gso=None, fill=b'X',
+                 target_rate=0, budget=None, payload=None, checksum=False, codec=CODEC_NONE, offset=0, trace=None):
+        self.sock = sock
+        self.addr = addr
+        self.file_size = file_size
+        self.segment_size = segment_size
+        self.total_segments = (file_size + segment_size - 1) // segment_size
+        self.next_segment = 0
+        self.bytes_sent = 0
+        self.syscalls = 0
+        self.pending = collections.deque()  # [first, length] ranges waiting for retransmission
+        self.retransmitted = 0  # segments sent again on request
+        # delivery of the current round (the first pass, then each round of retransmissions)
+        self.round_sent = 0
+        self.round_start_ns = None
+        self.round_end_ns = None
+        self.nacked = 0  # segments nacked since the round ended
+        self.retransmit_rate = None  # bytes/sec of the retransmission pacer
+        self.retransmit_batch = 0
+
+        self.stream = payload if payload is not None and payload.fill is None else None
+        self.offset = offset
+        self.checksum = checksum
+        self.header_size = CHECKED_PAYLOAD_HEADER_SIZE if checksum else PAYLOAD_HEADER_SIZE
+        self.packet_size = self.header_size + segment_size
+        gso_batch = min(GSO_MAX_SEGMENTS, GSO_MAX_BYTES // self.packet_size)
+        if batch_size is None:
+            batch_size = max(1, gso_batch)
+            if target_rate:
+                batch_size = min(batch_size, int(target_rate / 8 * PACING_QUANTUM) // self.packet_size)
+        self.batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+        self.use_gso = (_gso_supported is not False) if use_gso is None else use_gso
+        if self.batch_size > gso_batch or codec != CODEC_NONE:
+            self.use_gso = False
+
+        self.codec = compression.SegmentCodec(codec) if codec != CODEC_NONE else None
+        self.fill = fill
+        self.fill_encoded = {}  # segment length -> compressed constant fill, encoded once
+        self.burst = collections.deque()  # (segment, message) of the encoded burst being sent
+        self.burst_retransmit = False
+        self.prefetch = None  # (first segment, count, future) of the next encoded first-pass burst
+        self.wire_bytes = 0  # payload bytes as sent, after compression
+
+        self.buffer = bytearray(self.batch_size * self.packet_size)
+        if self.stream is None:
+            for i in range(self.batch_size):
+                start = i * self.packet_size + self.header_size
+                self.buffer[start:start + segment_size] = fill * segment_size
+        self.view = memoryview(self.buffer)
+        # constant fill: every full segment has the same crc, only a short last one differs
+        self.fill_checksums = None
+        if checksum and self.stream is None and self.total_segments:
+            last = self._segment_length(self.total_segments - 1)
+            self.fill_checksums = (zlib.crc32(fill * segment_size), zlib.crc32(fill * last))
+        self.gso_cmsg = [(SOL_UDP, UDP_SEGMENT, struct.pack('=H', self.packet_size))]
+
+        self.target_rate = target_rate
+        self.pacer = None
+        if target_rate:
+            self.pacer = TokenBucket(target_rate / 8, self.batch_size * self.packet_size)
+        self.budget = budget
+        self.trace = trace
+        if trace is not None:
+            trace.set_transfer(self.total_segments, segment_size)
+
+    @property
+    def done(self):
+        """
+        true when nothing is left to send right now (a reliable transfer may get more nacks)
+        """
+        return self.next_segment >= self.total_segments and not self.pending and not self.burst
+
+    def ready(self):
+        """
+        false while the next encoded burst is still being compressed in the pool
+        """
+        return bool(self.burst) or self.prefetch is None or self.prefetch[2].done()
+
+    def retransmit(self, ranges):
+        """
+        queue (first_segment, length) ranges for retransmission, clipped to the transfer
+        returns the number of segments queued
+        """
+        queued = 0
+        for first, length in ranges:
+            length = min(length, self.total_segments - first)
+            if length > 0:
+                self.pending.append([first, length])
+                queued += length
+        self.nacked += queued
+        return queued
+
+    def pacing_delay(self):
+        """
+        seconds until the next burst may go out, 0.0 when unpaced or due
+        """
+        delay = self.pacer.delay() if self.pacer is not None else 0.0
+        if self.budget is not None:
+            delay = max(delay, self.budget.delay())
+        return delay
+
+    def _segment_length(self, segment):
+        if segment == self.total_segments - 1:
+            return self.file_size - segment * self.segment_size
+        return self.segment_size
+
+    def _pace_retransmissions(self):
+        """
+        start a round of retransmissions: replace the pacer by one running at the rate the
+        client took in the round that just ended, with bursts of about PACING_QUANTUM worth of it
+        """
+        duration_ns = (self.round_end_ns or 0) - (self.round_start_ns or 0)
+        if self.round_sent and duration_ns > 0:
+            delivered = max(self.round_sent - self.nacked, 0)
+            rate = delivered * self.packet_size * 1e9 / duration_ns
+            if not delivered:
+                # nothing got through: back off from the rate the round was sent at
+                rate = (self.retransmit_rate or self.round_sent * self.packet_size * 1e9 / duration_ns) / 2
+            if self.retransmit_rate is not None:
+                rate = min(rate, self.retransmit_rate)
+            if self.target_rate:
+                rate = min(rate, self.target_rate / 8)
+            self.retransmit_rate = max(rate, RETRANSMIT_MIN_RATE)
+            self.retransmit_batch = max(1, min(self.batch_size,
+                                               int(self.retransmit_rate * PACING_QUANTUM) // self.packet_size))
+            self.pacer = TokenBucket(self.retransmit_rate, self.retransmit_batch * self.packet_size)
+        self.round_sent = 0
+        self.round_start_ns = self.round_end_ns = None
+        self.nacked = 0
+
+    def _take_pending(self):
+        """
+        pop up to one burst of queued retransmissions, in ascending order so a short last
+        segment can only end the burst (gso needs every other segment full sized)
+        """
+        if self.nacked:
+            self._pace_retransmissions()
+        batch_size = self.retransmit_batch or self.batch_size
+        segments = []
+        while self.pending and len(segments) < batch_size:
+            entry = self.pending[0]
+            take = min(entry[1], batch_size - len(segments))
+            segments.extend(range(entry[0], entry[0] + take))
+            entry[0] += take
+            entry[1] -= take
+            if not entry[1]:
+                self.pending.popleft()
+        segments.sort()
+        return segments
+
+    def send_burst(self):
+        """
+        send the next burst of segments: the first pass in order, then queued retransmissions
+        returns the number of segments sent; if the socket would block, the segments that did
+        go out are accounted for, retransmissions that did not are queued again with their
+        pacing tokens given back, and blockingioerror is re-raised
+        """
+        if self.codec is not None:
+            return self._send_encoded()
+        segments = self._next_segments()
+        if not segments:
+            return 0
+        count = len(segments)
+
+        # pack the headers in place and compute the wire length of the burst
+        if self.stream is not None or self.checksum:
+            self._fill_segments(segments)
+        else:
+            for i, segment in enumerate(segments):
+                packetBuilder.pack_payload_header_into(
+                    self.buffer, i * self.packet_size, self.total_segments, segment
+                )
+        length = (count - 1) * self.packet_size + self.header_size + self._segment_length(segments[-1])
+        if self.pacer is not None:
+            self.pacer.consume(length)
+        if self.budget is not None:
+            self.budget.consume(length)
+
+        try:
+            if self.use_gso and count > 1:
+                try:
+                    sent_gso = self._send_gso(length)
+                except BaseException:
+                    # nothing went out: retransmissions go back to the queue, tokens to the buckets
+                    self._refund(length)
+                    self._advance(segments, 0)
+                    raise
+                if sent_gso:
+                    self._advance(segments, count)
+                    return count
+
+            sent = 0
+            observe = metrics.UDP_SEND_SECONDS.observe
+            try:
+                for i in range(count):
+                    start = i * self.packet_size
+                    end = min(start + self.packet_size, length)
+                    started = time.perf_counter()
+                    self.sock.sendto(self.view[start:end], self.addr)
+                    observe(time.perf_counter() - started)
+                    self.syscalls += 1
+                    sent += 1
+            finally:
+                if sent < count:
+                    self._refund(length - sent * self.packet_size)
+                self._advance(segments, sent)
+            return sent
+        except BlockingIOError:
+            metrics.UDP_SEND_EAGAIN.inc()
+            raise
+        except OSError:
+            metrics.UDP_SEND_ERRORS.inc()
+            raise
+
+    def _next_segments(self):
+        """
+        the segments of the next burst: a range on the first pass, a list of retransmissions after it
+        """
+        if self.next_segment < self.total_segments:
+            count = min(self.batch_size, self.total_segments - self.next_segment)
+            return range(self.next_segment, self.next_segment + count)
+        return self._take_pending()
+
+    def _send_encoded(self):
+        """
+        send_burst for compressed segments: messages of a burst that could not be sent stay
+        queued in self.burst and go out first on the next call
+        """
+        if not self.burst:
+            segments = self._next_segments()
+            if not segments:
+                return 0
+            self.burst_retransmit = isinstance(segments, list)
+            if not self.burst_retransmit:
+                self.next_segment += len(segments)
+            self.burst.extend(zip(segments, self._encoded(segments)))
+            if not self.burst_retransmit and self.next_segment < self.total_segments:
+                count = min(self.batch_size, self.total_segments - self.next_segment)
+                following = range(self.next_segment, self.next_segment + count)
+                self.prefetch = (following.start, count, compression.pool().submit(self._encode, following))
+            length = sum(len(message) for _, message in self.burst)
+            if self.pacer is not None:
+                self.pacer.consume(length)
+            if self.budget is not None:
+                self.budget.consume(length)
+
+        sent = 0
+        nbytes = 0
+        observe = metrics.UDP_SEND_SECONDS.observe
+        try:
+            while self.burst:
+                segment, message = self.burst[0]
+                started = time.perf_counter()
+                self.sock.sendto(message, self.addr)
+                observe(time.perf_counter() - started)
+                self.burst.popleft()
+                self.syscalls += 1
+                self.wire_bytes += len(message) - self.header_size
+                if self.trace is not None:
+                    self.trace.record(segment, len(message) - self.header_size,
+                                      TRACE_RETRANSMIT if self.burst_retransmit else 0)
+                nbytes += self._segment_length(segment)
+                sent += 1
+        except BlockingIOError:
+            metrics.UDP_SEND_EAGAIN.inc()
+            raise
+        except OSError:
+            metrics.UDP_SEND_ERRORS.inc()
+            raise
+        finally:
+            self.bytes_sent += nbytes
+            metrics.UDP_BYTES_SENT.inc(nbytes)
+            metrics.UDP_SEGMENTS_SENT.inc(sent)
+            self._round_sent(sent)
+            if self.burst_retransmit:
+                self.retransmitted += sent
+                metrics.UDP_RETRANSMITTED.inc(sent)
+        return sent
+
+    def _encoded(self, segments):
+        """
+        the messages of a burst, from the prefetch when it holds them; the segment codec is
+        not thread safe, so an outstanding prefetch is always waited for first
+        """
+        if self.prefetch is not None:
+            first, count, future = self.prefetch
+            self.prefetch = None
+            messages = future.result()
+            if isinstance(segments, range) and segments.start == first and len(segments) == count:
+                return messages
+        return self._encode(segments)
+
+    def _encode(self, segments):
+        """
+        compress and frame every segment of a burst, runs in the compression pool for prefetches
+        """
+        started = time.thread_time()
+        messages = []
+        for segment in segments:
+            length = self._segment_length(segment)
+            if self.stream is not None:
+                data = self.codec.encode(self.stream.read(self.offset + segment * self.segment_size, length))
+            else:
+                data = self.fill_encoded.get(length)
+                if data is None:
+                    data = self.fill_encoded[length] = self.codec.encode(self.fill * length)
+            if self.checksum:
+                messages.append(packetBuilder.build_checked_payload_msg(self.total_segments, segment, data))
+            else:
+                messages.append(packetBuilder.build_payload_msg(self.total_segments, segment, data))
+        metrics.COMPRESS_SECONDS.inc(time.thread_time() - started)
+        return messages
+
+    def _fill_segments(self, segments):
+        """
+        header packing for real payloads and checked segments: copy each segment's bytes of
+        the stream into the buffer and / or hash them for the checked header
+        """
+        last = self.total_segments - 1
+        for i, segment in enumerate(segments):
+            start = i * self.packet_size
+            payload_start = start + self.header_size
+            length = self._segment_length(segment)
+            if self.stream is not None:
+                self.stream.read_into(self.buffer, payload_start, self.offset + segment * self.segment_size, length)
+            if not self.checksum:
+                packetBuilder.pack_payload_header_into(self.buffer, start, self.total_segments, segment)
+                continue
+            if self.fill_checksums is not None:
+                checksum = self.fill_checksums[segment == last]
+            else:
+                checksum = zlib.crc32(self.view[payload_start:payload_start + length])
+            packetBuilder.pack_checked_payload_header_into(self.buffer, start, self.total_segments, segment, checksum)
+
+    def _send_gso(self, length):
+        """
+        try to send the first length bytes of the buffer as one segmented sendmsg
+        returns false (and disables gso process-wide) if the kernel does not support it
+        """
+        global _gso_supported
+        try:
+            started = time.perf_counter()
+            self.sock.sendmsg([self.view[:length]], self.gso_cmsg, 0, self.addr)
+            metrics.UDP_SEND_SECONDS.observe(time.perf_counter() - started)
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            raise
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOPROTOOPT, errno.EIO, errno.EOPNOTSUPP):
+                raise
+            _gso_supported = False
+            self.use_gso = False
+            return False
+        _gso_supported = True
+        self.syscalls += 1
+        return True
+
+    def _refund(self, length):
+        if self.pacer is not None:
+            self.pacer.refund(length)
+        if self.budget is not None:
+            self.budget.refund(length)
+
+    def _round_sent(self, count):
+        if count:
+            now = time.perf_counter_ns()
+            if self.round_start_ns is None:
+                self.round_start_ns = now
+            self.round_end_ns = now
+            self.round_sent += count
+
+    def _advance(self, segments, count):
+        self._round_sent(count)
+        if self.trace is not None and count:
+            sent = segments[:count]
+            self.trace.record_burst(sent, map(self._segment_length, sent),
+                                    TRACE_RETRANSMIT if isinstance(segments, list) else 0)
+        if isinstance(segments, list):
+            # retransmissions: whatever did not go out goes back to the front of the queue
+            for segment in reversed(segments[count:]):
+                self.pending.appendleft([segment, 1])
+            self.retransmitted += count
+            metrics.UDP_RETRANSMITTED.inc(count)
+        else:
+            self.next_segment += count
+        if count:
+            nbytes = (count - 1) * self.segment_size + self._segment_length(segments[count - 1])
+            self.bytes_sent += nbytes
+            self.wire_bytes += nbytes
+            metrics.UDP_BYTES_SENT.inc(nbytes)
+            metrics.UDP_SEGMENTS_SENT.inc(count)
+
+    def send_all(self):
+        """
+        blocking helper: send every remaining segment of the transfer
+        """
+        while not self.done:
+            if self.pacer is not None:
+                self.pacer.wait()
+            if self.budget is not None:
+                self.budget.wait()
+            self.send_burst()
+        return self.bytes_sent